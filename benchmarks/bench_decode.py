@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Time and peak memory of decoding a light curve query result.
+
+Compares the old decoding in loadlc_db (fetchall, then one list
+comprehension per column; split() per column for the SSH text output)
+with the streaming decoders in data.py, on a synthetic table of a million
+rows. Each method runs in a fresh process so that peak memory is measured
+independently.
+
+Usage: python benchmarks/bench_decode.py [nrows]
+"""
+import os
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time as timer
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+import data
+
+QUERY = "SELECT cadenceno, quarter, sap_quality, time, pdcsap_flux, " \
+        "pdcsap_flux_err FROM source;"
+
+
+def make_table(dirname, nrows):
+    """
+    Write a synthetic `source` table as both sqlite and mysql-style text.
+    """
+    cadence = np.arange(nrows)
+    quarter = cadence // (nrows // 17 + 1)
+    quality = np.zeros(nrows, dtype=int)
+    time = 120.0 + cadence / 48.0
+    flux = 1e4 + np.random.normal(0, 10, nrows)
+    fluxerr = np.ones(nrows)
+
+    columns = (cadence, quarter, quality, time, flux, fluxerr)
+
+    db = sqlite3.connect(os.path.join(dirname, 'source.db'))
+    db.execute('CREATE TABLE source (cadenceno INT, quarter INT, '
+               'sap_quality INT, time REAL, pdcsap_flux REAL, '
+               'pdcsap_flux_err REAL)')
+    db.executemany('INSERT INTO source VALUES (?, ?, ?, ?, ?, ?)',
+                   zip(*[column.tolist() for column in columns]))
+    db.commit()
+    db.close()
+
+    text = open(os.path.join(dirname, 'source.txt'), 'w')
+    text.write('cadenceno\tquarter\tsap_quality\ttime\tpdcsap_flux\t'
+               'pdcsap_flux_err\n')
+    for row in zip(*columns):
+        text.write('%d\t%d\t%d\t%.8f\t%.4f\t%.4f\n' % row)
+    text.close()
+
+
+def decode(dirname, method):
+    """
+    Decode the synthetic table with one method.
+    """
+    if method in ('fetchall', 'stream'):
+        db = sqlite3.connect(os.path.join(dirname, 'source.db'))
+        cursor = db.cursor()
+        cursor.execute(QUERY)
+
+        if method == 'fetchall':
+            results = cursor.fetchall()
+            cadence = np.array([x[0] for x in results], dtype=np.int32)
+            quarter = np.array([x[1] for x in results], dtype=np.int32)
+            quality = np.array([x[2] for x in results], dtype=np.int32)
+            time = np.array([x[3] for x in results], dtype=np.float64)
+            flux = np.array([x[4] for x in results], dtype=np.float32)
+            fluxerr = np.array([x[5] for x in results], dtype=np.float32)
+            cursor.close()
+        else:
+            rows = data._read_rows(cursor, data._LC_DTYPE)
+            time = rows['time']
+    else:
+        stream = open(os.path.join(dirname, 'source.txt'))
+
+        if method == 'split':
+            results = stream.read().splitlines()[1:]
+            cadence = np.array([int(x.split('\t')[0]) for x in results],
+                               dtype=np.int32)
+            quarter = np.array([int(x.split('\t')[1]) for x in results],
+                               dtype=np.int32)
+            quality = np.array([int(x.split('\t')[2]) for x in results],
+                               dtype=np.int32)
+            time = np.array([float(x.split('\t')[3]) for x in results],
+                            dtype=np.float64)
+            flux = np.array([float(x.split('\t')[4]) for x in results],
+                            dtype=np.float32)
+            fluxerr = np.array([float(x.split('\t')[5]) for x in results],
+                               dtype=np.float32)
+        else:
+            rows = data._read_text_rows(stream, data._LC_DTYPE)
+            time = rows['time']
+
+    return time.size
+
+
+def main():
+    if len(sys.argv) == 4:
+        # Child process: decode, then report time and peak memory. Every
+        # child imports the same modules, so the peaks are comparable.
+        start = timer.time()
+        nrows = decode(sys.argv[2], sys.argv[3])
+        elapsed = timer.time() - start
+        rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print nrows, elapsed, rss_peak / 1024.
+        return
+
+    nrows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    dirname = tempfile.mkdtemp()
+    try:
+        make_table(dirname, nrows)
+
+        print '{0:>10s} {1:>10s} {2:>10s} {3:>14s}'.format(
+            'method', 'rows', 'time (s)', 'peak mem (MB)')
+        for method in ('fetchall', 'stream', 'split', 'read_csv'):
+            out = subprocess.check_output([sys.executable, __file__, 'child',
+                                           dirname, method]).split()
+            print '{0:>10s} {1:>10d} {2:10.2f} {3:14.1f}'.format(
+                method, int(out[0]), float(out[1]), float(out[2]))
+    finally:
+        shutil.rmtree(dirname)
+
+
+if __name__ == '__main__':
+    main()
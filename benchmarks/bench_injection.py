@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Injection-recovery benchmark of the rotation period search.
+
+Spot signals are injected over a grid of primary and secondary rotation
+periods, amplitudes and noise levels, using ModelBinary.make_fluxes (or
+BopIt.light_it with --source bopit). Each light curve then goes through
+LightCurve.curve_cut and LightCurve.periodogram. A rotation period counts
+as recovered if the best period is within --tol (relative) of the
+injected primary rotation period, whose spot amplitude is twice the
+secondary's.
+
+The report gives the wall time and throughput in points per second of
+each stage ("inject", "cut", "periodogram"), and the fraction recovered
+over the grid. Each run also appends one row to a history file, tagged
+with the git commit, so the speed and completeness impact of a change to
+curve cutting or the periodogram show up next to earlier runs.
+
+Usage: python benchmarks/bench_injection.py [--engine fft] [--source bopit]
+           [--history FILE] [--length DAYS] [--tol TOL]
+"""
+import argparse
+import datetime
+import os
+import subprocess
+import sys
+import time as timer
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'jktebop'))
+
+from binaries import ModelBinary
+from lightcurve import LightCurve
+
+# Kepler dates are BJD - 2454833; LightCurve.curve_cut expects t_0 in BJD.
+KEPLER_ZERO = 54833.0
+
+P_ROTS = (0.5, 1.5, 4.0, 10.0)
+S_ROTS = (0.8, 3.0, 7.0)
+AMPS = (0.001, 0.005, 0.02)
+SIGS = (0.001, 0.005, 0.02)
+
+# The injected binary: a 7.07 d orbit with one 0.2 deep eclipse.
+P_ORB = 7.07
+P_WIDTH = 0.02
+P_DEPTH = 0.2
+
+
+def make_grid():
+    """
+    Return the injection grid as a table, one row per light curve.
+    """
+    rows = [(p_rot, s_rot, amp, sig)
+            for p_rot in P_ROTS for s_rot in S_ROTS for amp in AMPS
+            for sig in SIGS]
+
+    return pd.DataFrame(rows, columns=('p_rot', 's_rot', 'amp', 'sig'))
+
+
+def inject_model(grid, length):
+    """
+    Make ModelBinary light curves for the grid. Returns a list of
+    LightCurves.
+    """
+    curves = []
+    for sig, group in grid.groupby('sig'):
+        time, fluxes = ModelBinary.make_fluxes(
+            p_orb=P_ORB, p_depth=P_DEPTH, p_width=P_WIDTH,
+            p_rot=group.p_rot.values, s_rot=group.s_rot.values,
+            p_amp=group.amp.values, s_amp=group.amp.values / 2.0,
+            length=length, sig=sig, sc=False, seed=int(sig * 1e6),
+            dtype=np.float64)
+        err = sig * np.ones_like(time)
+        quarter = np.zeros(time.size, dtype=int)
+
+        # ModelBinary eclipses start at t_0; curve_cut centers its cut on t_0.
+        t_0 = KEPLER_ZERO + P_WIDTH * P_ORB / 2.0
+        for idx, flux in zip(group.index, fluxes):
+            curves.append((idx, LightCurve(time, flux, err, quarter, P_ORB,
+                                           t_0, P_DEPTH, 0.0, P_WIDTH, 0.0,
+                                           0.5, idx)))
+
+    return [curve for idx, curve in sorted(curves)]
+
+
+def inject_bopit(grid, length):
+    """
+    Make BopIt light curves for the grid. Returns a list of LightCurves.
+    """
+    from synthetic import BopIt
+
+    sfsr = 0.1
+    width = 1.2 * sfsr / np.pi
+
+    curves = []
+    for row in grid.itertuples():
+        bop_it = BopIt(sfsr=sfsr, p_orb=P_ORB, csbr=0.8, sine_star=(-1, -2),
+                       sine_params=((KEPLER_ZERO, row.p_rot, row.amp),
+                                    (KEPLER_ZERO, row.s_rot, row.amp / 2.)))
+        phase, time, flux = bop_it.light_it(length=length, sigma=row.sig,
+                                            phase_grid=True)
+        time = time - KEPLER_ZERO
+        curves.append(LightCurve(time, flux, row.sig * np.ones_like(time),
+                                 np.zeros(time.size, dtype=int), P_ORB,
+                                 KEPLER_ZERO, 0.0, 0.0, width, width, 0.5,
+                                 row.Index))
+
+    return curves
+
+
+def git_commit():
+    """
+    Return the short hash of the checked out commit, or 'unknown'.
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short',
+                                        'HEAD'], cwd=ROOT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Injection-recovery benchmark of the rotation period '
+                    'search.')
+    parser.add_argument('--engine', default='gatspy',
+                        help='LightCurve.periodogram engine: gatspy, fft '
+                             'or acf.')
+    parser.add_argument('--source', default='model',
+                        choices=('model', 'bopit'),
+                        help='Injected light curves.')
+    parser.add_argument('--length', type=float, default=90.0,
+                        help='Length of the light curves in days.')
+    parser.add_argument('--tol', type=float, default=0.05,
+                        help='Relative tolerance of a recovered period.')
+    parser.add_argument('--history',
+                        default=os.path.join(ROOT, 'benchmarks',
+                                             'injection_history.csv'),
+                        help='CSV file of earlier runs to append to. '
+                             '(Default: benchmarks/injection_history.csv, '
+                             'ignored by git)')
+    args = parser.parse_args()
+
+    grid = make_grid()
+    stages = {}
+
+    start = timer.time()
+    if args.source == 'model':
+        curves = inject_model(grid, args.length)
+    else:
+        curves = inject_bopit(grid, args.length)
+    stages['inject'] = (timer.time() - start,
+                        sum(curve.time.size for curve in curves))
+
+    start = timer.time()
+    cuts = [curve.curve_cut() for curve in curves]
+    stages['cut'] = (timer.time() - start,
+                     sum(curve.time.size for curve in curves))
+
+    # periodogram cuts the eclipses itself, as in the pipeline; the cut is
+    # a negligible part of this stage.
+    start = timer.time()
+    best = []
+    for curve in curves:
+        period, power, best_period = curve.periodogram(
+            curve.time, curve.flux, curve.err, engine=args.engine)
+        best.append(best_period)
+    stages['periodogram'] = (timer.time() - start,
+                             sum(cut[0].size for cut in cuts))
+
+    grid['best'] = best
+    grid['recovered'] = (np.abs(grid.best / grid.p_rot - 1.0) <
+                         args.tol).astype(float)
+
+    print 'Injected {0:d} {1} light curves of {2:.0f} days; ' \
+        'periodogram engine {3}.\n'.format(len(grid), args.source,
+                                           args.length, args.engine)
+    print '{0:>12s} {1:>9s} {2:>10s} {3:>12s}'.format('stage', 'time (s)',
+                                                       'points', 'points/s')
+    for stage in ('inject', 'cut', 'periodogram'):
+        elapsed, npoints = stages[stage]
+        print '{0:>12s} {1:9.3f} {2:10d} {3:12.0f}'.format(
+            stage, elapsed, npoints, npoints / elapsed)
+
+    print '\nFraction recovered, by amplitude (rows) and noise (columns):'
+    print grid.pivot_table('recovered', 'amp', 'sig').to_string(
+        float_format=lambda x: '{0:.2f}'.format(x))
+    print '\nFraction recovered, by primary rotation period:'
+    print grid.groupby('p_rot').recovered.mean().to_string(
+        float_format=lambda x: '{0:.2f}'.format(x))
+
+    # Add this run to the history, and show the runs with the same setup.
+    run = pd.DataFrame([dict(
+        date=datetime.datetime.now().strftime('%Y-%m-%d %H:%M'),
+        commit=git_commit(), source=args.source, engine=args.engine,
+        length=args.length, ncurves=len(grid),
+        recovered=grid.recovered.mean(),
+        **dict(('{0}_pts_per_s'.format(stage),
+                stages[stage][1] / stages[stage][0]) for stage in stages))])
+    columns = ['date', 'commit', 'source', 'engine', 'length', 'ncurves',
+               'recovered', 'inject_pts_per_s', 'cut_pts_per_s',
+               'periodogram_pts_per_s']
+    run = run[columns]
+
+    if os.path.exists(args.history):
+        history = pd.read_csv(args.history)
+        run = pd.concat([history, run], ignore_index=True)[columns]
+    run.to_csv(args.history, index=False)
+
+    same = (run.source == args.source) & (run.engine == args.engine) & \
+        (run.length == args.length)
+    print '\nHistory ({0}):'.format(args.history)
+    print run[same].tail(10).to_string(
+        index=False, float_format=lambda x: '{0:.3g}'.format(x))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Throughput of BopIt.light_it, before and after batching the JKTEBOP calls.
+
+"loop" is the original implementation, one `getmodel` call per timestamp.
+"batch" is the current `light_it`, one `getmodels` call per light curve.
+Build the JKTEBOP module first with `make` in the jktebop directory.
+
+Usage: python benchmarks/bench_light_it.py
+"""
+import os
+import sys
+import time as timer
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from jktebop import jktebop_f2py
+from jktebop.synthetic import BopIt
+
+
+def loop_light_it(bop_it, length=90.0, sc=False):
+    """
+    The original per-timestamp light_it loop, kept as a reference.
+    """
+    vary = np.zeros(138, dtype=float)
+    ppoly = np.zeros(9)
+
+    if sc:
+        dt = 1.0 / 24.0 / 60.0
+    else:
+        dt = 1.0 / 24.0 / 2.
+
+    time = np.arange(bop_it.params['t_0'], bop_it.params['t_0'] + length + dt,
+                     dt)
+    flux = np.empty_like(time)
+
+    for ii, tt in enumerate(time):
+        mag = jktebop_f2py.getmodel(bop_it.vv, vary, bop_it.ldtype,
+                                    bop_it.nsine, bop_it.psine, 0, ppoly, tt,
+                                    1, 0.0, 0.0, 1, 0)
+        flux[ii] = 10.0 ** (mag / - 2.5)
+
+    return time, flux
+
+
+def best_time(func, repeats=3):
+    """
+    Return the fastest of several wall-clock timings of `func`.
+    """
+    best = np.inf
+    for ii in range(repeats):
+        start = timer.time()
+        func()
+        best = min(best, timer.time() - start)
+
+    return best
+
+
+def main():
+    bop_it = BopIt(sfsr=0.2, p_orb=15.5, csbr=0.8, sine_star=(-1, -2),
+                   sine_params=((54830, 3.71, 0.01), (54831, 1.21, 0.015)))
+
+    print '{0:>8s} {1:>8s} {2:>12s} {3:>12s} {4:>8s}'.format(
+        'cadence', 'points', 'loop (pt/s)', 'batch (pt/s)', 'speedup')
+
+    for sc in (False, True):
+        time, flux = loop_light_it(bop_it, sc=sc)
+        phase, time_b, flux_b = bop_it.light_it(sc=sc)
+        assert np.allclose(flux, flux_b, rtol=0, atol=1e-12)
+
+        t_loop = best_time(lambda: loop_light_it(bop_it, sc=sc))
+        t_batch = best_time(lambda: bop_it.light_it(sc=sc))
+
+        print '{0:>8s} {1:8d} {2:12.0f} {3:12.0f} {4:7.1f}x'.format(
+            'short' if sc else 'long', time.size, time.size / t_loop,
+            time.size / t_batch, t_loop / t_batch)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Time and peak memory of the periodogram engines of LightCurve.periodogram.
+
+"gatspy" is LombScargleFast.periodogram_auto followed by best_period, as
+used by engine='gatspy'. "fft" is periodogram.lomb_scargle, as used by
+engine='fft', on a grid of the same resolution over the same period range.
+The light curves are synthetic multi-quarter Kepler curves with two
+sinusoids; long cadence for up to ~65k points, short cadence beyond. Each
+run happens in a fresh process so that peak memory is measured
+independently.
+
+Usage: python benchmarks/bench_periodogram.py [npoints ...]
+"""
+import os
+import resource
+import subprocess
+import sys
+import time as timer
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from periodogram import lomb_scargle
+
+PERIOD_RANGE = (0.05, 45.0)
+PERIODS = (3.71, 1.21)
+
+
+def make_curve(npoints):
+    """
+    Return a synthetic light curve with `npoints` points.
+    """
+    rng = np.random.RandomState(42)
+    if npoints <= 65000:
+        dt = 1.0 / 48.0
+    else:
+        dt = 1.0 / 1440.0
+    time = 120.0 + dt * np.arange(npoints)
+
+    flux = 1.0 + 1e-4 * rng.randn(npoints)
+    for ii, period in enumerate(PERIODS):
+        flux += 1e-3 / (ii + 1) * np.sin(2 * np.pi * time / period)
+    err = 1e-4 * np.ones(npoints)
+
+    return time, flux, err
+
+
+def run(engine, npoints):
+    """
+    Compute the periodogram and best period of one light curve.
+    """
+    time, flux, err = make_curve(npoints)
+
+    start = timer.time()
+    if engine == 'gatspy':
+        from gatspy.periodic import LombScargleFast
+        model = LombScargleFast(silence_warnings=True).fit(time, flux, err)
+        period, power = model.periodogram_auto(oversampling=5)
+        model.optimizer.period_range = PERIOD_RANGE
+        model.optimizer.quiet = True
+        best = model.best_period
+    else:
+        period, power, peaks = lomb_scargle(time, flux, err,
+                                            pmin=PERIOD_RANGE[0],
+                                            pmax=PERIOD_RANGE[1])
+        best = peaks[0]
+
+    return timer.time() - start, best
+
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == 'child':
+        elapsed, best = run(sys.argv[2], int(sys.argv[3]))
+        rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print elapsed, best, rss_peak / 1024.
+        return
+
+    sizes = [int(arg) for arg in sys.argv[1:]] or [60000, 250000, 1500000]
+
+    print '{0:>8s} {1:>9s} {2:>10s} {3:>12s} {4:>14s}'.format(
+        'engine', 'points', 'time (s)', 'best period', 'peak mem (MB)')
+    for npoints in sizes:
+        for engine in ('gatspy', 'fft'):
+            try:
+                out = subprocess.check_output([sys.executable, __file__,
+                                               'child', engine,
+                                               str(npoints)]).split()
+            except subprocess.CalledProcessError:
+                # gatspy runs out of memory on the largest curves.
+                print '{0:>8s} {1:9d} {2:>10s}'.format(engine, npoints,
+                                                       'failed')
+                continue
+            print '{0:>8s} {1:9d} {2:10.2f} {3:12.5f} {4:14.1f}'.format(
+                engine, npoints, float(out[0]), float(out[1]),
+                float(out[2]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Cost of exposure-time supersampling in BopIt.light_it.
+
+"light_it" is `light_it(supersample=N)` on a 90 day long cadence curve,
+which evaluates all N sub-exposures in one JKTEBOP call and averages them
+in flux. "num_int" is JKTEBOP's own integration (`get_mags` with
+`num_int=N`), which averages in magnitudes; "max diff" is the largest
+difference between the two in relative flux. The cost of light_it should
+grow as N times the N = 1 cost. Build the JKTEBOP module first with `make`
+in the jktebop directory.
+
+Usage: python benchmarks/bench_supersample.py [N ...]
+"""
+import os
+import sys
+import time as timer
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from jktebop.synthetic import BopIt
+
+
+def best_time(func, repeats=3):
+    """
+    Return the fastest of several wall-clock timings of `func`.
+    """
+    best = np.inf
+    for ii in range(repeats):
+        start = timer.time()
+        func()
+        best = min(best, timer.time() - start)
+
+    return best
+
+
+def main():
+    nsubs = [int(arg) for arg in sys.argv[1:]] or [1, 5, 15, 30]
+
+    # A short period, deep EB, where smearing over 30 min. matters.
+    bop_it = BopIt(sfsr=0.3, p_orb=1.5, csbr=0.8, sine_star=(-1,),
+                   sine_params=((54830, 3.71, 0.01),))
+    exptime = 30.0 * 60.0
+
+    print '{0:>4s} {1:>13s} {2:>10s} {3:>12s} {4:>10s}'.format(
+        'N', 'light_it (s)', 'x N=1', 'num_int (s)', 'max diff')
+
+    t_one = None
+    for nsub in nsubs:
+        phase, time, flux = bop_it.light_it(supersample=nsub)
+        mag_flux = 10.0 ** (bop_it.get_mags(time, nsub, exptime) / -2.5)
+
+        t_light = best_time(lambda: bop_it.light_it(supersample=nsub))
+        t_numint = best_time(lambda: bop_it.get_mags(time, nsub, exptime))
+        if t_one is None:
+            t_one = t_light / nsub
+
+        print '{0:4d} {1:13.3f} {2:10.1f} {3:12.3f} {4:10.2e}'.format(
+            nsub, t_light, t_light / t_one, t_numint,
+            np.abs(flux - mag_flux).max())
+
+
+if __name__ == '__main__':
+    main()
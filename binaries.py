@@ -1,6 +1,7 @@
 import numpy as np
 
 from lightcurve import LightCurve
+from catalog import Catalog
 import data
 import binaries
 import matplotlib.pyplot as plt
@@ -27,6 +28,11 @@ class ModelBinary(LightCurve):
     sc : bool
         Default is for short cadence. Set to False for long cadence.
     """
+    __slots__ = ()
+
+    # Time arrays shared by all model light curves, keyed by (length, sc).
+    _times = {}
+
     def __init__(self, p_orb=7.07, t_0=0.0, p_depth=0.23, s_depth=0.17,
                  p_width=0.02, s_width=0.02, p_rot=1.51, s_rot=0.80,
                  p_amp=0.03, s_amp=0.02, length=100.0, sig=0.02, sc=True):
@@ -37,70 +43,238 @@ class ModelBinary(LightCurve):
 
         super(ModelBinary, self).__init__(time, flux, err, None, p_orb, t_0,
                                           p_depth, s_depth, p_width, s_width,
-                                          -999)
+                                          -999, None)
 
-    # TODO: Light curve model should account for both primary and secondary
-    # eclipse properties.
     @staticmethod
-    def _make_lc(p_orb, t_0, e_dur, depth, p_rot1, p_rot2, amp_1, amp_2,
-                 length, sig, sc):
+    def _exptime(sc):
         """
-        Make a light curve.
+        Return the exposure time in days.
         """
         # One minute exposure time for short cadence, 30 minute for long.
         if sc:
-            exptime = 1.0 / 60.0 / 24.0
+            return 1.0 / 60.0 / 24.0
         else:
-            exptime = 30.0 / 60.0 / 24.0
-        time = np.arange(0, length, exptime)
+            return 30.0 / 60.0 / 24.0
+
+    @classmethod
+    def time_grid(cls, length, sc):
+        """
+        Return the read-only time array shared by all light curves with the
+        same length and cadence.
+        """
+        key = (float(length), bool(sc))
+        if key not in cls._times:
+            time = np.arange(0, length, cls._exptime(sc))
+            time.flags.writeable = False
+            cls._times[key] = time
 
-        # Make the starspot signals.
-        f_1 = -amp_1 * np.sin(time * (2 * np.pi) / p_rot1)
-        f_2 = -amp_2 * np.sin(time * (2 * np.pi) / p_rot2)
+        return cls._times[key]
+
+    # TODO: Light curve model should account for both primary and secondary
+    # eclipse properties.
+    @classmethod
+    def _make_lc(cls, p_orb, t_0, e_dur, depth, p_rot1, p_rot2, amp_1, amp_2,
+                 length, sig, sc):
+        """
+        Make a light curve.
+        """
+        time = cls.time_grid(length, sc)
 
-        # Make the eclipse signal as a step function.
-        in_e = np.where((((time - t_0) % p_orb) / p_orb < (e_dur / p_orb)))
-        f_e = np.zeros_like(time)
-        f_e[in_e] = -depth
+        # Make the eclipse and starspot signals.
+        flux = np.ones((1, time.size))
+        params = [np.array([param], dtype=float)
+                  for param in (p_orb, t_0, e_dur, depth, p_rot1, p_rot2,
+                                amp_1, amp_2)]
+        cls._add_signals(flux, time, cls._exptime(sc), *params)
 
         # Make random noise.
         noise = np.random.random(len(time)) * sig
 
         # Add signals together.
-        flux = 1 + f_e + f_1 + f_2 + noise
+        flux = flux[0] + noise
 
         return time, flux, noise
 
+    @staticmethod
+    def _add_eclipses(flux, time, p_orb, t_0, e_dur, depth):
+        """
+        Subtract box-shaped eclipses from light curves, one row per curve.
+
+        Only the points in eclipse are touched: the eclipses of all rows
+        are listed, and located in `time` by bisection.
+        """
+        nrows = flux.shape[0]
+        e_dur = np.minimum(e_dur, p_orb)
+
+        # Every cycle that overlaps the time span, of every row.
+        first = np.floor((time[0] - t_0) / p_orb)
+        count = (np.floor((time[-1] - t_0) / p_orb) - first + 1).astype(int)
+        row = np.repeat(np.arange(nrows), count)
+        cycle = first[row] + np.arange(row.size) - \
+            np.repeat(np.cumsum(count) - count, count)
+
+        start = t_0[row] + cycle * p_orb[row]
+        lo = np.searchsorted(time, start)
+        npts = np.searchsorted(time, start + e_dur[row]) - lo
+
+        # Every point in eclipse, of every row.
+        col = np.arange(npts.sum()) + np.repeat(lo - (np.cumsum(npts) - npts),
+                                                npts)
+        row = np.repeat(row, npts)
+        flux[row, col] -= depth[row]
+
+    @staticmethod
+    def _add_sine(flux, dt, period, amp, block=64):
+        """
+        Subtract amp * sin(2 pi t / period) from light curves, one row per
+        curve, where t = 0, dt, 2 dt, ...
+
+        The time steps are split into blocks, and sin(a + b) is expanded
+        as sin(a) cos(b) + cos(a) sin(b) with a the start of each block, so
+        only about len(t) / block + block sines are evaluated per row.
+        """
+        nrows, size = flux.shape
+        nblocks = -(-size // block)
+        omega = 2 * np.pi * dt / period[:, np.newaxis]
+
+        coarse = omega * block * np.arange(nblocks)
+        fine = omega * np.arange(block)
+        amp = amp[:, np.newaxis]
+
+        sin_a = (amp * np.sin(coarse)).astype(flux.dtype)[:, :, np.newaxis]
+        cos_a = (amp * np.cos(coarse)).astype(flux.dtype)[:, :, np.newaxis]
+        sin_b = np.sin(fine).astype(flux.dtype)[:, np.newaxis, :]
+        cos_b = np.cos(fine).astype(flux.dtype)[:, np.newaxis, :]
+
+        signal = sin_a * cos_b
+        signal += cos_a * sin_b
+        flux -= signal.reshape(nrows, -1)[:, :size]
+
+    @classmethod
+    def _add_signals(cls, flux, time, dt, p_orb, t_0, e_dur, depth, p_rot1,
+                     p_rot2, amp_1, amp_2, rows=32):
+        """
+        Subtract the eclipse and starspot signals of many light curves from
+        `flux`, one row per curve, `rows` curves at a time so that the
+        temporary arrays stay in cache.
+        """
+        cls._add_eclipses(flux, time, p_orb, t_0, e_dur, depth)
+        for start in range(0, flux.shape[0], rows):
+            block = slice(start, start + rows)
+            cls._add_sine(flux[block], dt, p_rot1[block], amp_1[block])
+            cls._add_sine(flux[block], dt, p_rot2[block], amp_2[block])
+
+    @classmethod
+    def make_fluxes(cls, p_orb=7.07, t_0=0.0, p_depth=0.23, p_width=0.02,
+                    p_rot=1.51, s_rot=0.80, p_amp=0.03, s_amp=0.02,
+                    length=100.0, sig=0.02, sc=True, chunksize=None, seed=0,
+                    dtype=np.float32):
+        """
+        Make the light curves of a population of model binaries at once.
+
+        The parameters are those of ModelBinary, given as arrays with one
+        entry per system (scalars apply to all systems). All light curves
+        share a single time array. The noise of each chunk of `chunksize`
+        systems is drawn from its own random state, seeded with
+        (seed, chunk number), so chunks can be made in any order or in
+        parallel with the same results. The noise is uniform between 0 and
+        `sig`, as in ModelBinary, in steps of sig / 2**16.
+
+        Parameters
+        ----------
+        chunksize : int, optional
+            If given, return a generator of (start, flux) chunks of up to
+            `chunksize` systems instead of one array, where start is the
+            index of the first system in the chunk. (Default: None)
+        seed : int, optional
+            Seed of the noise. (Default: 0)
+        dtype : numpy dtype, optional
+            Type of the fluxes. (Default: numpy.float32)
+
+        Returns
+        -------
+        time : ndarray
+            The shared, read-only observation times.
+        flux : ndarray or generator
+            Fluxes with shape (N, len(time)), or a generator of chunks.
+
+        Examples
+        --------
+        Make 10^5 long cadence light curves, 10^4 at a time.
+
+        >>> time, chunks = ModelBinary.make_fluxes(
+        >>>     p_orb=np.random.uniform(1, 20, 100000), sc=False,
+        >>>     chunksize=10000)
+        >>> for start, flux in chunks:
+        >>>     ...
+
+        """
+        time = cls.time_grid(length, sc)
+        dt = cls._exptime(sc)
+        params = np.broadcast_arrays(
+            *[np.atleast_1d(np.asarray(param, dtype=float))
+              for param in (p_orb, t_0, p_width, p_depth, p_rot, s_rot,
+                            p_amp, s_amp)])
+        nsys = params[0].size
+        size = chunksize or nsys
+
+        def chunk(start):
+            p_orb, t_0, p_width, p_depth, p_rot, s_rot, p_amp, s_amp = \
+                [param[start:start + size] for param in params]
+
+            # Noise as in _make_lc, from the random state of this chunk.
+            rng = np.random.RandomState([seed, start // size])
+            flux = np.empty((p_orb.size, time.size), dtype=dtype)
+            for row in range(0, p_orb.size, 32):
+                block = flux[row:row + 32]
+                block[:] = rng.randint(0, 2 ** 16, block.shape,
+                                       dtype=np.uint16)
+                block *= sig / 2.0 ** 16
+                block += 1 + 0.5 * sig / 2.0 ** 16
+
+            cls._add_signals(flux, time, dt, p_orb, t_0, p_width * p_orb,
+                             p_depth, p_rot, s_rot, p_amp, s_amp)
+
+            return flux
+
+        if chunksize is None:
+            return time, chunk(0)
+
+        return time, ((start, chunk(start))
+                      for start in range(0, nsys, chunksize))
+
 class RealBinary(LightCurve):
     """ 
     It's an eclipsing binary from Kepler's data
+
+    Parameters
+    ----------
+    kic : int
+        Kepler Input Catalog (KIC) ID number.
+    cache : bool or data.LCCache, optional
+        Light curve cache passed on to data.loadlc_db. (Default: True)
+    source : string, optional
+        Light curve source passed on to data.loadlc_db, e.g. 'fits' to read
+        local MAST files offline. (Default: $TRICYCLE_SOURCE, or 'db')
+    catfile : string, optional
+        Catalog of the system parameters. (Default: villanova-db.csv)
+    dtype, time_dtype : numpy dtype, optional
+        Storage types of the light curve; see LightCurve. For many targets
+        in memory at once, use numpy.float32 for both.
+    **kwargs
+        Passed on to data.loadlc_db, e.g. quality_mask and sigma_clip.
     """
-    def __init__(self,kic):
-        #This calls the data file
-        catfile='villanova-db.csv'
-        df = pd.read_csv(catfile)
-    
-        #Calls the row and stores it into a new data file that only has the row's information
-        dfnew = df[df['KIC']==kic]
-        #We need dfnew to be greater than zero
-        #Calls each individual componet from the row
-        if len(dfnew) ==0:
-            print "no"
-        else:
-            print 'yasss'
-        
-        kicval=dfnew.KIC.values[0]
-        KOI=dfnew.KOI.values[0]
-        mult=dfnew.Mult.values[0]
-        period=dfnew.period.values[0]
-        swidth=dfnew.swidth.values[0]
-        bjd0= dfnew.bjd0.values[0]
-        pwidth=dfnew.pwidth.values[0]
-        pdepth=dfnew.pdepth.values[0]
-        sdepth=dfnew.sdepth.values[0]
-        sep=dfnew.sep.values[0]
-        time, flux, fluxerr, cadence, quarter, quality = data.loadlc_db(kic)
-        super(RealBinary, self).__init__(time, flux, fluxerr, quarter, period,
-                                         bjd0, pdepth, sdepth, pwidth, swidth,
-                                         sep, kic)
-        
+    __slots__ = ()
+
+    def __init__(self, kic, cache=True, dtype=None, time_dtype=None,
+                 source=None, catfile='villanova-db.csv', **kwargs):
+        # Look up the system in the (shared) Villanova catalog.
+        row = Catalog.load(catfile).row(kic)
+
+        time, flux, fluxerr, cadence, quarter, quality = \
+            data.loadlc_db(kic, cache=cache, source=source, **kwargs)
+        super(RealBinary, self).__init__(time, flux, fluxerr, quarter,
+                                         row.period, row.bjd0, row.pdepth,
+                                         row.sdepth, row.pwidth, row.swidth,
+                                         row.sep, kic, dtype=dtype,
+                                         time_dtype=time_dtype)
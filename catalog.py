@@ -0,0 +1,154 @@
+from collections import OrderedDict
+import os
+
+import numpy as np
+import pandas as pd
+
+# Columns of the Villanova catalog and their types. Missing values are
+# given as -999 (or -1 for KOI), so the physical quantities are floats.
+_COLUMNS = OrderedDict([('KIC', np.int64),
+                        ('KOI', np.int32),
+                        ('Mult', np.int32),
+                        ('period', np.float64),
+                        ('period_err', np.float64),
+                        ('bjd0', np.float64),
+                        ('bjd0_err', np.float64),
+                        ('pdepth', np.float64),
+                        ('sdepth', np.float64),
+                        ('pwidth', np.float64),
+                        ('swidth', np.float64),
+                        ('sep', np.float64),
+                        ('morph', np.float64),
+                        ('T2/T1', np.float64),
+                        ('rho1+rho2', np.float64),
+                        ('q', np.float64),
+                        ('e_sin_omega', np.float64),
+                        ('e_cos_omega', np.float64),
+                        ('FF', np.float64),
+                        ('sin_i', np.float64),
+                        ('RA', np.float64),
+                        ('DEC', np.float64),
+                        ('GLon', np.float64),
+                        ('GLat', np.float64),
+                        ('kmag', np.float64),
+                        ('Teff', np.float64),
+                        ('Teff(Pinsonneault)', np.float64),
+                        ('Teff(Casagrande)', np.float64),
+                        ('SC', np.bool_)])
+
+
+class Catalog(object):
+    """
+    The Villanova Kepler eclipsing binary catalog, held in memory.
+
+    The catalog is parsed once with explicit column types. Rows are indexed
+    by KIC ID for constant time lookup, and the orbital periods are kept
+    sorted for range queries. Use `Catalog.load` to share a single instance
+    per catalog file within a process.
+
+    Parameters
+    ----------
+    catfile : string, optional
+        Name of catalog file. (Default: villanova-db.csv)
+    sidecar : bool, optional
+        If True, keep a binary copy of the parsed catalog in a .npy file next
+        to `catfile`, and read that instead of the CSV while it is newer than
+        the CSV. (Default: False)
+
+    Attributes
+    ----------
+    df : pandas.DataFrame
+        The full catalog.
+    records : numpy.recarray
+        The same catalog as a record array, for fast row access.
+
+    """
+    _instances = {}
+
+    def __init__(self, catfile='villanova-db.csv', sidecar=False):
+        self.catfile = catfile
+        npyfile = os.path.splitext(catfile)[0] + '.npy'
+
+        if sidecar and os.path.exists(npyfile) and \
+                os.path.getmtime(npyfile) >= os.path.getmtime(catfile):
+            self.records = np.load(npyfile).view(np.recarray)
+        else:
+            df = pd.read_csv(catfile, comment='#', usecols=list(_COLUMNS),
+                             dtype=_COLUMNS)
+            self.records = df[list(_COLUMNS)].to_records(index=False)
+            if sidecar:
+                np.save(npyfile, self.records.view(np.ndarray))
+
+        self.df = pd.DataFrame(self.records)
+
+        # Row of each KIC ID. Some systems have more than one entry; the
+        # first one is used.
+        kics = self.records['KIC']
+        self._index = dict(zip(kics[::-1], np.arange(kics.size)[::-1]))
+
+        # Periods in ascending order, and the rows they belong to.
+        self._period_rows = np.argsort(self.records['period'],
+                                       kind='mergesort')
+        self._periods = self.records['period'][self._period_rows]
+
+    @classmethod
+    def load(cls, catfile='villanova-db.csv', sidecar=False):
+        """
+        Return the catalog for `catfile`, parsing it on the first call only.
+        """
+        key = os.path.abspath(catfile)
+        if key not in cls._instances:
+            cls._instances[key] = cls(catfile, sidecar=sidecar)
+
+        return cls._instances[key]
+
+    def __len__(self):
+        return self.records.size
+
+    def __contains__(self, kic):
+        return int(kic) in self._index
+
+    def row(self, kic):
+        """
+        Return the catalog entry of a system.
+
+        Parameters
+        ----------
+        kic : int
+            Kepler Input Catalog (KIC) ID number.
+
+        Returns
+        -------
+        row : numpy.record
+            Catalog columns as attributes, e.g. row.period.
+
+        """
+        try:
+            return self.records[self._index[int(kic)]]
+        except KeyError:
+            raise KeyError('KIC {0:d} is not in the catalog.'.format(int(kic)))
+
+    def period_range(self, pmin=0.0, pmax=None):
+        """
+        Return the rows with pmin < period < pmax, in catalog order.
+
+        Parameters
+        ----------
+        pmin : float, optional
+            Minimum orbital period in days. (Default: 0.0)
+        pmax : float, optional
+            Maximum orbital period in days.
+
+        Returns
+        -------
+        rows : ndarray
+            Indices of the matching rows.
+
+        """
+        start = np.searchsorted(self._periods, pmin, side='right')
+        if pmax:
+            stop = np.searchsorted(self._periods, pmax, side='left')
+        else:
+            stop = self._periods.size
+
+        return np.sort(self._period_rows[start:stop])
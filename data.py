@@ -1,7 +1,19 @@
+import glob
+import os
+import shutil
+import socket
+import sys
+import tempfile
+
 import pandas as pd
 import numpy as np
-import MySQLdb
-import socket
+try:
+    import MySQLdb
+except ImportError:
+    # Only needed on the UW network; see loadlc_db.
+    MySQLdb = None
+
+from catalog import Catalog
 
 
 def select_kics(catfile='villanova-db.csv', pmin=0.0, pmax=None):
@@ -23,14 +35,9 @@ def select_kics(catfile='villanova-db.csv', pmin=0.0, pmax=None):
         KIC IDs matching search criteria.
 
     """
-    # Construct the query string.
-    qstring = 'period > %s & ' % str(pmin)
-    if pmax:
-        qstring += 'period < %s & ' % str(pmax)
-
     # Load the Villanova catalog, find the matching KIC IDs.
-    df = pd.read_csv(catfile)
-    kics = df.query(qstring[:-2])['KIC'].values.astype(int).astype(str)
+    cat = Catalog.load(catfile)
+    kics = cat.records['KIC'][cat.period_range(pmin, pmax)]
 
     print 'Found %d systems in catalog meeting criteria.' % kics.size
     return kics.astype(int)
@@ -62,12 +69,713 @@ def __dbconnect(host='tddb.astro.washington.edu', user='tddb', password='tddb',
                            connect_timeout=0)
 
 
-def loadlc_db(kic, usepdc=True, lc=True, **kwargs):
+def _require_mysqldb():
+    """
+    Raise ImportError if MySQLdb, needed for source='db' on the UW network,
+    is not installed.
+    """
+    if MySQLdb is None:
+        raise ImportError("MySQLdb is needed for source='db' on the UW "
+                          "network; install MySQL-python or use "
+                          "source='fits'.")
+
+
+# Open database connections and SSH sessions, reused between queries.
+_db_pool = {}
+_ssh_pool = {}
+
+
+def _pooled_dbconnect(**kwargs):
+    """
+    Return a database connection, reusing an open one when possible.
+
+    Takes the same keyword arguments as __dbconnect.
+
+    """
+    _require_mysqldb()
+    key = tuple(sorted(kwargs.items()))
+    db = _db_pool.get(key)
+    if db is not None:
+        try:
+            db.ping()
+        except MySQLdb.Error:
+            db = None
+
+    if db is None:
+        db = __dbconnect(**kwargs)
+        _db_pool[key] = db
+
+    return db
+
+
+def _drop_dbconnect(**kwargs):
+    """
+    Close and forget a pooled database connection, e.g. after an error.
+    """
+    db = _db_pool.pop(tuple(sorted(kwargs.items())), None)
+    if db is not None:
+        try:
+            db.close()
+        except MySQLdb.Error:
+            pass
+
+
+def _ssh_query(toex):
+    """
+    Run a query with the mysql client on hail, over a reused SSH session.
+
+    Returns a file-like object streaming the result as tab separated text,
+    starting with a header line.
+
+    """
+    import paramiko
+
+    ssh = _ssh_pool.get('hail')
+    if ssh is None or ssh.get_transport() is None or \
+            not ssh.get_transport().is_active():
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        # no password because my SSH keygen doesn't have a password
+        ssh.connect('hail.astro.washington.edu', username='eakruse')
+        _ssh_pool['hail'] = ssh
+
+    stdin, stdout, stderr = ssh.exec_command(
+        'mysql -h tddb.astro.washington.edu -D Kepler -u eakruse '
+        '--password=tddbKepler -e "{0}"'.format(toex))
+
+    return stdout
+
+
+def _placeholder(db):
+    """
+    Return the query parameter marker used by a DB-API connection.
+    """
+    module = sys.modules.get(type(db).__module__.split('.')[0])
+    if getattr(module, 'paramstyle', 'format') == 'qmark':
+        return '?'
+    else:
+        return '%s'
+
+
+def _lc_query(where, usepdc, lc, kic_column=False):
+    """
+    Build the SQL query for light curve rows matching `where`.
+    """
+    tablename = 'source'
+    if lc:
+        lcflag = "LCFLAG > 0"
+    else:
+        lcflag = "LCFLAG = 0"
+
+    if usepdc:
+        fluxstr = "pdcsap_flux, pdcsap_flux_err "
+    else:
+        fluxstr = "sap_flux, sap_flux_err "
+
+    if kic_column:
+        fluxstr = "keplerid, " + fluxstr
+
+    return "SELECT cadenceno, quarter, sap_quality, time, {0} FROM {2} " \
+           "WHERE {3} AND {1};".format(fluxstr, lcflag, tablename, where)
+
+
+# Kepler quality flags of cadences that are unusable for photometry:
+# attitude tweak (1), safe mode (2), coarse point (4), Earth point (8),
+# reaction wheel desaturation (32) and manual exclude (128). See the Kepler
+# Archive Manual.
+QUALITY_BITMASK = 1 | 2 | 4 | 8 | 32 | 128
+
+# Columns of the light curve queries, in order.
+_LC_DTYPE = np.dtype([('cadence', np.int32), ('quarter', np.int32),
+                      ('quality', np.int32), ('time', np.float64),
+                      ('flux', np.float32), ('fluxerr', np.float32)])
+_MANY_DTYPE = np.dtype([('cadence', np.int32), ('quarter', np.int32),
+                        ('quality', np.int32), ('time', np.float64),
+                        ('kic', np.int64), ('flux', np.float32),
+                        ('fluxerr', np.float32)])
+
+
+def _stream_cursor(db):
+    """
+    Open a cursor that streams rows from the server as they are fetched,
+    rather than buffering the whole result set on the client.
+    """
+    if MySQLdb is not None and type(db).__module__.startswith('MySQLdb'):
+        from MySQLdb.cursors import SSCursor
+        return db.cursor(SSCursor)
+    else:
+        return db.cursor()
+
+
+def _fill_rows(chunks, dtype, size=65536):
+    """
+    Copy chunks of rows into a single preallocated structured array.
+
+    Parameters
+    ----------
+    chunks : iterable
+        Yields sequences of row tuples, or record arrays, in column order.
+    dtype : numpy.dtype
+        Structured dtype of the rows.
+    size : int, optional
+        Initial number of rows to allocate. Doubled whenever it runs out.
+
+    Returns
+    -------
+    rows : ndarray
+        Structured array of all the rows.
+
+    """
+    rows = np.empty(size, dtype=dtype)
+    nrows = 0
+    for chunk in chunks:
+        nnew = len(chunk)
+        if nrows + nnew > rows.size:
+            grown = np.empty(max(2 * rows.size, nrows + nnew), dtype=dtype)
+            grown[:nrows] = rows[:nrows]
+            rows = grown
+
+        rows[nrows:nrows + nnew] = chunk
+        nrows += nnew
+
+    return rows[:nrows]
+
+
+def _read_rows(cursor, dtype, size=65536):
+    """
+    Decode the result set of an executed cursor into a structured array,
+    `size` rows at a time, so that only one chunk of Python row tuples
+    exists at any moment.
+    """
+    def chunks():
+        while True:
+            chunk = cursor.fetchmany(size)
+            if not chunk:
+                break
+            yield chunk
+
+    rows = _fill_rows(chunks(), dtype, size=size)
+    cursor.close()
+
+    return rows
+
+
+def _read_text_rows(stream, dtype, size=65536):
+    """
+    Decode tab separated mysql client output into a structured array,
+    `size` lines at a time, with the pandas C parser.
+    """
+    reader = pd.read_csv(stream, sep='\t', header=0, names=dtype.names,
+                         dtype=dict((name, dtype[name]) for name in
+                                    dtype.names),
+                         na_values=['NULL'], chunksize=size)
+
+    return _fill_rows((df.to_records(index=False) for df in reader), dtype,
+                      size=size)
+
+
+def _segment_medians(values, starts):
+    """
+    Medians of the consecutive segments of `values` that begin at `starts`,
+    from a single sort of the values within segments.
+    """
+    counts = np.diff(np.append(starts, values.size))
+    segment = np.repeat(np.arange(starts.size), counts)
+    ordered = values[np.lexsort((values, segment))]
+
+    return 0.5 * (ordered[starts + (counts - 1) // 2] +
+                  ordered[starts + counts // 2])
+
+
+def normalize_lc(time, flux, fluxerr, cadence, quarter, quality,
+                 quality_mask=0, sigma_clip=None):
     """
-    Load Kepler data from the local tddb database. Written by Ethan Kruse.
+    Filter a light curve and normalize the fluxes of each quarter.
+
+    Points with a NaN time, flux or error, or with any of the bits of
+    `quality_mask` set in `quality`, are dropped, as are outliers if
+    `sigma_clip` is given. The rest are put in order of (quarter, time)
+    with one stable sort, which is combined with the filtering so that
+    each array is copied once. Fluxes and errors are then divided by the
+    median flux of their quarter, in place. Normalizing is idempotent, so
+    this works on raw database rows, on cached light curves and on light
+    curves loaded from elsewhere.
+
+    Parameters
+    ----------
+    time, flux, fluxerr, cadence, quarter, quality : array_like
+        The light curve, as returned by loadlc_db.
+    quality_mask : int, optional
+        Drop points with any of these quality flag bits set, e.g.
+        QUALITY_BITMASK. (Default: 0, keep all)
+    sigma_clip : float, optional
+        Drop points more than this many standard deviations from the median
+        of their quarter, with the standard deviation estimated from the
+        median absolute deviation, or taken as the median error where that
+        is zero. (Default: no clipping)
+
+    Returns
+    -------
+    time, flux, fluxerr, cadence, quarter, quality : ndarray
+        The filtered, ordered and normalized light curve.
+
+    """
+    arrays = [np.asarray(array) for array in (time, flux, fluxerr, cadence,
+                                              quarter, quality)]
+    time, flux, fluxerr, cadence, quarter, quality = arrays
+
+    good = np.isfinite(time) & np.isfinite(flux) & np.isfinite(fluxerr)
+    if quality_mask:
+        good &= (quality.astype(np.int64, copy=False) & quality_mask) == 0
+    index = np.flatnonzero(good)
+    index = index[np.lexsort((time[index], quarter[index]))]
+
+    flux = flux[index]
+    quarter = quarter[index]
+    starts = np.flatnonzero(np.append(True, quarter[1:] != quarter[:-1]))
+    if index.size == 0:
+        starts = starts[:0]
+    medians = _segment_medians(flux, starts)
+
+    if sigma_clip is not None and index.size:
+        counts = np.diff(np.append(starts, index.size))
+        resid = np.abs(flux - np.repeat(medians, counts))
+        sigma = 1.4826 * _segment_medians(resid, starts)
+
+        # Flat or quantized quarters have no spread about their median;
+        # clip them on their median error instead, if they have one.
+        flat = sigma == 0
+        if flat.any():
+            errs = _segment_medians(np.abs(fluxerr[index]), starts)
+            sigma[flat] = np.where(errs[flat] > 0, errs[flat], np.inf)
+        keep = resid <= sigma_clip * np.repeat(sigma, counts)
+
+        if not keep.all():
+            index, flux, quarter = index[keep], flux[keep], quarter[keep]
+            counts = np.bincount(np.repeat(np.arange(starts.size), counts),
+                                 weights=keep, minlength=starts.size)
+            counts = counts.astype(int)
+            medians = medians[counts > 0]
+            counts = counts[counts > 0]
+            starts = np.cumsum(counts) - counts
+
+    time, fluxerr, cadence, quality = [array[index] for array in
+                                       (time, fluxerr, cadence, quality)]
+
+    # Go from raw CCD counts to normalized fluxes per quarter.
+    scale = np.repeat(medians, np.diff(np.append(starts, index.size)))
+    flux /= scale
+    fluxerr /= scale
+
+    return time, flux, fluxerr, cadence, quarter, quality
+
+
+def _filter_lc(arrays, quality_mask=0, sigma_clip=None):
+    """
+    Apply `quality_mask` and `sigma_clip` to a light curve already passed
+    through normalize_lc. Without either, the arrays are returned as they
+    are, so that memory-mapped cache entries are not copied.
+    """
+    if not quality_mask and sigma_clip is None:
+        return tuple(arrays)
+
+    return normalize_lc(*arrays, quality_mask=quality_mask,
+                        sigma_clip=sigma_clip)
+
+
+class LCCache(object):
+    """
+    Persistent on-disk cache of Kepler light curves.
+
+    Each light curve is stored as a directory of .npy files, one per column,
+    so that it can be memory-mapped when loaded. Light curves are stored
+    already ordered and normalized by normalize_lc, without any quality
+    mask or clipping, so an unfiltered load needs no further work. Once the
+    cache grows beyond `max_bytes`, the least recently used light curves
+    are evicted.
+
+    Parameters
+    ----------
+    cache_dir : string, optional
+        Directory holding the cache. (Default: $TRICYCLE_CACHE if set,
+        otherwise ~/.tricycle/lc_cache)
+    max_bytes : int, optional
+        Maximum total size of the cache in bytes. (Default: 2 GB)
+
+    """
+    columns = ('time', 'flux', 'fluxerr', 'cadence', 'quarter', 'quality')
+
+    # Bump whenever the meaning of the stored arrays changes; a cache
+    # written with another version is cleared on first use.
+    version = 3
+
+    def __init__(self, cache_dir=None, max_bytes=2 * 1024 ** 3):
+        if cache_dir is None:
+            cache_dir = os.environ.get(
+                'TRICYCLE_CACHE',
+                os.path.join(os.path.expanduser('~'), '.tricycle',
+                             'lc_cache'))
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._checked = False
+
+    def _check_version(self):
+        """
+        Clear the cache if it was written with a different version.
+        """
+        if self._checked:
+            return
+
+        path = os.path.join(self.cache_dir, 'VERSION')
+        try:
+            with open(path) as fobj:
+                found = fobj.read().strip()
+        except IOError:
+            found = None
+
+        if found != str(self.version):
+            # Entry names may differ between versions, so drop every entry
+            # directory rather than those that entries() recognizes.
+            if os.path.isdir(self.cache_dir):
+                for name in os.listdir(self.cache_dir):
+                    if name[:1].isdigit() or name.startswith('.tmp'):
+                        shutil.rmtree(os.path.join(self.cache_dir, name),
+                                      ignore_errors=True)
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            with open(path, 'w') as fobj:
+                fobj.write('{0}\n'.format(self.version))
+
+        self._checked = True
+
+    def _path(self, kic, usepdc, lc, source):
+        """
+        Return the directory of the cached light curve for a key.
+        """
+        name = '{0:09d}_{1}_{2}_{3}'.format(int(kic),
+                                            'pdc' if usepdc else 'sap',
+                                            'lc' if lc else 'sc', source)
+        return os.path.join(self.cache_dir, name)
+
+    def entries(self):
+        """
+        List the cached light curves.
+
+        Returns
+        -------
+        entries : list of tuples
+            (path, kic, usepdc, lc, source, size in bytes, last access
+            time) for each cached light curve.
+
+        """
+        if not os.path.isdir(self.cache_dir):
+            return []
+
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            fields = name.split('_', 3)
+            if len(fields) != 4 or not fields[0].isdigit():
+                continue
+
+            path = os.path.join(self.cache_dir, name)
+            size = sum(os.path.getsize(os.path.join(path, ff))
+                       for ff in os.listdir(path))
+            entries.append((path, int(fields[0]), fields[1] == 'pdc',
+                            fields[2] == 'lc', fields[3], size,
+                            os.path.getmtime(path)))
+
+        return entries
+
+    def size(self):
+        """
+        Return the total size of the cache in bytes.
+        """
+        return sum(entry[5] for entry in self.entries())
+
+    def load(self, kic, usepdc=True, lc=True, source='db'):
+        """
+        Load a light curve from the cache.
+
+        The arrays are memory-mapped copy-on-write, so loading is nearly free
+        and modifying them never alters the cache. Light curves are cached
+        separately for each source, so that e.g. a partial set of local
+        FITS files never stands in for the database.
+
+        Returns
+        -------
+        arrays : tuple of ndarrays or None
+            (time, flux, fluxerr, cadence, quarter, quality), or None if the
+            light curve is not in the cache.
+
+        """
+        self._check_version()
+        path = self._path(kic, usepdc, lc, source)
+        if not os.path.isdir(path):
+            return None
+
+        try:
+            arrays = tuple(np.load(os.path.join(path, column + '.npy'),
+                                   mmap_mode='c')
+                           for column in self.columns)
+        except (IOError, ValueError):
+            # A damaged entry; drop it and fall back to the database.
+            shutil.rmtree(path, ignore_errors=True)
+            return None
+
+        # Mark as recently used for eviction.
+        os.utime(path, None)
+
+        return arrays
+
+    def store(self, kic, usepdc, lc, arrays, source='db'):
+        """
+        Add a light curve to the cache, then evict old entries if needed.
+
+        Parameters
+        ----------
+        kic : int
+            Kepler Input Catalog number for the target.
+        usepdc : bool
+            Whether the fluxes are PDCSAP or raw SAP.
+        lc : bool
+            Whether the data are long or short cadence.
+        arrays : sequence of ndarrays
+            (time, flux, fluxerr, cadence, quarter, quality), as returned
+            by normalize_lc without a quality mask or clipping.
+        source : string, optional
+            Name of the source the light curve was read from; see
+            loadlc_db. (Default: 'db')
+
+        """
+        self._check_version()
+
+        # Write to a scratch directory first so that readers never see a
+        # partially written entry.
+        tmp = tempfile.mkdtemp(prefix='.tmp', dir=self.cache_dir)
+        for column, array in zip(self.columns, arrays):
+            np.save(os.path.join(tmp, column + '.npy'),
+                    np.ascontiguousarray(array))
+
+        path = self._path(kic, usepdc, lc, source)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.rename(tmp, path)
+
+        self.evict()
+
+    def invalidate(self, kic=None, usepdc=None, lc=None, source=None):
+        """
+        Remove light curves from the cache.
+
+        Any argument left as None matches every value, so calling with no
+        arguments clears the whole cache.
+
+        Parameters
+        ----------
+        kic : int or sequence of ints, optional
+            Kepler Input Catalog number(s) to remove.
+        usepdc : bool, optional
+            Only remove PDCSAP (True) or SAP (False) light curves.
+        lc : bool, optional
+            Only remove long (True) or short (False) cadence light curves.
+        source : string, optional
+            Only remove light curves read from this source.
+
+        """
+        if kic is not None:
+            kics = set(np.atleast_1d(kic).astype(int))
+
+        for path, ekic, epdc, elc, esource, size, mtime in self.entries():
+            if ((kic is None or ekic in kics) and
+                    (usepdc is None or epdc == usepdc) and
+                    (lc is None or elc == lc) and
+                    (source is None or esource == source)):
+                shutil.rmtree(path, ignore_errors=True)
+
+    def evict(self, max_bytes=None):
+        """
+        Remove the least recently used light curves until the cache is no
+        larger than `max_bytes`. (Default: self.max_bytes)
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+
+        entries = sorted(self.entries(), key=lambda entry: entry[6])
+        total = sum(entry[5] for entry in entries)
+        for entry in entries:
+            if total <= max_bytes:
+                break
+            shutil.rmtree(entry[0], ignore_errors=True)
+            total -= entry[5]
+
+
+# The default cache used by loadlc_db.
+lc_cache = LCCache()
+
+
+def invalidate_cache(kic=None, usepdc=None, lc=None, source=None):
+    """
+    Remove light curves from the default cache. See LCCache.invalidate.
+    """
+    lc_cache.invalidate(kic=kic, usepdc=usepdc, lc=lc, source=source)
+
+
+def _db_source(kic, usepdc=True, lc=True, **kwargs):
+    """
+    Query the light curve of one target from the Kepler database at UW,
+    directly on the UW network and over SSH to hail elsewhere. Written by
+    Ethan Kruse.
 
     Can pass optional MySQLdb keyword arguments for logging into the database
     (host, user, passwd, db). Those default values should work though.
+    """
+    rows = np.empty(0, dtype=_LC_DTYPE)
+
+    hostname = socket.gethostname()
+    if 'astro.washington.edu' in hostname:
+        _require_mysqldb()
+        ct = 0
+        gotit = False
+        # try multiple times in case of sporadic database timeouts
+        while ct < 5 and not gotit:
+            try:
+                db = _pooled_dbconnect(**kwargs)
+                cursor = _stream_cursor(db)
+
+                toex = _lc_query("keplerid = %s", usepdc, lc)
+
+                cursor.execute(toex, (int(kic),))
+                rows = _read_rows(cursor, _LC_DTYPE)
+                # for some reason some results are coming back with arrays
+                # of length 0.
+                if len(rows) > 0:
+                    gotit = True
+                ct += 1
+            except MySQLdb.OperationalError:
+                print "mysqldb connection failed on attempt {0} of {1}.\n" \
+                      "Trying again.".format(ct + 1, 5)
+                _drop_dbconnect(**kwargs)
+                ct += 1
+    else:
+        toex = _lc_query("keplerid = {0}".format(int(kic)), usepdc, lc)
+        rows = _read_text_rows(_ssh_query(toex), _LC_DTYPE)
+
+    return _columns(rows)
+
+
+def _columns(rows):
+    """
+    Split a structured array of light curve rows into contiguous columns.
+    """
+    return tuple(np.ascontiguousarray(rows[field]) for field in
+                 ('time', 'flux', 'fluxerr', 'cadence', 'quarter', 'quality'))
+
+
+def _fits_files(kic, lc, fits_dir):
+    """
+    Find the MAST light curve files of a target under `fits_dir`, either
+    directly in it, in a directory named after the KIC ID, or in the MAST
+    archive layout (e.g. 0012/001234567/).
+    """
+    name = 'kplr{0:09d}-*_{1}.fits'.format(int(kic), 'llc' if lc else 'slc')
+    kicdir = '{0:09d}'.format(int(kic))
+
+    fnames = set()
+    for subdir in ('', kicdir, os.path.join(kicdir[:4], kicdir)):
+        fnames.update(glob.glob(os.path.join(fits_dir, subdir, name)))
+        fnames.update(glob.glob(os.path.join(fits_dir, subdir,
+                                             name + '.gz')))
+
+    return sorted(fnames)
+
+
+def fits_source(kic, usepdc=True, lc=True, fits_dir=None):
+    """
+    Read the light curve of one target from local MAST FITS files.
+
+    Reads the kplr*_llc.fits (or _slc.fits) files of every quarter found
+    under `fits_dir`, with memory mapping, touching only the columns that
+    are needed, and concatenates them. Requires astropy.
+
+    Parameters
+    ----------
+    kic : int
+        Kepler Input Catalog number for the target.
+    usepdc : bool, optional
+        Defaults to True. If True, use PDCSAP_FLUX instead of SAP_FLUX.
+    lc : bool, optional
+        Whether to select long or short cadence. Defaults to True, or LC data.
+    fits_dir : string, optional
+        Directory of the FITS files; see _fits_files for the layouts
+        searched. (Default: $TRICYCLE_FITS if set, otherwise
+        ~/.tricycle/fits)
+
+    Returns
+    -------
+    time, flux, fluxerr, cadence, quarter, quality : ndarray
+        The light curve as in the files, in the order of the quarters.
+
+    """
+    from astropy.io import fits
+
+    if fits_dir is None:
+        fits_dir = os.environ.get(
+            'TRICYCLE_FITS',
+            os.path.join(os.path.expanduser('~'), '.tricycle', 'fits'))
+
+    prefix = 'PDCSAP' if usepdc else 'SAP'
+    columns = (('time', 'TIME'), ('cadence', 'CADENCENO'),
+               ('quality', 'SAP_QUALITY'), ('flux', prefix + '_FLUX'),
+               ('fluxerr', prefix + '_FLUX_ERR'))
+
+    # Size the output from the headers, then copy the columns in.
+    hdulists = [fits.open(fname, memmap=True)
+                for fname in _fits_files(kic, lc, fits_dir)]
+    try:
+        sizes = [hdus[1].header['NAXIS2'] for hdus in hdulists]
+        rows = np.empty(sum(sizes), dtype=_LC_DTYPE)
+
+        start = 0
+        for hdus, size in zip(hdulists, sizes):
+            data = hdus[1].data
+            for field, column in columns:
+                rows[field][start:start + size] = data.field(column)
+            rows['quarter'][start:start + size] = hdus[0].header['QUARTER']
+            start += size
+    finally:
+        for hdus in hdulists:
+            hdus.close()
+
+    return _columns(rows)
+
+
+# Light curve sources of loadlc_db, by name; see register_source.
+sources = {'db': _db_source, 'fits': fits_source}
+
+
+def register_source(name, source):
+    """
+    Make a light curve source available to loadlc_db and RealBinary.
+
+    Parameters
+    ----------
+    name : string
+        Name to select the source with, as `source=name`.
+    source : callable
+        Called as source(kic, usepdc, lc, **kwargs), with the keyword
+        arguments given to loadlc_db. Returns the arrays (time, flux,
+        fluxerr, cadence, quarter, quality) of the target, in any order and
+        not normalized, or empty arrays if there are no data.
+
+    """
+    sources[name] = source
+
+
+def loadlc_db(kic, usepdc=True, lc=True, cache=True, quality_mask=0,
+              sigma_clip=None, source=None, **kwargs):
+    """
+    Load Kepler data from the local tddb database, or another source.
 
     Parameters
     ----------
@@ -78,6 +786,23 @@ def loadlc_db(kic, usepdc=True, lc=True, **kwargs):
         instead of the raw SAP.
     lc : bool, optional
         Whether to select long or short cadence. Defaults to True, or LC data.
+    cache : bool or LCCache, optional
+        Defaults to True. If True, use the default on-disk cache, so that
+        only the first load of a light curve queries the database. Pass an
+        LCCache to use a different cache, or False to always query.
+    quality_mask : int, optional
+        Drop points with these quality flag bits set. (Default: 0)
+    sigma_clip : float, optional
+        Drop outliers beyond this many standard deviations. See
+        normalize_lc. (Default: no clipping)
+    source : string, optional
+        Name of the source in `sources`: 'db' for the Kepler database at
+        UW, 'fits' for local MAST FITS files (see fits_source), or one
+        added with register_source. (Default: $TRICYCLE_SOURCE if set,
+        otherwise 'db')
+    **kwargs
+        Passed on to the source, e.g. MySQLdb login options for 'db', or
+        fits_dir for 'fits'.
 
     Returns
     -------
@@ -95,100 +820,152 @@ def loadlc_db(kic, usepdc=True, lc=True, **kwargs):
         Kepler data quality flag
 
     """
-    tablename = 'source'
-    if lc:
-        lcflag = "LCFLAG > 0"
-    else:
-        lcflag = "LCFLAG = 0"
+    if source is None:
+        source = os.environ.get('TRICYCLE_SOURCE', 'db')
+    if source not in sources:
+        raise ValueError("Unknown light curve source '{0}'.".format(source))
 
-    if usepdc:
-        fluxstr = "pdcsap_flux, pdcsap_flux_err "
-    else:
-        fluxstr = "sap_flux, sap_flux_err "
+    if cache is True:
+        cache = lc_cache
+
+    if cache:
+        arrays = cache.load(kic, usepdc, lc, source)
+        if arrays is not None:
+            return _filter_lc(arrays, quality_mask, sigma_clip)
+
+    # The cache holds the ordered and normalized light curve, so that
+    # unfiltered loads from it are zero-copy.
+    arrays = normalize_lc(*sources[source](kic, usepdc, lc, **kwargs))
+
+    if arrays[0].size == 0:
+        print 'No light curves found!'
+    elif cache:
+        cache.store(kic, usepdc, lc, arrays, source)
+
+    return _filter_lc(arrays, quality_mask, sigma_clip)
+
+
+def _query_many(kics, usepdc, lc, db=None, **kwargs):
+    """
+    Fetch the light curve rows of several targets with a single query.
+
+    Returns a structured array with the fields of _MANY_DTYPE.
+
+    """
+    if db is not None:
+        marks = ', '.join([_placeholder(db)] * len(kics))
+        cursor = _stream_cursor(db)
+        cursor.execute(_lc_query("keplerid IN ({0})".format(marks), usepdc,
+                                 lc, kic_column=True), tuple(kics))
+        return _read_rows(cursor, _MANY_DTYPE)
 
     hostname = socket.gethostname()
     if 'astro.washington.edu' in hostname:
-        ct = 0
-        gotit = False
+        _require_mysqldb()
         # try multiple times in case of sporadic database timeouts
-        while ct < 5 and not gotit:
+        for ct in range(5):
             try:
-                db = __dbconnect(**kwargs)
-                cursor = db.cursor()
-
-                toex = "SELECT cadenceno, quarter, sap_quality, time, {0} FROM" \
-                       " {2} WHERE keplerid = %s AND {1};"\
-                    .format(fluxstr, lcflag, tablename)
-
-                cursor.execute(toex, (int(kic),))
-                results = cursor.fetchall()
-                cadence = np.array([x[0] for x in results], dtype=np.int32)
-                quarter = np.array([x[1] for x in results], dtype=np.int32)
-                quality = np.array([x[2] for x in results], dtype=np.int32)
-                time = np.array([x[3] for x in results], dtype=np.float64)
-                flux = np.array([x[4] for x in results], dtype=np.float32)
-                fluxerr = np.array([x[5] for x in results], dtype=np.float32)
-                cursor.close()
-                db.close()
-                # for some reason some results are coming back with arrays
-                # of length 0.
-                if len(time) > 0:
-                    gotit = True
-                ct += 1
+                return _query_many(kics, usepdc, lc,
+                                   db=_pooled_dbconnect(**kwargs))
             except MySQLdb.OperationalError:
                 print "mysqldb connection failed on attempt {0} of {1}.\n" \
                       "Trying again.".format(ct + 1, 5)
-                ct += 1
+                _drop_dbconnect(**kwargs)
+
+        return np.empty(0, dtype=_MANY_DTYPE)
     else:
-        import paramiko
+        where = "keplerid IN ({0})".format(', '.join(str(kic) for kic in kics))
+        stream = _ssh_query(_lc_query(where, usepdc, lc, kic_column=True))
+        return _read_text_rows(stream, _MANY_DTYPE)
 
-        toex = "SELECT cadenceno, quarter, sap_quality, time, {0} FROM {3} " \
-               "WHERE keplerid = {2} AND {1};"\
-            .format(fluxstr, lcflag, int(kic), tablename)
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        # no password because my SSH keygen doesn't have a password
-        ssh.connect('hail.astro.washington.edu', username='eakruse')
-        stdin, stdout, stderr = ssh.exec_command(
-            'mysql -h tddb.astro.washington.edu -D Kepler -u eakruse '
-            '--password=tddbKepler -e "{0}"'.format(toex))
-        results = stdout.read().splitlines()
-        results = results[1:]
-
-        cadence = np.array([int(x.split('\t')[0]) for x in results],
-                           dtype=np.int32)
-        quarter = np.array([int(x.split('\t')[1]) for x in results],
-                           dtype=np.int32)
-        quality = np.array([int(x.split('\t')[2]) for x in results],
-                           dtype=np.int32)
-        time = np.array([float(x.split('\t')[3]) for x in results],
-                        dtype=np.float64)
-        flux = np.array([float(x.split('\t')[4]) for x in results],
-                        dtype=np.float32)
-        fluxerr = np.array([float(x.split('\t')[5]) for x in results],
-                           dtype=np.float32)
-        ssh.close()
-
-    # guarantee the light curve is in sequential order
-    # %timeit says that doing the ordering in python is faster than including
-    # an 'ORDER BY time' flag in the mysql search. I have no idea why, but
-    # I'll keep doing the ordering here.
-    order = np.argsort(time)
-    time = time[order]
-    flux = flux[order]
-    fluxerr = fluxerr[order]
-    quality = quality[order]
-    cadence = cadence[order]
-    quarter = quarter[order]
-
-    # go from raw CCD counts to normalized fluxes per quarter
-    uquarts = np.unique(quarter)
-    for ii in uquarts:
-        val = np.where(quarter == ii)[0]
-        fluxerr[val] /= np.median(flux[val])
-        flux[val] /= np.median(flux[val])
-
-    if flux.size == 0:
-        print 'No light curves found!'
 
-    return time, flux, fluxerr, cadence, quarter, quality
+def loadlc_db_many(kics, usepdc=True, lc=True, cache=True, chunksize=200,
+                   db=None, quality_mask=0, sigma_clip=None, source=None,
+                   **kwargs):
+    """
+    Load Kepler data for many targets at once.
+
+    Targets are fetched with one `keplerid IN (...)` query per chunk of
+    `chunksize` KIC IDs, over a single reused connection, so the cost of a
+    survey scales with the amount of data rather than with the number of
+    round trips. Light curves already in the cache are not queried. Other
+    sources than the database are read one target at a time.
+
+    Parameters
+    ----------
+    kics : sequence of ints
+        Kepler Input Catalog numbers, e.g. from select_kics.
+    usepdc : bool, optional
+        Defaults to True. If True, use the PDCSAP data
+        instead of the raw SAP.
+    lc : bool, optional
+        Whether to select long or short cadence. Defaults to True, or LC data.
+    cache : bool or LCCache, optional
+        Defaults to True. See loadlc_db.
+    chunksize : int, optional
+        Number of targets per query. (Default: 200)
+    db : DB-API connection, optional
+        Query this connection instead of the Kepler database, e.g. a
+        sqlite3 connection holding a `source` table with the same columns.
+    quality_mask, sigma_clip : optional
+        Filtering of each light curve; see normalize_lc.
+    source : string, optional
+        Light curve source; see loadlc_db. Ignored if `db` is given.
+
+    Returns
+    -------
+    lcs : dict
+        Maps each KIC ID with data to its light curve, as the tuple
+        (time, flux, fluxerr, cadence, quarter, quality) returned by
+        loadlc_db.
+
+    """
+    if source is None:
+        source = os.environ.get('TRICYCLE_SOURCE', 'db')
+    if source not in sources:
+        raise ValueError("Unknown light curve source '{0}'.".format(source))
+
+    if cache is True:
+        cache = lc_cache
+    if db is not None:
+        # Rows from a given connection are cached as database rows.
+        source = 'db'
+
+    lcs = {}
+    todo = []
+    for kic in kics:
+        arrays = cache.load(kic, usepdc, lc, source) if cache else None
+        if arrays is not None:
+            lcs[int(kic)] = _filter_lc(arrays, quality_mask, sigma_clip)
+        else:
+            todo.append(int(kic))
+
+    if source != 'db':
+        for kic in todo:
+            arrays = normalize_lc(*sources[source](kic, usepdc, lc,
+                                                   **kwargs))
+            if arrays[0].size == 0:
+                continue
+            if cache:
+                cache.store(kic, usepdc, lc, arrays, source)
+
+            lcs[kic] = _filter_lc(arrays, quality_mask, sigma_clip)
+        todo = []
+
+    for start in range(0, len(todo), chunksize):
+        rows = _query_many(todo[start:start + chunksize], usepdc, lc, db=db,
+                           **kwargs)
+
+        # Group the rows by target.
+        rows = rows[np.argsort(rows['kic'], kind='mergesort')]
+        ukics, starts = np.unique(rows['kic'], return_index=True)
+
+        for kic, group in zip(ukics, np.split(rows, starts[1:])):
+            arrays = normalize_lc(*_columns(group))
+            if cache:
+                cache.store(kic, usepdc, lc, arrays, source)
+
+            lcs[int(kic)] = _filter_lc(arrays, quality_mask, sigma_clip)
+
+    print 'Loaded light curves for %d of %d systems.' % (len(lcs), len(kics))
+    return lcs
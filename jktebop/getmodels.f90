@@ -0,0 +1,75 @@
+!=======================================================================
+!     GETMODELS: array version of the JKTEBOP GETMODEL function
+!-----------------------------------------------------------------------
+! Evaluates GETMODEL for every time in TIMES in a single call, so that
+! Python only pays the f2py argument conversion once per light curve
+! rather than once per datapoint. Compile together with jktebop_orig.f90
+! (see the Makefile in this directory).
+!=======================================================================
+      SUBROUTINE GETMODELS (V,VARY,LDTYPE,NSINE,PSINE,NPOLY,PPOLY,TIMES,
+     &                      NTIMES,DTYPE1,NUMINT,NINTERVAL,MAGS)
+      implicit none
+      integer NTIMES                ! IN: Number of times to evaluate
+      real*8 V(138)                 ! IN: Photometric parameters
+      integer VARY(138)             ! IN: Which parameters are fitted
+      integer LDTYPE(2)             ! IN: LD law type for the two stars
+      integer NSINE,PSINE(9)        ! IN: number and parameters of sines
+      integer NPOLY,PPOLY(9)        ! IN: number and parameters of polys
+      real*8 TIMES(NTIMES)          ! IN: The given TIMEs, PHASEs, CYCLEs
+      integer DTYPE1                ! IN: 1-8 depending on wanted result
+      integer NUMINT                ! IN: Number of numerical integratns
+      real*8 NINTERVAL              ! IN: Time interval for integrations
+      real*8 MAGS(NTIMES)           ! OUT: Model value for each time
+      real*8 LA,LB                  ! LOCAL: Light produced by each star
+      real*8 GETMODEL               ! FUNCTION: evaluate the model
+      integer i                     ! LOCAL: Loop counter
+!f2py intent(in) V,VARY,LDTYPE,NSINE,PSINE,NPOLY,PPOLY,TIMES
+!f2py intent(in) DTYPE1,NUMINT,NINTERVAL
+!f2py intent(hide) NTIMES
+!f2py depend(TIMES) NTIMES
+!f2py intent(out) MAGS
+!f2py depend(NTIMES) MAGS
+
+      do i = 1,NTIMES
+        MAGS(i) = GETMODEL (V,VARY,LDTYPE,NSINE,PSINE,NPOLY,PPOLY,
+     &                      TIMES(i),DTYPE1,LA,LB,NUMINT,NINTERVAL)
+      end do
+
+      END SUBROUTINE GETMODELS
+!=======================================================================
+!     GETLIGHTS: as GETMODELS, also returning the light of each star
+!-----------------------------------------------------------------------
+! LAS and LBS are the LA and LB outputs of GETMODEL: the light of stars A
+! and B outside eclipse, which the sines on stars A and B multiply.
+!=======================================================================
+      SUBROUTINE GETLIGHTS (V,VARY,LDTYPE,NSINE,PSINE,NPOLY,PPOLY,TIMES,
+     &                      NTIMES,NUMINT,NINTERVAL,MAGS,LAS,LBS)
+      implicit none
+      integer NTIMES                ! IN: Number of times to evaluate
+      real*8 V(138)                 ! IN: Photometric parameters
+      integer VARY(138)             ! IN: Which parameters are fitted
+      integer LDTYPE(2)             ! IN: LD law type for the two stars
+      integer NSINE,PSINE(9)        ! IN: number and parameters of sines
+      integer NPOLY,PPOLY(9)        ! IN: number and parameters of polys
+      real*8 TIMES(NTIMES)          ! IN: The given TIMEs
+      integer NUMINT                ! IN: Number of numerical integratns
+      real*8 NINTERVAL              ! IN: Time interval for integrations
+      real*8 MAGS(NTIMES)           ! OUT: Model magnitude for each time
+      real*8 LAS(NTIMES)            ! OUT: Light of star A for each time
+      real*8 LBS(NTIMES)            ! OUT: Light of star B for each time
+      real*8 GETMODEL               ! FUNCTION: evaluate the model
+      integer i                     ! LOCAL: Loop counter
+!f2py intent(in) V,VARY,LDTYPE,NSINE,PSINE,NPOLY,PPOLY,TIMES
+!f2py intent(in) NUMINT,NINTERVAL
+!f2py intent(hide) NTIMES
+!f2py depend(TIMES) NTIMES
+!f2py intent(out) MAGS,LAS,LBS
+!f2py depend(NTIMES) MAGS,LAS,LBS
+
+      do i = 1,NTIMES
+        MAGS(i) = GETMODEL (V,VARY,LDTYPE,NSINE,PSINE,NPOLY,PPOLY,
+     &                      TIMES(i),1,LAS(i),LBS(i),NUMINT,NINTERVAL)
+      end do
+
+      END SUBROUTINE GETLIGHTS
+!=======================================================================
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import glob
+import multiprocessing
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from synthetic import BopIt
+
+# Columns of a population table that describe the spots, as sines on the
+# light of star A (1) and star B (2). Zero-phase times default to t_0.
+SINE_COLUMNS = {-1: ('p_rot1', 'amp_1', 't_rot1'),
+                -2: ('p_rot2', 'amp_2', 't_rot2')}
+
+# Columns of a population table passed to BopIt as keyword arguments.
+BOPIT_COLUMNS = tuple(BopIt().params)
+
+
+class PopulationStore(object):
+    """
+    Light curves of a simulated population, stored on disk in chunks.
+
+    The store is a directory holding the parameter table (params.csv), the
+    observation times relative to each system's t_0 (elapsed.npy), and one
+    .npy file of fluxes per chunk of consecutive rows. Chunks are written
+    atomically, so an interrupted run leaves only whole chunks behind.
+
+    Parameters
+    ----------
+    path : string
+        Directory of the store.
+
+    Attributes
+    ----------
+    params : pandas.DataFrame
+        One row of parameters per system.
+    elapsed : ndarray
+        Observation times in days since t_0 of each system.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self.params = pd.read_csv(os.path.join(path, 'params.csv'))
+        self.elapsed = np.load(os.path.join(path, 'elapsed.npy'))
+
+    def _chunk_path(self, start, stop):
+        return os.path.join(self.path,
+                            'flux_{0:09d}_{1:09d}.npy'.format(start, stop))
+
+    def chunks(self):
+        """
+        Return the (start, stop) row ranges of the chunks written so far.
+        """
+        chunks = []
+        for fname in glob.glob(os.path.join(self.path, 'flux_*.npy')):
+            start, stop = os.path.basename(fname)[5:-4].split('_')
+            chunks.append((int(start), int(stop)))
+
+        return sorted(chunks)
+
+    def done(self):
+        """
+        Return a boolean array, True for each system already simulated.
+        """
+        done = np.zeros(len(self.params), dtype=bool)
+        for start, stop in self.chunks():
+            done[start:stop] = True
+
+        return done
+
+    def write(self, start, stop, flux):
+        """
+        Store the fluxes of rows start...stop-1.
+        """
+        fd, tmp = tempfile.mkstemp(prefix='.tmp', suffix='.npy',
+                                   dir=self.path)
+        with os.fdopen(fd, 'wb') as fobj:
+            np.save(fobj, flux)
+        os.rename(tmp, self._chunk_path(start, stop))
+
+    def flux(self, rows=None):
+        """
+        Load the fluxes of the population.
+
+        Parameters
+        ----------
+        rows : array_like, optional
+            Row numbers to load. (Default: all)
+
+        Returns
+        -------
+        flux : ndarray
+            Fluxes with shape (len(rows), len(elapsed)). Rows that have not
+            been simulated yet are NaN.
+
+        """
+        if rows is None:
+            rows = np.arange(len(self.params))
+        rows = np.asarray(rows)
+
+        flux = np.nan * np.ones((rows.size, self.elapsed.size))
+        for start, stop in self.chunks():
+            sel = np.flatnonzero((rows >= start) & (rows < stop))
+            if sel.size:
+                chunk = np.load(self._chunk_path(start, stop), mmap_mode='r')
+                flux[sel] = chunk[rows[sel] - start]
+
+        return flux
+
+    def time(self, row):
+        """
+        Return the observation times of one system, in HJD.
+        """
+        return self.params['t_0'][row] + self.elapsed
+
+
+def _bop_it(params):
+    """
+    Build a BopIt from one row of a population table.
+    """
+    kwargs = dict((key, value) for key, value in params.iteritems()
+                  if key in BOPIT_COLUMNS)
+
+    sine_star, sine_params = [], []
+    for star, (period, amp, t_zero) in sorted(SINE_COLUMNS.items()):
+        if params.get(period, 0) > 0:
+            sine_star.append(star)
+            sine_params.append((params.get(t_zero, params['t_0']),
+                                params[period], params.get(amp, 0.0)))
+
+    if not sine_star:
+        return BopIt(**kwargs)
+
+    return BopIt(sine_star=sine_star, sine_params=sine_params, **kwargs)
+
+
+def _simulate_chunk(args):
+    """
+    Simulate and store rows start...stop-1 of a population.
+    """
+    path, start, stop, sigma, seed, phase_grid, dtype = args
+    store = PopulationStore(path)
+
+    flux = np.empty((stop - start, store.elapsed.size), dtype=dtype)
+    for ii, row in enumerate(range(start, stop)):
+        params = store.params.iloc[row].to_dict()
+        bop_it = _bop_it(params)
+        time = params['t_0'] + store.elapsed
+
+        if phase_grid:
+            flux[ii] = bop_it.get_flux(time)
+        else:
+            flux[ii] = 10.0 ** (bop_it.get_mags(time) / -2.5)
+
+        # Noise depends only on the seed and the row, not on the worker.
+        if sigma is not None:
+            rng = np.random.RandomState([seed, row])
+            flux[ii] += rng.normal(0, sigma, time.size)
+
+    store.write(start, stop, flux)
+
+    return stop - start
+
+
+def simulate_population(params, path, length=90.0, sigma=None, sc=False,
+                        seed=0, processes=None, chunksize=100,
+                        phase_grid=False, dtype=np.float32):
+    """
+    Simulate the light curves of a population of binaries with BopIt.
+
+    Chunks of systems are simulated in a pool of processes; JKTEBOP keeps
+    global state, so processes rather than threads. Each worker writes its
+    chunks straight to the store, so the run scales with the number of
+    cores. Running again with the same table and path resumes an
+    interrupted run, simulating only the missing chunks.
+
+    Parameters
+    ----------
+    params : pandas.DataFrame
+        One row per system. Columns named after BopIt parameters (e.g.
+        sfsr, inc, ecc, p_orb) are passed to BopIt; others use the BopIt
+        defaults. Spots are given by p_rot1 and amp_1 for star A and p_rot2
+        and amp_2 for star B, with optional zero-phase times t_rot1 and
+        t_rot2.
+    path : string
+        Directory of the PopulationStore.
+    length : float, optional
+        Length of the light curves in days. (Default: 90.0)
+    sigma : float, optional
+        Standard deviation of the noise, in relative flux units. The noise
+        of row i is drawn with seed (seed, i).
+    sc : bool, optional
+        Default is long cadence (30 min. data). Set to True for short
+        cadence (1 min data).
+    seed : int, optional
+        Seed of the noise. (Default: 0)
+    processes : int, optional
+        Number of worker processes. (Default: number of CPUs)
+    chunksize : int, optional
+        Number of systems per chunk of the store. (Default: 100)
+    phase_grid : bool, optional
+        Interpolate a model of one orbit; see BopIt.get_flux.
+        (Default: False)
+    dtype : numpy dtype, optional
+        Type of the stored fluxes. (Default: numpy.float32)
+
+    Returns
+    -------
+    store : PopulationStore
+        The simulated population.
+
+    """
+    params = pd.DataFrame(params).reset_index(drop=True)
+    if 't_0' not in params:
+        params['t_0'] = BopIt().params['t_0']
+    params = params.astype(float)
+
+    # Set cadence.
+    if sc:
+        dt = 1.0 / 24.0 / 60.0
+    else:
+        dt = 1.0 / 24.0 / 2.
+    elapsed = np.arange(0.0, length + dt, dt)
+
+    if os.path.exists(os.path.join(path, 'params.csv')):
+        store = PopulationStore(path)
+        if list(store.params.columns) != list(params.columns) or \
+                store.params.shape != params.shape or \
+                not np.allclose(store.params.values, params.values,
+                                equal_nan=True) or \
+                not np.array_equal(store.elapsed, elapsed):
+            raise ValueError('{0} holds a different population.'.format(path))
+    else:
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        np.save(os.path.join(path, 'elapsed.npy'), elapsed)
+        params.to_csv(os.path.join(path, 'params.csv'), index=False)
+        store = PopulationStore(path)
+
+    done = store.done()
+    tasks = [(path, start, min(start + chunksize, len(params)), sigma, seed,
+              phase_grid, dtype)
+             for start in range(0, len(params), chunksize)
+             if not done[start:start + chunksize].all()]
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        nsims = sum(pool.imap_unordered(_simulate_chunk, tasks))
+    finally:
+        pool.close()
+        pool.join()
+
+    print 'Simulated %d of %d systems.' % (nsims, len(params))
+
+    return store
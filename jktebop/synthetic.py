@@ -1,13 +1,92 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 from collections import OrderedDict
+import multiprocessing
+import numbers
 import random
+import re
 import signal
 
 import numpy as np
+import pandas as pd
 
 import jktebop_f2py
 
+# Numerical derivative intervals of the 30 BopIt parameters and the sines,
+# from GET_DV in jktebop_orig.f90. Positive values are relative to the
+# parameter, negative values are absolute. The interval of a sine's time of
+# zero phase is a hundredth of its period.
+_DVD = np.array([0.01, 0.01, 0.01, -0.01, -0.01, -0.01, -0.001, -0.001,
+                 0.02, 0.02, 0.001, 0.001, 0.01, -1.0, -0.01, -0.0001,
+                 -0.001, 0.5, 0.1e-6, -0.001, -0.01, -0.01, -0.01, -0.01,
+                 -0.01, -0.01, 0.01, 0.01, -0.1, -0.1] +
+                [-0.01, 0.0001, 0.01] * 9)
+
+# Names of the sine parameters that BopIt.fit can vary, e.g. 'sine1_amp'.
+_SINE_NAME = re.compile(r'^sine([1-9])_(t0|period|amp)$')
+
+# Model state of the worker processes of BopIt.fit and BopIt.fit_errors.
+_fit_state = {}
+
+
+def _finite(time, flux, err):
+    """
+    Return the points of a light curve with finite values and errors > 0.
+    """
+    time = np.asarray(time, dtype=float)
+    flux = np.asarray(flux, dtype=float)
+    if err is None:
+        err = np.ones_like(flux)
+    err = np.asarray(err, dtype=float)
+
+    good = np.isfinite(time) & np.isfinite(flux) & np.isfinite(err) & \
+        (err > 0)
+
+    return np.ascontiguousarray(time[good]), flux[good], err[good]
+
+
+def _init_fit_worker(state):
+    """
+    Store the model state in a worker process of BopIt.fit.
+    """
+    _fit_state.update(state)
+
+
+def _fit_flux(vv):
+    """
+    Evaluate the model flux for parameter array `vv` in a worker process.
+    """
+    return _fit_state['bop_it']._flux(vv, _fit_state['time'],
+                                      _fit_state['num_int'],
+                                      _fit_state['n_interval'])
+
+
+def _fit_sim(args):
+    """
+    Fit one simulated light curve for BopIt.fit_errors.
+    """
+    seed, shift = args
+    bop_it, time, err = _fit_state['bop_it'], _fit_state['time'], \
+        _fit_state['err']
+    model, resid, scale = _fit_state['model'], _fit_state['resid'], \
+        _fit_state['scale']
+
+    if shift is None:
+        rng = np.random.RandomState(seed)
+        flux = model + rng.normal(0, 1, time.size) * err * scale
+    else:
+        flux = model + np.roll(resid, shift)
+
+    sim = bop_it.copy()
+    try:
+        values, errors, chi2 = sim.fit(time, flux, err,
+                                       vary=_fit_state['vary'],
+                                       processes=1, **_fit_state['kwargs'])
+    except np.linalg.LinAlgError:
+        return [np.nan] * len(_fit_state['vary'])
+
+    return values.values()
+
 
 class BopIt(object):
     """
@@ -120,6 +199,11 @@ class BopIt(object):
     >>> phase, time, flux = bop_it.light_it(sigma=0.005)
 
     """
+    # Models of one orbit without sines, shared by all instances and keyed
+    # by the parameters that change them. See phase_model.
+    _phase_models = OrderedDict()
+    _max_phase_models = 16
+
     def __init__(self, sine_star=None, sine_params=None, ldtype=(4, 4),
                  **kwargs):
 
@@ -194,7 +278,174 @@ class BopIt(object):
         elif sine_star is not None and sine_params is None:
             raise ValueError("'sine_params' not given")
 
-    def light_it(self, length=90.0, sigma=None, sc=False):
+        # Additional filler for JKTEBOP.
+        self.vary = np.zeros(138, dtype=int)
+        self.npoly = 0
+        self.ppoly = np.zeros(9, dtype=int)
+
+    def get_mags(self, time, num_int=1, n_interval=0.0):
+        """
+        Evaluate the JKTEBOP model magnitudes at an array of times.
+
+        All times are passed to JKTEBOP in a single call, rather than one
+        call per time.
+
+        Parameters
+        ----------
+        time : array_like
+            Observation times in HJD.
+        num_int : int, optional
+            Number of numerical integrations over each exposure. (Default: 1)
+        n_interval : float, optional
+            Duration of each exposure in seconds, used if `num_int` > 1.
+            (Default: 0.0)
+
+        Returns
+        -------
+        mag : ndarray
+            Model magnitude at each time.
+
+        """
+        time = np.ascontiguousarray(time, dtype=float)
+        dtype = 1
+
+        return jktebop_f2py.getmodels(self.vv, self.vary, self.ldtype,
+                                      self.nsine, self.psine, self.npoly,
+                                      self.ppoly, time, dtype, num_int,
+                                      n_interval)
+
+    def phase_model(self, tol=1e-6):
+        """
+        Tabulate the model without sines over one orbit.
+
+        The grid is refined adaptively: an interval is split while the model
+        at its midpoint differs from the straight line between its ends by
+        more than `tol`, so the grid is dense through ingress and egress and
+        sparse out of eclipse. Each refinement step is one JKTEBOP call.
+        Results are cached by model parameters, excluding the sines, and
+        shared between instances.
+
+        Parameters
+        ----------
+        tol : float, optional
+            Interpolation tolerance in relative flux. (Default: 1e-6)
+
+        Returns
+        -------
+        phase : ndarray
+            Orbital phases from 0 to 1.
+        flux : ndarray
+            Relative flux of the EB without sines.
+        light_a, light_b : ndarray
+            Light of stars A and B outside eclipse, in the same units as
+            `flux`. A sine on star A multiplies light_a, one on star B
+            multiplies light_b.
+
+        """
+        vv = self.vv.copy()
+        vv[30:57] = 0.0
+        key = (vv.tobytes(), tuple(self.ldtype), tol)
+        if key in self._phase_models:
+            return self._phase_models[key]
+
+        p_orb, t_0 = self.params['p_orb'], self.params['t_0']
+        no_psine = np.zeros(9, dtype=int)
+        scale = 10.0 ** (self.params['lsf'] / 2.5)
+
+        def evaluate(phase):
+            mag, light_a, light_b = jktebop_f2py.getlights(
+                vv, self.vary, self.ldtype, 0, no_psine, self.npoly,
+                self.ppoly, t_0 + p_orb * phase, 1, 0.0)
+            flux = 10.0 ** (mag / -2.5)
+            return np.vstack((flux, light_a / scale, light_b / scale))
+
+        # Start with at least eight points per eclipse duration.
+        if vv[6] < 5.0:
+            ecc = np.hypot(vv[6], vv[7])
+        else:
+            ecc = vv[6] - 10.0
+        duration = abs(self.params['sfsr']) * (1.0 - min(ecc, 0.9)) / np.pi
+        nstart = max(256, int(np.ceil(8.0 / duration)))
+
+        phase = np.linspace(0.0, 1.0, nstart + 1)
+        values = evaluate(phase)
+        split = np.ones(nstart, dtype=bool)
+
+        while split.any():
+            left = np.flatnonzero(split)
+            mid = 0.5 * (phase[left] + phase[left + 1])
+            mid_values = evaluate(mid)
+            error = np.abs(mid_values - 0.5 * (values[:, left] +
+                                               values[:, left + 1]))
+
+            # Split both halves of the intervals that failed.
+            failed = (error.max(axis=0) > tol) & \
+                (phase[left + 1] - phase[left] > 1e-9)
+            split = np.zeros(phase.size - 1, dtype=bool)
+            split[left[failed]] = True
+
+            phase = np.insert(phase, left + 1, mid)
+            values = np.insert(values, left + 1, mid_values, axis=1)
+            split = np.insert(split, left + 1, split[left])
+
+        model = (phase,) + tuple(values)
+
+        if len(self._phase_models) >= self._max_phase_models:
+            self._phase_models.popitem(last=False)
+        self._phase_models[key] = model
+
+        return model
+
+    def get_flux(self, time, tol=1e-6):
+        """
+        Evaluate the relative flux at an array of times from phase_model.
+
+        The model without sines is interpolated in phase, and the sines on
+        stars A and B are applied to the light of each star, as JKTEBOP does.
+        The error is about `tol` at most, within ingress and egress, and
+        much smaller elsewhere. Only sines on the light of star A or B (-1
+        and -2 in `sine_star`) are supported.
+
+        Parameters
+        ----------
+        time : array_like
+            Observation times in HJD.
+        tol : float, optional
+            Interpolation tolerance in relative flux. (Default: 1e-6)
+
+        Returns
+        -------
+        flux : ndarray
+            Relative flux at each time.
+
+        """
+        if not set(self.psine[:self.nsine]) <= set([-1, -2]) or \
+                self.npoly or self.params['irs'] == -1:
+            raise ValueError('The phase model only supports sines on the '
+                             'light of star A or B, with no polynomials '
+                             'and no Mandel & Agol model.')
+
+        time = np.asarray(time, dtype=float)
+        p_orb, t_0 = self.params['p_orb'], self.params['t_0']
+
+        model_phase, flux0, light_a, light_b = self.phase_model(tol)
+        phase = ((time - t_0) % p_orb) / p_orb
+
+        mult = {-1: np.ones_like(time), -2: np.ones_like(time)}
+        for idx in range(self.nsine):
+            sin_t0, sin_period, sin_amp = self.vv[30 + idx * 3:33 + idx * 3]
+            mult[self.psine[idx]] *= 1.0 + sin_amp * \
+                np.sin(2.0 * np.pi * (time - sin_t0) / sin_period)
+
+        flux = np.interp(phase, model_phase, flux0)
+        if self.nsine:
+            flux += np.interp(phase, model_phase, light_a) * (mult[-1] - 1.0)
+            flux += np.interp(phase, model_phase, light_b) * (mult[-2] - 1.0)
+
+        return flux
+
+    def light_it(self, length=90.0, sigma=None, sc=False, phase_grid=False,
+                 tol=1e-6, supersample=1):
         """
         Produce a Kepler-like light curve.
 
@@ -207,6 +458,18 @@ class BopIt(object):
         sc : bool, optional
             Default is long cadence (30 min. data). Set to True for short
             cadence (1 min data).
+        phase_grid : bool, optional
+            If True, interpolate a model of one orbit (see get_flux) instead
+            of running JKTEBOP at every time. Much faster for light curves
+            of many orbits. (Default: False)
+        tol : float, optional
+            Interpolation tolerance in relative flux, if `phase_grid`.
+            (Default: 1e-6)
+        supersample : int, optional
+            Number of sub-exposures per cadence. The model is evaluated at
+            the middle of each sub-exposure, all in one pass, and averaged
+            in flux to smear the eclipses over the exposure time.
+            (Default: 1)
 
         Returns
         -------
@@ -218,15 +481,9 @@ class BopIt(object):
             Relative flux of EB.
 
         """
-        # Additional filler for JKTEBOP.
-        vary = np.zeros(138, dtype=float)
-        npoly = 0
-        ppoly = np.zeros(9)
-        dtype = 1
-        l_a = 0.0
-        l_b = 0.0
-        num_int = 1
-        n_interval = 0
+        if not isinstance(supersample, numbers.Integral) or supersample < 1:
+            raise ValueError('supersample must be a positive integer, not '
+                             '{0!r}'.format(supersample))
 
         # Set cadence.
         if sc:
@@ -239,14 +496,20 @@ class BopIt(object):
                          dt)
         phase = ((time - self.params['t_0']) % self.params['p_orb']) / \
             self.params['p_orb']
-        flux = np.empty_like(time)
 
-        # Loop through time and run JKTEBOP.
-        for ii, tt in enumerate(time):
-            mag = jktebop_f2py.getmodel(self.vv, vary, self.ldtype, self.nsine,
-                                        self.psine, npoly, ppoly, tt, dtype,
-                                        l_a, l_b, num_int, n_interval)
-            flux[ii] = 10.0 ** (mag / - 2.5)
+        # Times of the sub-exposures, in cadence order.
+        offsets = dt * ((np.arange(supersample) + 0.5) / supersample - 0.5)
+        model_time = (time[:, np.newaxis] + offsets).ravel()
+
+        if phase_grid:
+            flux = self.get_flux(model_time, tol)
+        else:
+            # Run JKTEBOP on all times at once.
+            flux = 10.0 ** (self.get_mags(model_time) / -2.5)
+
+        # Average the sub-exposures in flux, rather than in magnitudes as
+        # JKTEBOP does with num_int.
+        flux = flux.reshape(time.size, supersample).mean(axis=1)
 
         # Add noise.
         if sigma is not None:
@@ -254,6 +517,300 @@ class BopIt(object):
 
         return phase, time, flux
 
+    def copy(self):
+        """
+        Return an independent copy of the model.
+        """
+        bop_it = BopIt(ldtype=self.ldtype, **self.params)
+        bop_it.vv = self.vv.copy()
+        bop_it.psine = self.psine.copy()
+        bop_it.nsine = self.nsine
+
+        return bop_it
+
+    def _flux(self, vv, time, num_int=1, n_interval=0.0):
+        """
+        Evaluate the relative flux for parameter array `vv`.
+        """
+        mags = jktebop_f2py.getmodels(vv, self.vary, self.ldtype, self.nsine,
+                                      self.psine, self.npoly, self.ppoly,
+                                      time, 1, num_int, n_interval)
+
+        return 10.0 ** (mags / -2.5)
+
+    def _vary_index(self, name):
+        """
+        Return the index in the JKTEBOP parameter array of a fit parameter.
+        """
+        if name in self.params:
+            return self.params.keys().index(name)
+
+        match = _SINE_NAME.match(name)
+        if match is None or int(match.group(1)) > self.nsine:
+            raise ValueError("Cannot vary unknown parameter "
+                             "'{0}'".format(name))
+
+        return 30 + 3 * (int(match.group(1)) - 1) + \
+            ('t0', 'period', 'amp').index(match.group(2))
+
+    def _set_vv(self, vv):
+        """
+        Set the JKTEBOP parameter array, keeping `params` in step.
+        """
+        self.vv = vv.copy()
+        for ii, key in enumerate(self.params):
+            self.params[key] = vv[ii]
+
+    def _jacobian(self, vv, index, time, num_int, n_interval, model):
+        """
+        Central-difference derivatives of the flux for the indices `index`.
+
+        Each derivative takes two model evaluations, as in JKTEBOP's
+        MRQCOF; `model` maps a list of parameter arrays to their fluxes.
+        The model is symmetric about an inclination of 90 degrees, so
+        where a step would cross it the inclination takes a backward
+        difference instead.
+        """
+        dv = np.abs(_DVD[index])
+        dv[_DVD[index] > 0] *= np.abs(vv[index][_DVD[index] > 0])
+        for jj, idx in enumerate(index):
+            if idx in range(30, 57, 3):
+                dv[jj] = vv[idx + 1] / 100.0
+        dv[dv == 0] = 1e-6
+
+        upper = vv[index] + dv
+        lower = vv[index] - dv
+        backward = (index == 5) & (upper > 90.0)
+        upper[backward] = vv[index][backward]
+
+        trials = []
+        for jj, idx in enumerate(index):
+            for value in (upper[jj], lower[jj]):
+                trial = vv.copy()
+                trial[idx] = value
+                trials.append(trial)
+        fluxes = model(trials)
+
+        jac = np.empty((time.size, len(index)))
+        for jj in range(len(index)):
+            jac[:, jj] = (fluxes[2 * jj] - fluxes[2 * jj + 1]) / \
+                (upper[jj] - lower[jj])
+
+        return jac
+
+    def fit(self, time, flux, err=None, vary=('csbr', 'sfsr', 'rsr', 'inc',
+                                              'lsf', 'p_orb', 't_0'),
+            processes=None, maxiter=100, ftol=1e-6, num_int=1,
+            n_interval=0.0):
+        """
+        Fit the model to a light curve by least squares.
+
+        A Levenberg-Marquardt fit as in JKTEBOP, in relative flux rather
+        than magnitudes. The model evaluations for the finite-difference
+        Jacobian, two per varied parameter, are spread across a pool of
+        processes. The model is updated in place with the best fit, so a
+        fit starts from the current parameters.
+
+        Parameters
+        ----------
+        time : array_like
+            Observation times in HJD.
+        flux : array_like
+            Relative flux, e.g. normalized to a median of 1. Points that are
+            not finite are ignored.
+        err : array_like, optional
+            Flux uncertainties. Default is to weight all points equally.
+        vary : sequence of strings, optional
+            Names of the parameters to fit: keys of `params`, or
+            'sine<n>_t0', 'sine<n>_period' and 'sine<n>_amp' for sine n.
+            (Default: 'csbr', 'sfsr', 'rsr', 'inc', 'lsf', 'p_orb', 't_0')
+        processes : int, optional
+            Number of worker processes; 1 evaluates the model in this
+            process. (Default: number of CPUs)
+        maxiter : int, optional
+            Maximum number of iterations. (Default: 100)
+        ftol : float, optional
+            Stop when an iteration lowers chi-squared by less than this
+            fraction. (Default: 1e-6)
+        num_int : int, optional
+            Number of numerical integrations over each exposure, e.g. to
+            account for the 30 min. integrations of long cadence data.
+            (Default: 1)
+        n_interval : float, optional
+            Duration of each exposure in seconds, used if `num_int` > 1.
+            (Default: 0.0)
+
+        Returns
+        -------
+        values : OrderedDict
+            Best-fit value of each varied parameter.
+        errors : OrderedDict
+            Formal error of each varied parameter, from the covariance
+            matrix scaled by the reduced chi-squared.
+        chi2 : float
+            Chi-squared of the best fit.
+
+        Examples
+        --------
+        Fit a Kepler EB, starting from its catalog parameters.
+
+        >>> binary = RealBinary(kic)
+        >>> bop_it = BopIt(p_orb=binary.p_orb, t_0=binary.t_0, sfsr=0.2)
+        >>> values, errors, chi2 = bop_it.fit(
+        >>>     binary.time, binary.flux / np.nanmedian(binary.flux),
+        >>>     binary.err / np.nanmedian(binary.flux))
+
+        """
+        time, flux, err = _finite(time, flux, err)
+
+        index = np.array([self._vary_index(name) for name in vary])
+        if time.size <= index.size:
+            raise ValueError('Not enough data points to fit '
+                             '{0} parameters.'.format(index.size))
+
+        if processes == 1:
+            pool = None
+
+            def model(trials):
+                return [self._flux(vv, time, num_int, n_interval)
+                        for vv in trials]
+        else:
+            state = {'bop_it': self, 'time': time, 'num_int': num_int,
+                     'n_interval': n_interval}
+            pool = multiprocessing.Pool(processes, _init_fit_worker,
+                                        (state,))
+
+            def model(trials):
+                return pool.map(_fit_flux, trials)
+
+        def chi_squared(vv):
+            resid = (flux - self._flux(vv, time, num_int, n_interval)) / err
+            return np.sum(resid ** 2), resid
+
+        try:
+            vv = self.vv.copy()
+            chi2, resid = chi_squared(vv)
+            lam = 1e-3
+            for ii in range(maxiter):
+                # An exact fit cannot be improved on.
+                if chi2 == 0.0:
+                    break
+
+                jac = self._jacobian(vv, index, time, num_int, n_interval,
+                                     model) / err[:, np.newaxis]
+                alpha = np.dot(jac.T, jac)
+                beta = np.dot(jac.T, resid)
+
+                # Raise the damping until a step lowers chi-squared.
+                while lam < 1e10:
+                    curv = alpha + lam * np.diag(np.diag(alpha))
+                    trial = vv.copy()
+                    trial[index] += np.linalg.lstsq(curv, beta, rcond=None)[0]
+                    if 5 in index:
+                        trial[5] = min(trial[5], 90.0)
+
+                    trial_chi2, trial_resid = chi_squared(trial)
+                    if trial_chi2 <= chi2:
+                        break
+                    lam *= 10.0
+                else:
+                    break
+
+                improvement = (chi2 - trial_chi2) / chi2
+                vv, chi2, resid = trial, trial_chi2, trial_resid
+                lam /= 10.0
+                if improvement < ftol:
+                    break
+
+            jac = self._jacobian(vv, index, time, num_int, n_interval,
+                                 model) / err[:, np.newaxis]
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        self._set_vv(vv)
+
+        cov = np.linalg.inv(np.dot(jac.T, jac))
+        scale = np.sqrt(chi2 / (time.size - index.size))
+        values = OrderedDict((name, vv[idx])
+                             for name, idx in zip(vary, index))
+        errors = OrderedDict((name, np.sqrt(cov[jj, jj]) * scale)
+                             for jj, name in enumerate(vary))
+
+        return values, errors, chi2
+
+    def fit_errors(self, time, flux, err=None, vary=('csbr', 'sfsr', 'rsr',
+                                                     'inc', 'lsf', 'p_orb',
+                                                     't_0'),
+                   method='mc', nsims=100, processes=None, seed=0, **kwargs):
+        """
+        Estimate parameter errors by refitting simulated light curves.
+
+        The model is first fit to the light curve, then refit to `nsims`
+        simulated light curves in a pool of processes. The spread of the
+        refitted parameters estimates their errors, as JKTEBOP tasks 8 and
+        9 do.
+
+        Parameters
+        ----------
+        time, flux, err, vary
+            As for `fit`.
+        method : {'mc', 'rp'}, optional
+            'mc' for Monte Carlo: the best fit plus Gaussian noise, with
+            the errors scaled to the residuals of the fit. 'rp' for residual
+            permutation: the best fit plus the residuals, shifted cyclically
+            by a different number of points for each simulation.
+            (Default: 'mc')
+        nsims : int, optional
+            Number of simulations. (Default: 100)
+        processes : int, optional
+            Number of worker processes. (Default: number of CPUs)
+        seed : int, optional
+            Seed of the Monte Carlo noise; simulation i uses seed
+            (seed, i). (Default: 0)
+        **kwargs
+            Other `fit` options, e.g. num_int or maxiter.
+
+        Returns
+        -------
+        sims : pandas.DataFrame
+            Refitted parameters, one row per simulation and one column per
+            varied parameter. Failed fits are NaN. The errors are
+            `sims.std()`.
+
+        """
+        if method not in ('mc', 'rp'):
+            raise ValueError("method must be 'mc' or 'rp'")
+
+        values, errors, chi2 = self.fit(time, flux, err, vary=vary,
+                                        processes=processes, **kwargs)
+
+        time, flux, err = _finite(time, flux, err)
+        model = self._flux(self.vv, time, kwargs.get('num_int', 1),
+                           kwargs.get('n_interval', 0.0))
+        resid = flux - model
+        scale = np.sqrt(chi2 / (time.size - len(vary)))
+
+        if method == 'mc':
+            tasks = [([seed, ii], None) for ii in range(nsims)]
+        else:
+            nsims = min(nsims, time.size - 1)
+            tasks = [(None, (ii + 1) * time.size // (nsims + 1))
+                     for ii in range(nsims)]
+
+        state = {'bop_it': self, 'time': time, 'err': err, 'model': model,
+                 'resid': resid, 'scale': scale, 'vary': tuple(vary),
+                 'kwargs': kwargs}
+        pool = multiprocessing.Pool(processes, _init_fit_worker, (state,))
+        try:
+            sims = pool.map(_fit_sim, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+        return pd.DataFrame(sims, columns=vary)
+
     @staticmethod
     def _bop_it(start_time=6, repeats=5):
         """
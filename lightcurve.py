@@ -2,6 +2,8 @@ from gatspy.periodic import LombScargleFast
 import matplotlib.pyplot as plt
 import numpy as np
 
+from periodogram import autocorrelation, lomb_scargle, prewhiten, spectrogram
+
 class LightCurve(object):
     """
     Eclipsing binary light curve with system parameters.
@@ -32,15 +34,53 @@ class LightCurve(object):
         Seperation between the primary eclipse in secondary eclipse in phase
     kic : int
         Kepler Input Catalog (KIC) ID number.
+    dtype : numpy dtype, optional
+        Storage type of `flux` and `err`, e.g. numpy.float32 to halve their
+        memory. (Default: the type of `flux`)
+    time_dtype : numpy dtype, optional
+        Storage type of `time`, relative to `epoch`. With numpy.float32 the
+        times of a 4 year curve keep a precision of about 10 s.
+        (Default: the type of `time`)
+    epoch : float, optional
+        Reference time that `time` is stored relative to. (Default: 0.0,
+        or the first whole day of `time` if `time_dtype` is float32)
+
+    Notes
+    -----
+    `flux`, `err`, `quarter` (as int8) and `time` are packed into one
+    contiguous buffer per light curve. Reading them returns views of the
+    buffer, except `time` when stored relative to a nonzero epoch, which is
+    converted back to float64. Assigning one of them repacks the buffer.
+    Arrays that are read-only and already of the storage type, such as the
+    time grid shared by ModelBinary light curves, are referenced instead of
+    copied.
 
     """
+    __slots__ = ('_buffer', '_time', '_flux', '_err', '_quarter', '_epoch',
+                 '_dtypes', 'p_orb', 't_0', 'p_depth', 's_depth', 'p_width',
+                 's_width', 'sep', 'kic', '_phase_cache', '_mask_cache',
+                 '_index_cache', '_cut_cache')
+
     def __init__(self, time, flux, err, quarter, p_orb, t_0, p_depth, s_depth,
-+                 p_width, s_width, sep, kic):
+                 p_width, s_width, sep, kic, dtype=None, time_dtype=None,
+                 epoch=None):
+
+        time = np.asarray(time)
+        flux = np.asarray(flux)
+        if dtype is None:
+            dtype = flux.dtype
+        if time_dtype is None:
+            time_dtype = time.dtype
+        if epoch is None:
+            if np.dtype(time_dtype).itemsize < 8 and time.size:
+                epoch = np.floor(np.nanmin(time))
+            else:
+                epoch = 0.0
+
+        self._epoch = float(epoch)
+        self._dtypes = (np.dtype(time_dtype), np.dtype(dtype))
+        self._pack(time, flux, err, quarter)
 
-        self.time = time
-        self.flux = flux
-        self.err = err
-        self.quarter = quarter
         self.p_orb = p_orb
         self.t_0 = t_0
         self.p_depth = p_depth
@@ -50,6 +90,127 @@ class LightCurve(object):
         self.sep = sep
         self.kic = kic
 
+    def _pack(self, time, flux, err, quarter):
+        """
+        Store the light curve arrays in one contiguous buffer.
+        """
+        time_dtype, dtype = self._dtypes
+        time = np.asarray(time)
+        if self._epoch != 0.0:
+            time = time - self._epoch
+
+        arrays = [(time, time_dtype), (flux, dtype), (err, dtype),
+                  (quarter, np.int8)]
+
+        # Largest items first, so that every view is aligned.
+        nbytes = 0
+        order = sorted(range(4), key=lambda ii: -np.dtype(arrays[ii][1])
+                       .itemsize)
+        offsets = [None] * 4
+        for ii in order:
+            array, array_dtype = arrays[ii]
+            if array is None or (isinstance(array, np.ndarray) and
+                                 not array.flags.writeable and
+                                 array.dtype == array_dtype):
+                continue
+            offsets[ii] = nbytes
+            nbytes += np.size(array) * np.dtype(array_dtype).itemsize
+
+        self._buffer = np.empty(nbytes, dtype=np.uint8)
+        stored = []
+        for (array, array_dtype), offset in zip(arrays, offsets):
+            if offset is not None:
+                view = self._buffer[offset:offset + np.size(array) *
+                                    np.dtype(array_dtype).itemsize]
+                view = view.view(array_dtype)
+                view[:] = array
+                array = view
+            stored.append(array)
+
+        self._time, self._flux, self._err, self._quarter = stored
+
+    @property
+    def time(self):
+        """
+        The observation times, in days.
+        """
+        if self._epoch != 0.0:
+            return self._time.astype(np.float64) + self._epoch
+        return self._time
+
+    @time.setter
+    def time(self, time):
+        self._pack(time, self._flux, self._err, self._quarter)
+
+    @property
+    def flux(self):
+        """
+        The system flux.
+        """
+        return self._flux
+
+    @flux.setter
+    def flux(self, flux):
+        self._pack(self.time, flux, self._err, self._quarter)
+
+    @property
+    def err(self):
+        """
+        The flux errors.
+        """
+        return self._err
+
+    @err.setter
+    def err(self, err):
+        self._pack(self.time, self._flux, err, self._quarter)
+
+    @property
+    def quarter(self):
+        """
+        The Kepler quarter of each point, or None.
+        """
+        return self._quarter
+
+    @quarter.setter
+    def quarter(self, quarter):
+        self._pack(self.time, self._flux, self._err, quarter)
+
+    @property
+    def nbytes(self):
+        """
+        Memory used by the light curve arrays, in bytes.
+        """
+        return sum(array.nbytes for array in (self._time, self._flux,
+                                              self._err, self._quarter)
+                   if array is not None)
+
+    def __getstate__(self):
+        """
+        Pickle the stored arrays and parameters, but not the buffer holding
+        the arrays, which would store every point twice.
+
+        >>> import pickle
+        >>> lc = LightCurve(np.arange(10000.), np.ones(10000), np.ones(10000),
+        ...                 np.zeros(10000), 1., 0., 0., 0., 0., 0., 0., 1,
+        ...                 dtype=np.float32, time_dtype=np.float32)
+        >>> copy = pickle.loads(pickle.dumps(lc, 2))
+        >>> np.may_share_memory(copy.flux, copy._buffer)
+        True
+        >>> len(pickle.dumps(lc, 2)) < 1.01 * lc.nbytes
+        True
+
+        """
+        return dict((key, getattr(self, key)) for key in LightCurve.__slots__
+                    if hasattr(self, key) and not key.endswith('_cache') and
+                    key != '_buffer')
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            setattr(self, key, value)
+
+        # Repack the arrays into one buffer.
+        self._pack(self.time, self._flux, self._err, self._quarter)
+
     def get_period(self, units='days'):
         """
         Return the orbital period.
@@ -76,38 +237,228 @@ class LightCurve(object):
 
         return period
 
-    def curve_cut(self):
-        """This a function that takes parameters of a star and gives you the time and flux with the eclipses cut out
-    
-        Parameters:
-        Time
-        Flux
-        bjdo
-        period
-        pwidth
-        swidth
-        separation
-        
-        return:
-            timecut and fluxcut"""
-        # Convert BJD to Kepler date
-        t_0 = self.t_0 - 54833
-
-        phase=((self.time- t_0) % self.p_orb) / self.p_orb
-        mask= ((phase > self.p_width / 2.) &
-               (phase < 1 - self.p_width / 2.)) & \
-              ((phase > self.sep + self.s_width / 2.) |
-               (phase < self.sep - self.s_width / 2.))
-               
-        timecut= self.time[mask]
-        fluxcut= self.flux[mask]
-        errcut = self.err[mask]
-        quartercut = self.quarter[mask]
-
-        return timecut, fluxcut, errcut, quartercut
+    @property
+    def phase(self):
+        """
+        Orbital phase of each point, from 0 to 1 with the primary eclipse at
+        0. Computed on first use and cached, until `time`, `p_orb` or `t_0`
+        are replaced. Read-only.
+        """
+        key = (self._time, self.p_orb, self.t_0)
+        cache = getattr(self, '_phase_cache', None)
+        if cache is None or cache[0] is not key[0] or cache[1:3] != key[1:]:
+            # Convert BJD to Kepler date
+            t_0 = self.t_0 - 54833
+            phase = ((self.time - t_0) % self.p_orb) / self.p_orb
+            phase.flags.writeable = False
+            self._phase_cache = key + (phase,)
+
+        return self._phase_cache[-1]
+
+    @property
+    def cut_mask(self):
+        """
+        True for each point outside the primary and secondary eclipses.
+        Cached like `phase`, and also recomputed when `p_width`, `s_width`
+        or `sep` change. Read-only.
+        """
+        phase = self.phase
+        key = (phase, self.p_width, self.s_width, self.sep)
+        cache = getattr(self, '_mask_cache', None)
+        if cache is None or cache[0] is not phase or cache[1:4] != key[1:]:
+            mask = ((phase > self.p_width / 2.) &
+                    (phase < 1 - self.p_width / 2.)) & \
+                ((phase > self.sep + self.s_width / 2.) |
+                 (phase < self.sep - self.s_width / 2.))
+            mask.flags.writeable = False
+            self._mask_cache = key + (mask,)
+
+        return self._mask_cache[-1]
+
+    @property
+    def cut_index(self):
+        """
+        Indices of the points outside the eclipses, e.g. for `np.take`.
+        Cached with `cut_mask`. Read-only.
+        """
+        mask = self.cut_mask
+        cache = getattr(self, '_index_cache', None)
+        if cache is None or cache[0] is not mask:
+            index = np.flatnonzero(mask)
+            index.flags.writeable = False
+            self._index_cache = (mask, index)
+
+        return self._index_cache[1]
+
+    def curve_cut(self, masked=False):
+        """
+        Return the light curve with the eclipses cut out.
+
+        The eclipses are at phases within `p_width` / 2 of 0 and within
+        `s_width` / 2 of `sep`; see `cut_mask`. The cut arrays are made
+        once and shared by later calls, until the light curve or the
+        eclipse parameters change, so they are read-only.
+
+        Parameters
+        ----------
+        masked : bool, optional
+            If True, return masked arrays that share memory with `time`,
+            `flux`, `err` and `quarter`, with the eclipses masked, instead
+            of copies. (Default: False)
+
+        Returns
+        -------
+        timecut, fluxcut, errcut, quartercut : ndarray
+            The time, flux, errors and quarters outside the eclipses.
+            `quartercut` is None if `quarter` is.
+
+        """
+        arrays = (self._time, self._flux, self._err, self._quarter)
+
+        if masked:
+            arrays = (self.time,) + arrays[1:]
+            in_eclipse = ~self.cut_mask
+            return tuple(None if array is None else
+                         np.ma.MaskedArray(array, mask=in_eclipse, copy=False)
+                         for array in arrays)
+
+        index = self.cut_index
+        cache = getattr(self, '_cut_cache', None)
+        if cache is None or cache[0] is not index or \
+                any(old is not new for old, new in zip(cache[1], arrays)):
+            cut = [None if array is None else array[index]
+                   for array in arrays]
+            if self._epoch != 0.0:
+                cut[0] = cut[0].astype(np.float64) + self._epoch
+            for array in cut:
+                if array is not None:
+                    array.flags.writeable = False
+            self._cut_cache = (index, arrays, tuple(cut))
+
+        return self._cut_cache[2]
+
+    def prewhiten(self, nperiods=3, period_range=(.05, 45), oversampling=10,
+                  cut_eclipses=True, snr_width=1.0):
+        """
+        Extract the strongest periods of the light curve by prewhitening.
+
+        See periodogram.prewhiten.
+
+        Parameters
+        ----------
+        nperiods : int, optional
+            Number of periods to extract. (Default: 3)
+        period_range : tuple, optional
+            Period range in days. (Default: (0.05, 45))
+        oversampling : float, optional
+            Number of grid points per peak width. (Default: 10)
+        cut_eclipses : bool, optional
+            Remove the eclipses first, with curve_cut. (Default: True)
+        snr_width : float, optional
+            Width in 1 / days of the noise estimate. (Default: 1.0)
+
+        Returns
+        -------
+        peaks : list of tuples
+            (period, amplitude, phase, snr) of each period, in the order
+            extracted.
+
+        """
+        if cut_eclipses:
+            time, flux, err, quarter = self.curve_cut()
+        else:
+            time, flux, err = self.time, self.flux, self.err
+
+        return prewhiten(time, flux, err, nperiods, period_range[0],
+                         period_range[1], oversampling, snr_width)
+
+    def acf(self, period_range=(.05, 45), smooth=0.1, npeaks=1,
+            cut_eclipses=True):
+        """
+        Autocorrelation function of the light curve, and its best periods.
+
+        A cheaper alternative to a periodogram for spot modulation. See
+        periodogram.autocorrelation.
+
+        Parameters
+        ----------
+        period_range : tuple, optional
+            Period range in days. (Default: (0.05, 45))
+        smooth : float, optional
+            Width of the Gaussian smoothing of the ACF, in days.
+            (Default: 0.1)
+        npeaks : int, optional
+            Number of periods to return. (Default: 1)
+        cut_eclipses : bool, optional
+            Remove the eclipses first, with curve_cut. The gaps they leave
+            are masked. (Default: True)
+
+        Returns
+        -------
+        lag : ndarray
+            The lags in days.
+        acf : ndarray
+            The autocorrelation at each lag.
+        peaks : ndarray
+            Periods of the `npeaks` highest ranked ACF peaks, highest first.
+
+        """
+        if cut_eclipses:
+            time, flux, err, quarter = self.curve_cut()
+        else:
+            time, flux = self.time, self.flux
+
+        return autocorrelation(time, flux, period_range[0], period_range[1],
+                               smooth, npeaks)
+
+    def spectrogram(self, window=90., step=10., period_range=(.05, 45),
+                    oversampling=5, cut_eclipses=True, processes=None):
+        """
+        Periodograms of the light curve in sliding time windows, to follow
+        the spot periods as they change.
+
+        See periodogram.spectrogram. The quarters are computed in parallel.
+
+        Parameters
+        ----------
+        window : float, optional
+            Length of the windows in days. (Default: 90.0)
+        step : float, optional
+            Shift in days from one window to the next. (Default: 10.0)
+        period_range : tuple, optional
+            Period range in days. (Default: (0.05, 45))
+        oversampling : float, optional
+            Number of grid points per peak width of a window. (Default: 5)
+        cut_eclipses : bool, optional
+            Remove the eclipses first, with curve_cut. (Default: True)
+        processes : int, optional
+            Number of worker processes. (Default: number of CPUs)
+
+        Returns
+        -------
+        center : ndarray
+            Middle time of each window.
+        period : ndarray
+            The grid periods in days.
+        power : ndarray
+            The power, with shape (n_windows, n_freq).
+        peaks : ndarray
+            Period of the highest peak in each window.
+
+        """
+        if cut_eclipses:
+            time, flux, err, quarter = self.curve_cut()
+        else:
+            time, flux, err, quarter = (self.time, self.flux, self.err,
+                                        self.quarter)
+
+        return spectrogram(time, flux, err, quarter, window, step,
+                           period_range[0], period_range[1], oversampling,
+                           processes=processes)
 
     def periodogram(self, time, flux, err, p_fold=None, plt_color='k',
-                    max_days=100.0, oversampling=5, plot=False, cut_eclipses=True, best_period = True, period_range = (.05,45)):
+                    max_days=100.0, oversampling=5, plot=False, cut_eclipses=True, best_period = True, period_range = (.05,45),
+                    engine='gatspy'):
         """
         Plot a the light curve, periodogram, and phase-folded light curve.
 
@@ -132,23 +483,44 @@ class LightCurve(object):
             periodogram.
         oversampling: int, optional
             The oversampling factor for the periodogram.
+        engine : {'gatspy', 'fft', 'acf'}, optional
+            'gatspy' uses gatspy's LombScargleFast, with a second optimizer
+            pass for the best period. 'fft' uses periodogram.lomb_scargle,
+            which finds the best period in the same pass, on a grid limited
+            to `period_range`. 'acf' uses the autocorrelation function (see
+            `acf`) instead of a periodogram; `period` and `power` are then
+            the lags and the ACF.
 
         """
         if cut_eclipses:
-            time, flux, err = self.curve_cut()
+            time, flux, err, quarter = self.curve_cut()
             
         else:
             time=self.time
             flux=self.flux
-            error=self.error
+            err=self.err
             
-        model = LombScargleFast().fit(time, flux, err)
-        period, power = model.periodogram_auto(oversampling=oversampling)
-        
-         #new stuff to output the best period
-        if best_period:
-            model.optimizer.period_range = period_range
-            Best_period = model.best_period
+        if engine == 'gatspy':
+            model = LombScargleFast().fit(time, flux, err)
+            period, power = model.periodogram_auto(oversampling=oversampling)
+
+            #new stuff to output the best period
+            if best_period:
+                model.optimizer.period_range = period_range
+                Best_period = model.best_period
+        elif engine == 'fft':
+            period, power, peaks = lomb_scargle(time, flux, err,
+                                                pmin=period_range[0],
+                                                pmax=period_range[1],
+                                                oversampling=oversampling)
+            Best_period = peaks[0]
+        elif engine == 'acf':
+            period, power, peaks = autocorrelation(time, flux,
+                                                   pmin=period_range[0],
+                                                   pmax=period_range[1])
+            Best_period = peaks[0]
+        else:
+            raise ValueError('Invalid choice of engine.')
             
         if plot:
             fig1, (ax1, ax2) = plt.subplots(nrows=2, figsize=(7, 14))
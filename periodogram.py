@@ -0,0 +1,1047 @@
+from collections import OrderedDict
+import hashlib
+import multiprocessing
+import multiprocessing.pool
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+# Lagrange extirpolation order, and the minimum ratio of FFT length to the
+# number of frequencies computed from it. Together they keep the error of
+# the normalized power below ~1e-6.
+_EXTIRP_ORDER = 6
+_FFT_OVERSAMPLING = 8
+
+# Extirpolation tables and window sums kept by lomb_scargle_many, per
+# process.
+_TABLE_CACHE_SIZE = 2
+_table_cache = OrderedDict()
+_table_lock = threading.Lock()
+
+
+def _grid(baseline, pmin, pmax, oversampling):
+    """
+    Linear frequency grid (f0, df, nf) from pmax down to pmin.
+    """
+    f0 = 1. / pmax
+    df = 1. / (oversampling * baseline)
+    nf = int(np.floor((1. / pmin - f0) / df)) + 1
+
+    return f0, df, nf
+
+
+def frequency_grid(time, pmin=None, pmax=None, oversampling=5):
+    """
+    Return a linear frequency grid suited to a set of observation times.
+
+    Parameters
+    ----------
+    time : array_like
+        Observation times in days.
+    pmin : float, optional
+        Shortest period in days. (Default: twice the median cadence)
+    pmax : float, optional
+        Longest period in days. (Default: the time baseline)
+    oversampling : float, optional
+        Number of grid points per periodogram peak width, 1 / baseline.
+        (Default: 5)
+
+    Returns
+    -------
+    f0 : float
+        The lowest frequency, in 1 / days.
+    df : float
+        The frequency spacing.
+    nf : int
+        The number of frequencies, f0 + df * arange(nf).
+
+    """
+    time = np.asarray(time)
+    baseline = time.max() - time.min()
+
+    if pmin is None:
+        pmin = 2. * np.median(np.diff(np.sort(time)))
+    if pmax is None:
+        pmax = baseline
+
+    return _grid(baseline, pmin, pmax, oversampling)
+
+
+def _fft_size(nf):
+    """
+    FFT length for computing nf frequencies at once.
+    """
+    return 1 << int(np.ceil(np.log2(_FFT_OVERSAMPLING * nf)))
+
+
+class _Extirpolation(object):
+    """
+    Lagrange extirpolation of data at times `tau` onto a periodic grid of
+    `nfft` points, for frequencies spaced by `df`.
+
+    The node positions and weights depend only on the times, so one table
+    serves every weighting of the data, every block of frequencies, and
+    every light curve observed at the same times.
+    """
+    def __init__(self, tau, df, nfft):
+        order = _EXTIRP_ORDER
+        u = (tau * (df * nfft)) % nfft
+
+        self.nfft = nfft
+        self.first = np.floor(u).astype(np.int64) - (order // 2 - 1)
+
+        # Lagrange basis polynomial of each node, at u.
+        offset = u - self.first
+        self.weights = np.ones((order, u.size))
+        for jj in range(order):
+            for mm in range(order):
+                if mm != jj:
+                    self.weights[jj] *= (offset - mm) / (jj - mm)
+
+    def grid(self, h):
+        """
+        Return the real values h extirpolated onto the grid.
+        """
+        index = (self.first + np.arange(len(self.weights))[:, None]) % \
+            self.nfft
+        return np.bincount(index.ravel(), weights=(self.weights * h).ravel(),
+                           minlength=self.nfft)
+
+    def sums(self, h, nf):
+        """
+        Return sum(h * exp(2j pi k df tau)) for k in range(nf).
+        """
+        grid = np.zeros(self.nfft, dtype=np.complex128)
+        for jj, weight in enumerate(self.weights):
+            index = (self.first + jj) % self.nfft
+            grid.real += np.bincount(index, weights=weight * h.real,
+                                     minlength=self.nfft)
+            grid.imag += np.bincount(index, weights=weight * h.imag,
+                                     minlength=self.nfft)
+
+        return self.nfft * np.fft.ifft(grid)[:nf]
+
+
+def _window(tables, tau, w, f0, nf):
+    """
+    Sums of the weights alone, which do not depend on the fluxes: the sums
+    over w * exp(i omega tau) and w * exp(2i omega tau) for nf frequencies
+    from f0.
+    """
+    # The data are heterodyned down by f0 (Press & Rybicki 1989).
+    shift = np.exp(2j * np.pi * f0 * tau)
+
+    return tables[0].sums(w * shift, nf), tables[1].sums(w * shift * shift, nf)
+
+
+class _Tables(object):
+    """
+    Extirpolation tables of the times tau and 2 tau, and the window sums of
+    each block of frequencies, computed on first use.
+    """
+    def __init__(self, tau, w, df, nfft, keep_window=False):
+        self.tau = tau
+        self.w = w
+        self.extirp = (_Extirpolation(tau, df, nfft),
+                       _Extirpolation(2. * tau, df, nfft))
+        self.keep_window = keep_window
+        self.windows = {}
+
+    def window(self, f0, nf):
+        key = (f0, nf)
+        if key in self.windows:
+            return self.windows[key]
+
+        window = _window(self.extirp, self.tau, self.w, f0, nf)
+        if self.keep_window:
+            self.windows[key] = window
+
+        return window
+
+
+def _tables(tau, w, df, nfft, cache=False):
+    """
+    Tables for light curves with times tau and weights w. With `cache`,
+    tables are kept for reuse by later light curves with the same times and
+    weights.
+    """
+    if not cache:
+        return _Tables(tau, w, df, nfft)
+
+    key = (hashlib.sha1(tau.tobytes()).hexdigest(),
+           hashlib.sha1(w.tobytes()).hexdigest(), df, nfft)
+    with _table_lock:
+        tables = _table_cache.pop(key, None)
+    if tables is None:
+        tables = _Tables(tau, w, df, nfft, keep_window=True)
+
+    with _table_lock:
+        _table_cache[key] = tables
+        while len(_table_cache) > _TABLE_CACHE_SIZE:
+            _table_cache.popitem(last=False)
+
+    return tables
+
+
+def _power(tables, y, f0, nf):
+    """
+    Floating-mean Lomb-Scargle power, normalized as in gatspy, on nf
+    frequencies of the tables' spacing from f0. `y` has zero weighted mean.
+    """
+    # The power does not depend on the time origin, so the sums need no
+    # phase correction back from tau to the original times.
+    tau, w = tables.tau, tables.w
+    window, window2 = tables.window(f0, nf)
+    shift = np.exp(2j * np.pi * f0 * tau)
+    sums = tables.extirp[0].sums(w * y * shift, nf)
+
+    return _sums_power(window, window2, sums, np.dot(w, y * y))
+
+
+def _sums_power(window, window2, sums, YY):
+    """
+    Floating-mean Lomb-Scargle power from the window sums, the data sums
+    over w * y * exp(i omega tau), and the weighted sum of squares YY.
+    """
+    C, S = window.real, window.imag
+    C2, S2 = window2.real, window2.imag
+    Ch, Sh = sums.real, sums.imag
+
+    # Phase offset tau of Zechmeister & Kurster (2009), for a floating mean.
+    two_omega_tau = np.arctan2(S2 - 2. * S * C, C2 - (C * C - S * S))
+    C2w = np.cos(two_omega_tau)
+    S2w = np.sin(two_omega_tau)
+    Cw = np.cos(0.5 * two_omega_tau)
+    Sw = np.sin(0.5 * two_omega_tau)
+
+    YC = Ch * Cw + Sh * Sw
+    YS = Sh * Cw - Ch * Sw
+    CC = 0.5 * (1. + C2 * C2w + S2 * S2w) - (C * Cw + S * Sw) ** 2
+    SS = 0.5 * (1. - C2 * C2w - S2 * S2w) - (S * Cw - C * Sw) ** 2
+
+    return (YC * YC / CC + YS * YS / SS) / YY
+
+
+def _log_indices(f0, df, nf, oversampling):
+    """
+    Indices into a linear frequency grid that are spaced evenly in log
+    frequency, `oversampling` points per peak width at the lowest frequency.
+    """
+    fmax = f0 + df * (nf - 1)
+    ratio = 1. + df / f0
+    num = int(np.ceil(np.log(fmax / f0) / np.log(ratio))) + 1
+    freqs = f0 * ratio ** np.arange(num)
+    index = np.round((freqs - f0) / df).astype(np.int64)
+
+    return np.unique(np.clip(index, 0, nf - 1))
+
+
+def _refine_peaks(index, power, f0, df):
+    """
+    Frequencies of the local maxima at `index`, refined with a parabola
+    through the neighboring power values.
+    """
+    left, mid, right = power[index - 1], power[index], power[index + 1]
+    curve = left - 2. * mid + right
+
+    shift = np.zeros(index.size)
+    ok = curve < 0
+    shift[ok] = 0.5 * (left - right)[ok] / curve[ok]
+
+    return f0 + df * (index + shift)
+
+
+def _weighted(time, flux, err):
+    """
+    Times from zero, normalized weights and weighted-mean-subtracted fluxes.
+    """
+    time = np.asarray(time, dtype=np.float64)
+    flux = np.asarray(flux, dtype=np.float64)
+    if err is None:
+        w = np.ones_like(flux)
+    else:
+        w = 1. / np.asarray(err, dtype=np.float64) ** 2
+    w /= w.sum()
+
+    return time - time.min(), w, flux - np.dot(w, flux)
+
+
+def _periodogram(time, flux, err, f0, df, nf, keep, npeaks, block, power,
+                 cache=False):
+    """
+    Fill `power` with the power at grid indices `keep`, block by block, and
+    return the frequencies of the highest peaks, highest first. If `keep`
+    leaves out grid points, each kept point gets the highest power of the
+    grid points nearest to it, so that sparse grids lose no peaks.
+    """
+    tau, w, y = _weighted(time, flux, err)
+    if keep.size < nf:
+        edges = np.append(0, (keep[1:] + keep[:-1] + 1) // 2)
+        power[:] = 0.
+
+    # Every block has the same FFT length, so the tables serve them all.
+    block = min(block, nf)
+    tables = _tables(tau, w, df, _fft_size(block + 2), cache=cache)
+
+    peak_freqs = np.empty(0)
+    peak_power = np.empty(0)
+
+    for start in range(0, nf, block):
+        stop = min(start + block, nf)
+
+        # One extra frequency on each side, to find peaks at block edges.
+        lo, hi = max(start - 1, 0), min(stop + 1, nf)
+        pw = _power(tables, y, f0 + lo * df, hi - lo)
+
+        if keep.size < nf:
+            bins = np.arange(np.searchsorted(edges, start, 'right') - 1,
+                             np.searchsorted(edges, stop - 1, 'right'))
+            runs = np.maximum(edges[bins], start) - start
+            power[bins] = np.maximum(power[bins], np.maximum.reduceat(
+                pw[start - lo:stop - lo], runs))
+        else:
+            power[start:stop] = pw[start - lo:stop - lo]
+
+        index = np.arange(max(start, 1), min(stop, nf - 1)) - lo
+        index = index[(pw[index] > pw[index - 1]) &
+                      (pw[index] >= pw[index + 1])]
+        if index.size > npeaks:
+            index = index[np.argsort(pw[index])[-npeaks:]]
+
+        peak_freqs = np.concatenate((peak_freqs,
+                                     _refine_peaks(index, pw, f0 + lo * df,
+                                                   df)))
+        peak_power = np.concatenate((peak_power, pw[index]))
+
+    best = np.argsort(peak_power)[::-1][:npeaks]
+
+    return peak_freqs[best]
+
+
+def lomb_scargle(time, flux, err=None, pmin=None, pmax=None, oversampling=5,
+                 log=False, npeaks=1, dtype=np.float64, block=2 ** 18):
+    """
+    Floating-mean Lomb-Scargle periodogram and its highest peaks.
+
+    The periodogram is computed with FFTs of extirpolated data (Press &
+    Rybicki 1989), one block of frequencies at a time, so the working memory
+    is set by `block` rather than by the size of the grid. The peaks come out
+    of the same pass, so no separate optimizer run is needed to find the best
+    period.
+
+    Parameters
+    ----------
+    time : array_like
+        Observation times in days.
+    flux : array_like
+        Fluxes.
+    err : array_like, optional
+        Flux errors. Default is to weight all points equally.
+    pmin, pmax : float, optional
+        Period range in days. See `frequency_grid` for the defaults.
+    oversampling : float, optional
+        Number of grid points per peak width. (Default: 5)
+    log : bool, optional
+        If True, return the power on a grid evenly spaced in log frequency,
+        `oversampling` points per peak width at `pmax` and sparser at shorter
+        periods. Each point holds the highest power of the linear grid
+        points nearest to it, so that short-period peaks keep their height.
+        The peaks are still found on the full linear grid.
+        (Default: False)
+    npeaks : int, optional
+        Number of peaks to return. (Default: 1)
+    dtype : {numpy.float64, numpy.float32}, optional
+        Precision of the returned arrays. The sums are always accumulated in
+        double precision. (Default: numpy.float64)
+    block : int, optional
+        Number of frequencies computed at a time. (Default: 2**18)
+
+    Returns
+    -------
+    period : ndarray
+        The grid periods in days, in order of increasing frequency.
+    power : ndarray
+        The normalized power at each period.
+    peaks : ndarray
+        Periods of the `npeaks` highest local maxima of the power, highest
+        first, refined between grid points.
+
+    """
+    f0, df, nf = frequency_grid(time, pmin, pmax, oversampling)
+    if log:
+        keep = _log_indices(f0, df, nf, oversampling)
+    else:
+        keep = np.arange(nf)
+
+    power = np.empty(keep.size, dtype=dtype)
+    peak_freqs = _periodogram(time, flux, err, f0, df, nf, keep, npeaks,
+                              block, power)
+
+    period = (1. / (f0 + df * keep)).astype(dtype)
+    peaks = (1. / peak_freqs).astype(dtype)
+
+    return period, power, peaks
+
+
+def spectral_window(time, err=None, pmin=None, oversampling=5, npeaks=5,
+                    min_power=0.0, block=2 ** 18):
+    """
+    Highest peaks of the spectral window of a set of observation times.
+
+    The spectral window, |sum(w * exp(2 pi i f t))|**2 with the weights w
+    normalized to sum to one, is the periodogram of the sampling pattern.
+    Each peak of a periodogram is echoed at its frequency plus and minus
+    those of the peaks of the window, with about the power of the peak
+    times that of the window, so gaps that recur, e.g. eclipses cut every
+    orbit, give aliases of strong signals.
+
+    Parameters
+    ----------
+    time : array_like
+        Observation times in days.
+    err : array_like, optional
+        Flux errors, for the weights. Default is to weight all points
+        equally.
+    pmin : float, optional
+        Shortest period, so that 1 / pmin is the largest frequency
+        searched. (Default: twice the median cadence)
+    oversampling : float, optional
+        Number of grid points per peak width. (Default: 5)
+    npeaks : int, optional
+        Number of peaks to return. (Default: 5)
+    min_power : float, optional
+        Lowest window power of a peak. (Default: 0.0)
+    block : int, optional
+        Number of frequencies computed at a time. (Default: 2**18)
+
+    Returns
+    -------
+    freqs : ndarray
+        Frequencies of the highest peaks in 1 / days, highest first,
+        leaving out the central peak at zero frequency.
+    power : ndarray
+        The window power at each peak, relative to 1 at zero frequency.
+
+    """
+    tau, w, y = _weighted(time, np.zeros(np.size(time)), err)
+    if pmin is None:
+        pmin = 2. * np.median(np.diff(np.sort(tau)))
+
+    # The grid starts at the first zero of the central peak, 1 / baseline.
+    f0, df, nf = _grid(tau.max(), pmin, tau.max(), oversampling)
+    block = min(block, nf)
+    extirp = _Extirpolation(tau, df, _fft_size(block + 2))
+
+    peak_freqs = np.empty(0)
+    peak_power = np.empty(0)
+
+    for start in range(0, nf, block):
+        stop = min(start + block, nf)
+        lo, hi = max(start - 1, 0), min(stop + 1, nf)
+        shift = np.exp(2j * np.pi * (f0 + lo * df) * tau)
+        pw = np.abs(extirp.sums(w * shift, hi - lo)) ** 2
+
+        index = np.arange(max(start, 1), min(stop, nf - 1)) - lo
+        index = index[(pw[index] > pw[index - 1]) &
+                      (pw[index] >= pw[index + 1]) &
+                      (pw[index] >= min_power)]
+        if index.size > npeaks:
+            index = index[np.argsort(pw[index])[-npeaks:]]
+
+        peak_freqs = np.concatenate((peak_freqs,
+                                     _refine_peaks(index, pw, f0 + lo * df,
+                                                   df)))
+        peak_power = np.concatenate((peak_power, pw[index]))
+
+    best = np.argsort(peak_power)[::-1][:npeaks]
+
+    return peak_freqs[best], peak_power[best]
+
+
+def _fit_sines(tau, w, y, freqs):
+    """
+    Weighted least-squares fit of a constant and sinusoids at `freqs` to y.
+    Returns the coefficients of 1, cos(2 pi f tau) and sin(2 pi f tau) for
+    each frequency in turn, and the model.
+    """
+    omega_tau = 2. * np.pi * np.outer(tau, freqs)
+    design = np.empty((tau.size, 2 * len(freqs) + 1))
+    design[:, 0] = 1.
+    design[:, 1::2] = np.cos(omega_tau)
+    design[:, 2::2] = np.sin(omega_tau)
+
+    sqrt_w = np.sqrt(w)
+    coef = np.linalg.lstsq(design * sqrt_w[:, None], y * sqrt_w,
+                           rcond=None)[0]
+
+    return coef, np.dot(design, coef)
+
+
+def prewhiten(time, flux, err=None, nperiods=3, pmin=None, pmax=None,
+              oversampling=10, snr_width=1.0):
+    """
+    Extract the strongest periods of a light curve by prewhitening.
+
+    Each round takes the highest peak of the floating-mean Lomb-Scargle
+    periodogram, fits a sinusoid at that frequency and subtracts it. The
+    periodogram is not recomputed from the residuals: its sums over the data
+    are linear in the fluxes, so the sums of the subtracted sinusoid, which
+    are window sums shifted by its frequency, are taken off instead. The
+    window sums are computed once, so a round costs one pass over the
+    frequency grid and one over the data. The subtracted sinusoids are at
+    grid frequencies; at the end, all of them are fit again jointly at
+    their refined frequencies, with one linear least-squares solve.
+
+    Parameters
+    ----------
+    time : array_like
+        Observation times in days.
+    flux : array_like
+        Fluxes.
+    err : array_like, optional
+        Flux errors. Default is to weight all points equally.
+    nperiods : int, optional
+        Number of periods to extract. (Default: 3)
+    pmin, pmax : float, optional
+        Period range in days. See `frequency_grid` for the defaults.
+    oversampling : float, optional
+        Number of grid points per peak width. The finer the grid, the
+        closer the subtracted sinusoids are to the signal. (Default: 10)
+    snr_width : float, optional
+        Width in 1 / days of the frequency range around each peak in which
+        the noise is measured. (Default: 1.0)
+
+    Returns
+    -------
+    peaks : list of tuples
+        (period, amplitude, phase, snr) of each extracted sinusoid, in the
+        order found. The fluxes are modeled as their weighted mean plus
+        amplitude * sin(2 pi time / period + phase), summed over the
+        peaks. The SNR is the amplitude over the mean amplitude spectrum
+        of the residuals within `snr_width` of the frequency.
+
+    """
+    f0, df, nf = frequency_grid(time, pmin, pmax, oversampling)
+    tau, w, y = _weighted(time, flux, err)
+
+    # All sums are over nf frequencies, so one table serves them.
+    extirp = _Extirpolation(tau, df, _fft_size(nf))
+    shift = np.exp(2j * np.pi * f0 * tau)
+    # The window sums at f0 + j df, at j df, and at 2 f0 + j df for j < 2 nf.
+    window = extirp.sums(w * shift, nf)
+    lag = extirp.sums(w, nf)
+    shift2 = shift * shift
+    window_sum = np.concatenate(
+        (extirp.sums(w * shift2, nf),
+         extirp.sums(w * shift2 * np.exp(2j * np.pi * nf * df * tau), nf)))
+    window2 = window_sum[::2]
+    sums = extirp.sums(w * y * shift, nf)
+
+    index = np.arange(nf)
+    freqs = []
+    for ii in range(nperiods):
+        power = _sums_power(window, window2, sums, np.dot(w, y * y))
+        peak = np.argmax(power[1:-1]) + 1
+        freqs.append(_refine_peaks(np.array([peak]), power, f0, df)[0])
+
+        (mean, a, b), model = _fit_sines(tau, w, y, [f0 + peak * df])
+        y -= model
+
+        # Sums of the model: mean * window(f) + (a - ib) / 2 * window(f +
+        # f_peak) + (a + ib) / 2 * window(f - f_peak).
+        diff = index - peak
+        lag_diff = lag[np.abs(diff)]
+        lag_diff[diff < 0] = np.conj(lag_diff[diff < 0])
+        sums -= mean * window + 0.5 * (a - 1j * b) * window_sum[index + peak] \
+            + 0.5 * (a + 1j * b) * lag_diff
+
+    freqs = np.array(freqs)
+    tau, w, y = _weighted(time, flux, err)
+    coef, model = _fit_sines(tau, w, y, freqs)
+    amplitude = np.hypot(coef[1::2], coef[2::2])
+    phase = (np.arctan2(coef[1::2], coef[2::2]) -
+             2. * np.pi * freqs * np.min(time)) % (2. * np.pi)
+
+    noise_spec = 2. * np.abs(sums)
+    grid = f0 + df * index
+    snr = [amp / noise_spec[np.abs(grid - freq) <= 0.5 * snr_width].mean()
+           for amp, freq in zip(amplitude, freqs)]
+
+    return zip(1. / freqs, amplitude, phase, snr)
+
+
+def _next_size(n):
+    """
+    Smallest power of two that is at least n.
+    """
+    return 1 << int(np.ceil(np.log2(max(n, 1))))
+
+
+def autocorrelation(time, flux, pmin=None, pmax=None, smooth=0.1, npeaks=1,
+                    min_overlap=0.1, echo_ratio=0.8):
+    """
+    Autocorrelation function of a light curve with gaps, and its periods.
+
+    The fluxes are put on a grid of the median cadence, with a mask that is
+    zero in the gaps, e.g. the eclipses taken out by curve_cut. The
+    correlation at each lag is taken over the pairs of points that are both
+    observed, and normalized by their variances, with a few FFTs of the
+    grid, so the cost is O(N log N) in the number of cadences. It tapers
+    with the fraction of points in pairs at each lag. The ACF is
+    then smoothed with a Gaussian, and its local maxima are ranked by
+    height. A periodic signal also gives peaks at every multiple of its
+    period; peaks at a multiple of a shorter peak of at least `echo_ratio`
+    times their height are ranked last.
+
+    Parameters
+    ----------
+    time : array_like
+        Observation times in days, on a nearly regular cadence.
+    flux : array_like
+        Fluxes.
+    pmin, pmax : float, optional
+        Period range in days. (Default: twice the median cadence, and half
+        the time baseline)
+    smooth : float, optional
+        Standard deviation of the Gaussian smoothing, in days. 0 for no
+        smoothing. (Default: 0.1)
+    npeaks : int, optional
+        Number of periods to return. (Default: 1)
+    min_overlap : float, optional
+        Lags with fewer pairs of observed points than this fraction of the
+        number of points are left out. (Default: 0.1)
+    echo_ratio : float, optional
+        Height, relative to a peak, of a peak at an integer fraction of its
+        lag that makes it an echo. (Default: 0.8)
+
+    Returns
+    -------
+    lag : ndarray
+        The lags in days, up to `pmax`.
+    acf : ndarray
+        The smoothed, normalized autocorrelation at each lag, NaN where
+        there are too few pairs.
+    peaks : ndarray
+        Periods of the `npeaks` highest ranked peaks, highest first,
+        refined between lags. NaN where there are fewer peaks.
+
+    """
+    time = np.asarray(time, dtype=np.float64)
+    flux = np.asarray(flux, dtype=np.float64)
+
+    order = np.argsort(time)
+    time, flux = time[order], flux[order]
+    cadence = np.median(np.diff(time))
+    if pmin is None:
+        pmin = 2. * cadence
+    if pmax is None:
+        pmax = 0.5 * (time[-1] - time[0])
+
+    index = np.round((time - time[0]) / cadence).astype(np.int64)
+    ngrid = index[-1] + 1
+    nlag = min(int(np.floor(pmax / cadence)) + 1, ngrid)
+
+    x = np.zeros(ngrid)
+    x[index] = flux - flux.mean()
+    mask = np.zeros(ngrid)
+    mask[index] = 1.
+
+    # Zero padding keeps the circular correlations from wrapping around.
+    nfft = _next_size(ngrid + nlag)
+    fx = np.fft.rfft(x, nfft)
+    fm = np.fft.rfft(mask, nfft)
+    fx2 = np.fft.rfft(x * x, nfft)
+
+    def correlate(fa, fb):
+        # sum_i a_i b_(i + k) for k < nlag
+        return np.fft.irfft(np.conj(fa) * fb, nfft)[:nlag]
+
+    pairs = correlate(fm, fm)
+    cross = correlate(fx, fx)
+    # Variances of the earlier and the later point of the pairs at each lag.
+    var_early = correlate(fx2, fm)
+    var_late = correlate(fm, fx2)
+
+    # Scaling by the fraction of pairs tapers the ACF with lag, as in the
+    # usual biased estimate, so that multiples of a period rank lower.
+    with np.errstate(invalid='ignore', divide='ignore'):
+        acf = cross / np.sqrt(var_early * var_late) * (pairs / pairs[0])
+    acf[pairs < max(min_overlap * time.size, 2.)] = np.nan
+    lag = cadence * np.arange(nlag)
+
+    if smooth > 0:
+        width = smooth / cadence
+        kernel = np.exp(-0.5 * (np.arange(-int(4 * width), int(4 * width) +
+                                          1) / width) ** 2)
+        valid = np.isfinite(acf)
+        norm = np.convolve(valid, kernel, mode='same')
+        with np.errstate(invalid='ignore', divide='ignore'):
+            acf = np.convolve(np.where(valid, acf, 0.), kernel,
+                              mode='same') / norm
+        acf[~valid] = np.nan
+
+    # Local maxima, and their height above the minima on either side.
+    # Comparisons with NaN are false, so no extrema are found in the gaps.
+    peaks = np.nan * np.ones(npeaks)
+    with np.errstate(invalid='ignore'):
+        slope = np.sign(np.diff(acf))
+        turning = np.flatnonzero(slope[1:] != slope[:-1]) + 1
+        maxima = turning[(slope[turning - 1] > 0) & (slope[turning] <= 0)]
+        minima = turning[(slope[turning - 1] < 0) & (slope[turning] >= 0)]
+    maxima = maxima[(lag[maxima] >= pmin) & (lag[maxima] <= pmax) &
+                    (maxima < nlag - 1)]
+
+    if maxima.size:
+        period = _refine_peaks(maxima, acf, 0., cadence)
+        height = acf[maxima]
+        order = np.argsort(height, kind='mergesort')[::-1]
+        top = order[:max(10 * npeaks, 50)]
+
+        # A peak at a multiple of a shorter one that is nearly as high is an
+        # echo of that period, and ranks after the other peaks.
+        with np.errstate(invalid='ignore', divide='ignore'):
+            multiple = period[top, None] / period[None, :]
+            harmonic = np.round(multiple)
+            echo = ((harmonic >= 2) &
+                    (np.abs(multiple / harmonic - 1.) < 0.05) &
+                    (height[None, :] >= echo_ratio * height[top, None])
+                    ).any(axis=1)
+        top = np.concatenate((top[~echo], top[echo]))
+
+        found = period[top[:npeaks]]
+        peaks[:found.size] = found
+
+    return lag, acf, peaks
+
+
+def _segment_task(args):
+    """
+    Sums over the points of one group, e.g. one quarter, split into the
+    segments of spectrogram. Returns the segments touched and their sums.
+    """
+    tau, w, y, segment, k0, df, nf = args
+    nfft = _fft_size(k0 + nf)
+    freq = slice(k0, k0 + nf)
+    # Index -k of the FFT, for k in the grid.
+    mirror = (nfft - np.arange(k0, k0 + nf)) % nfft
+
+    segments = np.unique(segment)
+    sums = np.empty((3, segments.size, nf), dtype=np.complex128)
+    scalars = np.empty((4, segments.size))
+    for ii, seg in enumerate(segments):
+        sel = segment == seg
+        t, ws, ys = tau[sel], w[sel], y[sel]
+        extirp = _Extirpolation(t, df, nfft)
+
+        # The grid starts at a multiple of df, so no heterodyning is
+        # needed and the inputs are real: the window and data sums share
+        # one complex FFT, and the sums at 2 tau take a real one.
+        both = extirp.grid(ws) + 1j * extirp.grid(ws * ys)
+        both = nfft * np.fft.ifft(both)
+        sums[0, ii] = 0.5 * (both[freq] + np.conj(both[mirror]))
+        sums[2, ii] = -0.5j * (both[freq] - np.conj(both[mirror]))
+        sums[1, ii] = np.conj(np.fft.rfft(
+            _Extirpolation(2. * t, df, nfft).grid(ws))[freq])
+        scalars[:, ii] = (t.size, ws.sum(), np.dot(ws, ys),
+                          np.dot(ws, ys * ys))
+
+    return segments, sums, scalars
+
+
+def spectrogram(time, flux, err=None, quarter=None, window=90., step=10.,
+                pmin=None, pmax=None, oversampling=5, min_points=100,
+                dtype=np.float32, processes=None):
+    """
+    Lomb-Scargle periodograms of a light curve in sliding time windows.
+
+    The light curve is split into segments of `step` days, and each window
+    is `window` / `step` consecutive segments. The sums of the
+    floating-mean Lomb-Scargle periodogram add up over segments, so they
+    are computed once per segment, with FFTs on one frequency grid, and
+    the sums of every window come from running totals over the segments.
+    The cost is then nearly independent of the overlap of the windows. The
+    segments of each quarter are computed in a pool of processes.
+
+    Parameters
+    ----------
+    time : array_like
+        Observation times in days.
+    flux : array_like
+        Fluxes.
+    err : array_like, optional
+        Flux errors. Default is to weight all points equally.
+    quarter : array_like, optional
+        Kepler quarter of each point, which sets the groups of points
+        computed in parallel. (Default: one group per process)
+    window : float, optional
+        Length of the windows in days, rounded to a multiple of `step`.
+        (Default: 90.0)
+    step : float, optional
+        Shift in days from one window to the next. (Default: 10.0)
+    pmin, pmax : float, optional
+        Period range in days. The grid starts at a multiple of its spacing,
+        at or just beyond pmax. (Default: twice the median cadence, and the
+        window length)
+    oversampling : float, optional
+        Number of grid points per peak width of a window. (Default: 5)
+    min_points : int, optional
+        Windows with fewer points have NaN power. (Default: 100)
+    dtype : {numpy.float32, numpy.float64}, optional
+        Type of the power matrix. (Default: numpy.float32)
+    processes : int, optional
+        Number of worker processes. (Default: number of CPUs)
+
+    Returns
+    -------
+    center : ndarray
+        Middle time of each window.
+    period : ndarray
+        The grid periods in days, in order of increasing frequency.
+    power : ndarray
+        The normalized power, with shape (n_windows, n_freq).
+    peaks : ndarray
+        Period of the highest peak in each window, refined between grid
+        points, or NaN.
+
+    """
+    time = np.asarray(time, dtype=np.float64)
+    flux = np.asarray(flux, dtype=np.float64)
+
+    nstep = max(int(round(window / step)), 1)
+    window = nstep * step
+    if pmin is None:
+        pmin = 2. * np.median(np.diff(np.sort(time)))
+    if pmax is None:
+        pmax = window
+    f0, df, nf = _grid(window, pmin, pmax, oversampling)
+    # Start the grid at a multiple of df; see _segment_task.
+    k0 = max(int(np.floor(f0 / df)), 1)
+    f0 = k0 * df
+    nf = int(np.floor((1. / pmin - f0) / df)) + 1
+
+    # Subtracting the overall mean keeps the sums of squares accurate.
+    tau, w, y = _weighted(time, flux, err)
+    segment = np.floor(tau / step).astype(np.int64)
+    nseg = segment.max() + 1
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if quarter is not None:
+        groups = [quarter == qq for qq in np.unique(quarter)]
+    else:
+        bounds = np.linspace(0, nseg, min(processes, nseg) + 1).astype(int)
+        groups = [(segment >= lo) & (segment < hi)
+                  for lo, hi in zip(bounds[:-1], bounds[1:])]
+    tasks = [(tau[group], w[group], y[group], segment[group], k0, df, nf)
+             for group in groups if group.any()]
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(_segment_task, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+    # Running totals over the segments, with a leading zero. A segment
+    # split between quarters gets the sums of both.
+    sums = np.zeros((3, nseg + 1, nf), dtype=np.complex128)
+    scalars = np.zeros((4, nseg + 1))
+    for segments, seg_sums, seg_scalars in results:
+        sums[:, segments + 1] += seg_sums
+        scalars[:, segments + 1] += seg_scalars
+    sums = np.cumsum(sums, axis=1)
+    scalars = np.cumsum(scalars, axis=1)
+
+    # Window j covers segments j ... j + nstep - 1.
+    nwin = max(nseg - nstep + 1, 1)
+    stop = np.minimum(np.arange(nwin) + nstep, nseg)
+    window_sums = sums[:, stop] - sums[:, :nwin]
+    count, W, Y, YY = scalars[:, stop] - scalars[:, :nwin]
+
+    # Normalize the weights of each window, and take out its mean.
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (Y / W)[:, None]
+        window1 = window_sums[0] / W[:, None]
+        window2 = window_sums[1] / W[:, None]
+        data = window_sums[2] / W[:, None] - mean * window1
+        power = _sums_power(window1, window2, data,
+                            (YY / W)[:, None] - mean ** 2)
+    power[count < min_points] = np.nan
+
+    peaks = np.nan * np.ones(nwin)
+    ok = np.flatnonzero(np.isfinite(power[:, 1:-1]).all(axis=1))
+    if ok.size:
+        index = np.argmax(power[ok, 1:-1], axis=1) + 1
+        for row, idx in zip(ok, index):
+            peaks[row] = 1. / _refine_peaks(np.array([idx]), power[row], f0,
+                                            df)[0]
+
+    center = time.min() + step * (np.arange(nwin) + 0.5 * nstep)
+    period = 1. / (f0 + df * np.arange(nf))
+
+    return center, period, power.astype(dtype), peaks
+
+
+def _many_task(args):
+    """
+    Compute one row of the power matrix for lomb_scargle_many. The row is
+    written to the memory-mapped matrix if there is one, else returned.
+    """
+    (row, time, flux, err, grid, log, oversampling, npeaks, dtype, block,
+     filename) = args
+    f0, df, nf = grid
+
+    if log:
+        keep = _log_indices(f0, df, nf, oversampling)
+    else:
+        keep = np.arange(nf)
+
+    if filename is None:
+        power = np.empty(keep.size, dtype=dtype)
+    else:
+        power = np.load(filename, mmap_mode='r+')[row]
+
+    peak_freqs = _periodogram(time, flux, err, f0, df, nf, keep, npeaks,
+                              block, power, cache=True)
+
+    peaks = np.nan * np.ones(npeaks)
+    peaks[:peak_freqs.size] = 1. / peak_freqs
+
+    if filename is None:
+        return power, peaks
+    else:
+        power.flush()
+        return None, peaks
+
+
+def lomb_scargle_many(curves, pmin=None, pmax=None, oversampling=5,
+                      log=False, npeaks=1, dtype=np.float32, block=2 ** 18,
+                      processes=None, threads=False, cut_eclipses=True,
+                      filename=None, max_bytes=2 ** 30):
+    """
+    Lomb-Scargle periodograms of many light curves on one frequency grid.
+
+    All light curves share the frequency grid, so their power spectra stack
+    into a single (n_curves, n_freq) matrix. The extirpolation tables and
+    the window sums depend only on the observation times and weights, and
+    are reused between light curves that share them, e.g. simulated light
+    curves with the same cadence; each further light curve then costs one
+    FFT per block of frequencies instead of three. The periodograms are
+    computed in a pool of processes, or threads, and written straight into
+    the matrix, which is a memory-mapped .npy file when large.
+
+    Parameters
+    ----------
+    curves : sequence of LightCurve or (time, flux, err) tuples
+        The light curves. `err` may be None.
+    pmin, pmax : float, optional
+        Period range in days. (Default: twice the shortest median cadence,
+        and the longest time baseline)
+    oversampling : float, optional
+        Number of grid points per peak width of the light curve with the
+        longest baseline. (Default: 5)
+    log, npeaks, block
+        As for `lomb_scargle`.
+    dtype : {numpy.float32, numpy.float64}, optional
+        Type of the power matrix. (Default: numpy.float32)
+    processes : int, optional
+        Number of workers. (Default: number of CPUs)
+    threads : bool, optional
+        Use a pool of threads rather than processes. (Default: False)
+    cut_eclipses : bool, optional
+        Remove the eclipses from LightCurve objects, as in
+        LightCurve.periodogram. (Default: True)
+    filename : str, optional
+        Write the power matrix to this .npy file, and return it memory
+        mapped. (Default: a temporary file, if the matrix is larger than
+        `max_bytes`)
+    max_bytes : int, optional
+        Largest power matrix kept in memory. (Default: 1 GB)
+
+    Returns
+    -------
+    period : ndarray
+        The grid periods in days, in order of increasing frequency.
+    power : ndarray or numpy.memmap
+        The normalized power, one row per light curve. If memory mapped,
+        `power.filename` is the file, which the caller should remove.
+    peaks : ndarray
+        Periods of the `npeaks` highest peaks of each light curve, highest
+        first, with shape (n_curves, npeaks). Missing peaks are NaN.
+
+    """
+    data = []
+    for curve in curves:
+        if hasattr(curve, 'curve_cut'):
+            if cut_eclipses:
+                time, flux, err, quarter = curve.curve_cut()
+            else:
+                time, flux, err = curve.time, curve.flux, curve.err
+        else:
+            time, flux, err = curve
+        data.append((np.asarray(time, dtype=np.float64), flux, err))
+
+    baseline = max(time.max() - time.min() for time, flux, err in data)
+    if pmin is None:
+        pmin = min(2. * np.median(np.diff(np.sort(time)))
+                   for time, flux, err in data)
+    if pmax is None:
+        pmax = baseline
+
+    grid = _grid(baseline, pmin, pmax, oversampling)
+    f0, df, nf = grid
+    if log:
+        keep = _log_indices(f0, df, nf, oversampling)
+    else:
+        keep = np.arange(nf)
+
+    shape = (len(data), keep.size)
+    if filename is None and \
+            shape[0] * shape[1] * np.dtype(dtype).itemsize > max_bytes:
+        fd, filename = tempfile.mkstemp(suffix='.npy')
+        os.close(fd)
+    if filename is not None:
+        power = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype,
+                                          shape=shape)
+        power.flush()
+    else:
+        power = np.empty(shape, dtype=dtype)
+
+    # Light curves with the same times go to the same worker, one after
+    # another, so that they reuse its cached extirpolation tables.
+    order = sorted(range(len(data)), key=lambda ii: (data[ii][0].size,
+                                                    data[ii][0][0],
+                                                    data[ii][0][-1]))
+    tasks = [(ii,) + data[ii] + (grid, log, oversampling, npeaks, dtype,
+                                 block, filename) for ii in order]
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if threads:
+        pool = multiprocessing.pool.ThreadPool(processes)
+    else:
+        pool = multiprocessing.Pool(processes)
+    try:
+        chunksize = max(1, len(tasks) // (4 * processes))
+        results = pool.map(_many_task, tasks, chunksize)
+    finally:
+        pool.close()
+        pool.join()
+        with _table_lock:
+            _table_cache.clear()
+
+    peaks = np.empty((len(data), npeaks))
+    for ii, (row, row_peaks) in zip(order, results):
+        if row is not None:
+            power[ii] = row
+        peaks[ii] = row_peaks
+
+    if filename is not None:
+        # Reopen, to see the rows written by the workers.
+        power = np.load(filename, mmap_mode='r+')
+
+    period = (1. / (f0 + df * keep)).astype(dtype)
+
+    return period, power, peaks
@@ -0,0 +1,534 @@
+"""
+Catalog-wide search for eclipsing binaries with three distinct periods.
+
+Each target goes through fetch (data.loadlc_db, with cleaning by
+normalize_lc), eclipse cut (LightCurve.curve_cut), periodogram with
+multi-peak extraction (periodogram.lomb_scargle), and rejection of orbital
+aliases, harmonics and aliases from the spectral window of the cut light
+curve (periodogram.spectral_window). A system is a candidate if, besides the orbit, at
+least two distinct, non-harmonic periods remain, as expected for spots on
+both stars.
+
+Fetching runs in a pool of threads, since it mostly waits on the database
+or the disk, and feeds the rest of the search to a pool of processes, so
+the two overlap. The result of each target is written to a ResultStore as
+soon as it is done, and targets already in the store are skipped, so an
+interrupted run resumes where it stopped.
+"""
+import glob
+import json
+import multiprocessing
+import multiprocessing.pool
+import os
+import Queue
+import tempfile
+import threading
+import time as timer
+
+import numpy as np
+import pandas as pd
+
+from binaries import RealBinary
+import data
+from periodogram import lomb_scargle, spectral_window
+
+
+class ResultStore(object):
+    """
+    Results of the period search, one JSON file per target.
+
+    Each result is written atomically, so an interrupted run leaves only
+    whole results behind.
+
+    Parameters
+    ----------
+    path : string
+        Directory of the store. Created if needed.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _path(self, kic):
+        return os.path.join(self.path, '{0:09d}.json'.format(int(kic)))
+
+    def kics(self):
+        """
+        Return the KIC IDs with a result, sorted.
+        """
+        return sorted(int(os.path.basename(fname)[:-5]) for fname in
+                      glob.glob(os.path.join(self.path, '*.json')))
+
+    def __contains__(self, kic):
+        return os.path.exists(self._path(kic))
+
+    def load(self, kic):
+        """
+        Return the result of one target, as a dictionary.
+        """
+        with open(self._path(kic)) as fobj:
+            return json.load(fobj)
+
+    def write(self, result):
+        """
+        Store a result, replacing any earlier one of the same target.
+        """
+        fd, tmp = tempfile.mkstemp(prefix='.tmp', suffix='.json',
+                                   dir=self.path)
+        with os.fdopen(fd, 'w') as fobj:
+            json.dump(result, fobj)
+        os.rename(tmp, self._path(result['kic']))
+
+    def table(self):
+        """
+        Return all results as a table, one row per target.
+
+        The peak periods, powers and labels are lists, highest peak first.
+        """
+        results = [self.load(kic) for kic in self.kics()]
+        columns = ['kic', 'status', 'p_orb', 'npoints', 'baseline',
+                   'ndistinct', 'score', 'candidate', 'periods', 'powers',
+                   'labels', 'window', 'elapsed', 'error']
+
+        return pd.DataFrame(results, columns=columns)
+
+    def peaks(self):
+        """
+        Return the peaks of all searched targets as arrays, e.g. to
+        reclassify them with classify_peaks.
+
+        Returns
+        -------
+        kics, p_orb, baseline : ndarray
+            KIC ID, orbital period and time baseline (for the resolution
+            of classify_peaks) of each target with peaks.
+        periods, powers : ndarray
+            Peak periods and powers, one row per target, highest peak
+            first, padded with NaN.
+        window : ndarray
+            Frequencies of the peaks of the spectral window of each target,
+            padded with NaN, for the window of classify_peaks.
+
+        """
+        results = [result for result in
+                   (self.load(kic) for kic in self.kics())
+                   if result.get('periods')]
+        npeaks = max([len(result['periods']) for result in results] or [0])
+
+        periods = np.nan * np.ones((len(results), npeaks))
+        powers = np.nan * np.ones((len(results), npeaks))
+        nwindow = max([len(result.get('window', [])) for result in results] or
+                      [0])
+        window = np.nan * np.ones((len(results), nwindow))
+        for row, result in enumerate(results):
+            periods[row, :len(result['periods'])] = result['periods']
+            powers[row, :len(result['powers'])] = result['powers']
+            window[row, :len(result.get('window', []))] = \
+                result.get('window', [])
+
+        kics = np.array([result['kic'] for result in results], dtype=int)
+        p_orb = np.array([result['p_orb'] for result in results])
+        baseline = np.array([result['baseline'] for result in results])
+
+        return kics, p_orb, baseline, periods, powers, window
+
+
+# Labels of classify_peaks, by code.
+PEAK_LABELS = ('distinct', 'orbital', 'harmonic', 'combination', 'weak',
+               'none')
+
+
+def _ratios(max_order):
+    """
+    The distinct ratios n / m of integers 1 <= n, m <= max_order.
+    """
+    orders = np.arange(1, max_order + 1)
+    return np.unique(np.divide.outer(orders, orders.astype(float)))
+
+
+def classify_peaks(periods, p_orb, powers=None, tol=0.02, max_order=4,
+                   min_power=0.0, resolution=1. / 1470, window=None):
+    """
+    Classify the periodogram peaks of many targets at once.
+
+    The peak frequencies of all targets are compared in one pass against
+    tables of candidate frequencies: n / m times the orbital frequency
+    ('orbital'), n / m times a stronger peak of the same target
+    ('harmonic'), for integers n and m up to `max_order`, and sums and
+    differences of two stronger peaks, or of a stronger peak and once or
+    twice the orbital frequency or a peak of the spectral `window`
+    ('combination'), the last being aliases from the sampling. A peak is
+    an orbital
+    alias or a harmonic if its frequency is within `tol` (relative) of a
+    candidate, and a combination if it is within `resolution`. Peaks with
+    less than `min_power` times the power of the highest peak of their
+    target are 'weak', which leaves out noise and the sidelobes of strong
+    peaks, and are not used as stronger peaks. Other peaks are 'distinct'.
+    A peak that fits more than one class gets the first of 'none', 'weak',
+    'orbital', 'harmonic' and 'combination' that it fits.
+
+    Parameters
+    ----------
+    periods : array_like
+        Peak periods in days, with shape (n_targets, n_peaks), highest peak
+        first. Rows with fewer peaks are padded with NaN.
+    p_orb : array_like
+        Orbital period of each target in days.
+    powers : array_like, optional
+        Periodogram power of each peak. (Default: all equal)
+    tol : float, optional
+        Relative tolerance of a match. (Default: 0.02)
+    max_order : int, optional
+        Largest harmonic considered. (Default: 4)
+    min_power : float, optional
+        Power of the weakest peak considered, relative to the highest.
+        (Default: 0.0)
+    resolution : float or array_like, optional
+        Tolerance of a combination frequency in 1 / days, for all targets
+        or one per target; about 1 / T for light curves T days long.
+        (Default: 1 / 1470, for the 4 years of Kepler)
+    window : array_like, optional
+        Frequencies of the peaks of the spectral window in 1 / days, for
+        all targets or one row per target, padded with NaN; see
+        periodogram.spectral_window. (Default: none)
+
+    Returns
+    -------
+    labels : ndarray
+        Index into PEAK_LABELS of each peak, with the shape of `periods`.
+    score : ndarray
+        Triplet score of each target: the power of its second strongest
+        distinct peak relative to its highest peak, or 0 with fewer than
+        two distinct peaks. Together with the orbit, two distinct peaks
+        make the three non-harmonic periods sought.
+
+    Examples
+    --------
+    Spots at 2.3 and 5.1 days on a 1.59 day binary are both distinct,
+    while a peak at the sum of the orbital and a spot frequency is not.
+
+    >>> periods = [[2.3, 5.1, 1. / (1. / 1.59 + 1. / 2.3)]]
+    >>> labels, score = classify_peaks(periods, 1.59)
+    >>> [PEAK_LABELS[code] for code in labels[0]]
+    ['distinct', 'distinct', 'combination']
+
+    With eclipses cut from a 3.556 day binary, the spectral window has
+    peaks at 0.0261 / day and three times the orbital frequency, which
+    echo the 2.3 day spot at 2.447 days and the 5.1 day spot at 0.962 days.
+
+    >>> periods = [[2.3, 5.1, 2.447, 0.962]]
+    >>> labels, score = classify_peaks(periods, 3.556)
+    >>> [PEAK_LABELS[code] for code in labels[0]]
+    ['distinct', 'distinct', 'distinct', 'distinct']
+    >>> labels, score = classify_peaks(periods, 3.556,
+    ...                                window=[0.0261, 3. / 3.556])
+    >>> [PEAK_LABELS[code] for code in labels[0]]
+    ['distinct', 'distinct', 'combination', 'combination']
+
+    """
+    periods = np.atleast_2d(np.asarray(periods, dtype=float))
+    p_orb = np.asarray(p_orb, dtype=float).reshape(-1, 1)
+    if powers is None:
+        powers = np.ones_like(periods)
+    powers = np.where(np.isfinite(periods),
+                      np.atleast_2d(np.asarray(powers, dtype=float)),
+                      -np.inf)
+    ratios = _ratios(max_order)
+    orders = np.arange(1, min(max_order, 2) + 1)
+    resolution = np.asarray(resolution, dtype=float).reshape(-1, 1, 1, 1)
+    if window is None:
+        window = np.empty((1, 0))
+    window = np.atleast_2d(np.asarray(window, dtype=float))[:, None, None, :]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        freq = 1. / periods
+        f_orb = 1. / p_orb
+
+        def near(candidates, axes):
+            """
+            True for each peak within tol of any of `candidates`, which
+            have the peaks along the second axis and their candidates along
+            `axes`.
+            """
+            target = freq.reshape(freq.shape + (1,) *
+                                  (candidates.ndim - 2))
+            return (np.abs(target / candidates - 1.) <= tol).any(axis=axes)
+
+        def combines(candidates):
+            # As near, for the [target, peak, parent, other] combinations.
+            return (np.abs(freq[:, :, None, None] - candidates) <=
+                    resolution).any(axis=(2, 3))
+
+        none = ~np.isfinite(freq)
+        top = powers.max(axis=1)[:, None]
+        weak = ~none & (powers < min_power * top)
+
+        # Stronger peaks that may explain a peak: [target, peak, parent].
+        npeaks = freq.shape[1]
+        parent = np.tri(npeaks, k=-1, dtype=bool) & \
+            ~(none | weak)[:, None, :]
+        parent_freq = np.where(parent, freq[:, None, :], np.nan)
+
+        orbital = near((f_orb * ratios)[:, None, :], 2)
+        harmonic = near(parent_freq[..., None] * ratios, (2, 3))
+
+        # Sums and differences of two parents, [target, peak, parent,
+        # parent], and of a parent and orbital harmonics or window peaks.
+        pair_sum = parent_freq[:, :, :, None] + parent_freq[:, :, None, :]
+        pair_diff = np.abs(parent_freq[:, :, :, None] -
+                           parent_freq[:, :, None, :])
+        orbit_freq = (f_orb * orders)[:, None, None, :]
+        combination = combines(pair_sum) | combines(pair_diff) | \
+            combines(parent_freq[..., None] + orbit_freq) | \
+            combines(np.abs(parent_freq[..., None] - orbit_freq)) | \
+            combines(parent_freq[..., None] + window) | \
+            combines(np.abs(parent_freq[..., None] - window))
+
+    labels = np.zeros(freq.shape, dtype=np.int8)
+    for code, mask in ((3, combination), (2, harmonic), (1, orbital),
+                       (4, weak), (5, none)):
+        labels[mask] = code
+
+    distinct = np.sort(np.where(labels == 0, powers, -np.inf), axis=1)
+    if npeaks > 1:
+        second = distinct[:, -2]
+    else:
+        second = -np.inf * np.ones(freq.shape[0])
+    score = np.where(np.isfinite(second) & (top[:, 0] > 0),
+                     second / top[:, 0], 0.)
+
+    return labels, score
+
+
+def _fetch(args):
+    """
+    Load the light curve of one target. Returns (kic, curve, error).
+    """
+    kic, kwargs = args
+    try:
+        return kic, RealBinary(kic, **kwargs), None
+    except Exception as err:
+        return kic, None, '{0}: {1}'.format(type(err).__name__, err)
+
+
+def _search(args):
+    """
+    Cut the eclipses of one light curve and search it for periods. Always
+    returns a result, with status 'error' if the search failed.
+    """
+    (kic, curve, period_range, oversampling, npeaks, tol, max_order,
+     min_power) = args
+    start = timer.time()
+    result = dict(kic=kic, status='error', error=None)
+
+    try:
+        result.update(kic=int(kic), status='ok', p_orb=float(curve.p_orb),
+                      npoints=0, baseline=0.0, ndistinct=0, score=0.0,
+                      candidate=False, periods=[], powers=[], labels=[],
+                      window=[])
+        time, flux, err, quarter = curve.curve_cut()
+        result['npoints'] = int(time.size)
+        if time.size:
+            result['baseline'] = float(time.max() - time.min())
+        if time.size < 2 * npeaks + 3:
+            result['status'] = 'nodata'
+        else:
+            period, power, peaks = lomb_scargle(
+                time, flux, err, pmin=period_range[0], pmax=period_range[1],
+                oversampling=oversampling, npeaks=npeaks)
+
+            # Peaks of the sampling pattern, whose aliases of the strongest
+            # peak would otherwise pass as distinct. Aliases of window peaks
+            # below min_power are weak anyway.
+            window = spectral_window(
+                time, err, pmin=period_range[0], oversampling=oversampling,
+                npeaks=npeaks, min_power=min_power)[0]
+
+            # Power at the grid point nearest each peak.
+            freq = 1. / period
+            index = np.clip(np.searchsorted(freq, 1. / peaks), 1,
+                            freq.size - 1)
+            index -= (1. / peaks - freq[index - 1]) < (freq[index] -
+                                                       1. / peaks)
+            labels, score = classify_peaks(peaks, curve.p_orb, power[index],
+                                           tol, max_order, min_power,
+                                           1. / result['baseline'], window)
+
+            result['periods'] = [float(p) for p in peaks]
+            result['powers'] = [float(p) for p in power[index]]
+            result['labels'] = [PEAK_LABELS[code] for code in labels[0]]
+            result['window'] = [float(f) for f in window]
+            result['ndistinct'] = int((labels[0] == 0).sum())
+            result['score'] = float(score[0])
+            result['candidate'] = result['ndistinct'] >= 2
+    except Exception as err:
+        result['status'] = 'error'
+        result['error'] = '{0}: {1}'.format(type(err).__name__, err)
+
+    result['elapsed'] = timer.time() - start
+    return result
+
+
+def run_pipeline(store, kics=None, catfile='villanova-db.csv', pmin=0.0,
+                 pmax=None, source=None, cache=True,
+                 quality_mask=data.QUALITY_BITMASK, sigma_clip=None,
+                 period_range=(0.05, 45), oversampling=5, npeaks=10,
+                 tol=0.02, max_order=4, min_power=0.1, processes=None,
+                 fetch_threads=4, max_pending=None, retry=False, **kwargs):
+    """
+    Search the light curves of catalog systems for three distinct periods.
+
+    Targets already in `store` are skipped, so running again after an
+    interruption only processes the rest. At most `max_pending` light
+    curves are held in memory at a time.
+
+    Parameters
+    ----------
+    store : string or ResultStore
+        Where results are written, as each target finishes.
+    kics : sequence of ints, optional
+        Targets to search. (Default: the catalog systems with
+        pmin < p_orb < pmax)
+    catfile : string, optional
+        Name of catalog file. (Default: villanova-db.csv)
+    pmin, pmax : float, optional
+        Orbital period range of the default targets; see select_kics.
+    source, cache, quality_mask, sigma_clip : optional
+        Loading and cleaning of the light curves; see data.loadlc_db.
+        (Default quality_mask: data.QUALITY_BITMASK)
+    period_range : tuple, optional
+        Period range of the periodogram, in days. (Default: (0.05, 45))
+    oversampling : float, optional
+        Periodogram grid points per peak width. (Default: 5)
+    npeaks : int, optional
+        Number of periodogram peaks examined. (Default: 10)
+    tol, max_order : optional
+        Matching of aliases and harmonics; see classify_peaks.
+    min_power : float, optional
+        Power of the weakest peak kept, relative to the highest.
+        (Default: 0.1)
+    processes : int, optional
+        Number of search processes. (Default: number of CPUs)
+    fetch_threads : int, optional
+        Number of light curves loaded at once. (Default: 4)
+    max_pending : int, optional
+        Largest number of loaded light curves waiting for, or in, the
+        search. (Default: 4 per search process)
+    retry : bool, optional
+        If True, also process the targets stored with status 'error'.
+        (Default: False)
+    **kwargs
+        Passed on to the light curve source.
+
+    Returns
+    -------
+    store : ResultStore
+        The results.
+
+    """
+    if not isinstance(store, ResultStore):
+        store = ResultStore(store)
+    if kics is None:
+        kics = data.select_kics(catfile, pmin, pmax)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if max_pending is None:
+        max_pending = 4 * processes
+
+    todo = []
+    for kic in kics:
+        kic = int(kic)
+        if kic not in store or \
+                (retry and store.load(kic)['status'] == 'error'):
+            todo.append(kic)
+    todo = sorted(set(todo))
+    print 'Searching %d of %d systems.' % (len(todo), len(kics))
+
+    load_kwargs = dict(kwargs, catfile=catfile, source=source, cache=cache,
+                       quality_mask=quality_mask, sigma_clip=sigma_clip)
+    search_args = (period_range, oversampling, npeaks, tol, max_order,
+                   min_power)
+
+    # Fetching waits for a free slot, which is given back once the search
+    # of a target is done, so loading never runs far ahead of the search.
+    slots = threading.BoundedSemaphore(max_pending)
+    finished = Queue.Queue()
+
+    def fetch_tasks():
+        for kic in todo:
+            slots.acquire()
+            yield kic, load_kwargs
+
+    def done(result):
+        slots.release()
+        finished.put(result)
+
+    # Searches in progress. A search that fails in the pool itself, e.g.
+    # when its light curve cannot be pickled, gets no callback; it is
+    # recorded as an error once its result is ready.
+    pending = {}
+
+    def collect(timeout=None):
+        for kic, search in pending.items():
+            if search.ready():
+                del pending[kic]
+                if not search.successful():
+                    try:
+                        search.get()
+                    except Exception as err:
+                        done(dict(kic=kic, status='error', error='{0}: {1}'.
+                                  format(type(err).__name__, err)))
+
+        results = []
+        try:
+            results.append(finished.get(timeout=timeout) if timeout
+                           else finished.get_nowait())
+            while True:
+                results.append(finished.get_nowait())
+        except Queue.Empty:
+            pass
+
+        for result in results:
+            store.write(result)
+            counts['results'] += 1
+            counts['candidates'] += bool(result.get('candidate'))
+
+    fetchers = multiprocessing.pool.ThreadPool(fetch_threads)
+    searchers = multiprocessing.Pool(processes)
+    counts = dict(results=0, candidates=0)
+    try:
+        fetched = fetchers.imap_unordered(_fetch, fetch_tasks())
+        while True:
+            # Failed searches free their slot in collect, so keep calling
+            # it while fetching waits for a slot.
+            try:
+                kic, curve, error = fetched.next(timeout=1.0)
+            except multiprocessing.TimeoutError:
+                collect()
+                continue
+            except StopIteration:
+                break
+
+            if curve is None:
+                done(dict(kic=kic, status='error', error=error))
+            else:
+                pending[kic] = searchers.apply_async(
+                    _search, ((kic, curve) + search_args,), callback=done)
+
+            collect()
+
+        while counts['results'] < len(todo):
+            # Waiting in short steps keeps the loop interruptible, and
+            # catches failed searches.
+            collect(timeout=1.0)
+    finally:
+        fetchers.terminate()
+        searchers.terminate()
+        fetchers.join()
+        searchers.join()
+
+    print 'Searched %d systems, %d candidates.' % (counts['results'],
+                                                   counts['candidates'])
+    return store
@@ -2,6 +2,7 @@
 #include <stdio.h>
 #include <string.h>
 #include <time.h>
+#include <math.h>
 
 #include <gsl/gsl_vector.h>
 #include <gsl/gsl_matrix.h>
@@ -20,8 +21,16 @@ int    FIND_STEP = 0;
 
 int    CHAIN_LENGTH = 8;
 
+/* Independent knot search chains, and iterations without improvement
+ * after which a chain stops early (0 to always run all ITERS). */
+int    CHAINS   = 1;
+int    PATIENCE = 0;
+
 int    ANN_COMPATIBLE = 0;
 
+/* Suppress all diagnostic output; set when running as a library. */
+int    SILENT = 0;
+
 /* Maximum number of observed data points: */
 #define NMAX 10000
 
@@ -65,7 +74,7 @@ int find_knots (triplet *data, int nobs, double **knots)
 		average += data[i].y;
 	average /= (double) nobs;
 
-	if (!ANN_COMPATIBLE) {
+	if (!ANN_COMPATIBLE && !SILENT) {
 		printf ("# searching for knots automatically:\n");
 		printf ("# * average value of the flux: %lf\n", average);
 	}
@@ -145,13 +154,13 @@ int find_knots (triplet *data, int nobs, double **knots)
 			/* else drop through without recording it because it is shorter. */
 		}
 
-		if (!ANN_COMPATIBLE)
+		if (!ANN_COMPATIBLE && !SILENT)
 			printf ("# * found a chain from %lf (index %d/%d) to %lf (index %d/%d)\n", data[chain_wrapped*nobs+i].x, chain_wrapped*nobs+i, nobs-1, data[i+j-1].x, i+j-1, nobs-1);
 		i += j-1;
 		if (chain_wrapped) break;
 	}
 
-	if (!ANN_COMPATIBLE)
+	if (!ANN_COMPATIBLE && !SILENT)
 		printf ("# * total number of chains found: %d\n", chains);
 
 	/* If the number of chains is less than 2, the search for knots failed. */
@@ -166,7 +175,13 @@ int find_knots (triplet *data, int nobs, double **knots)
 	return 0;
 }
 
-double polyfit (triplet *data, int nobs, int KNOTS, double *knots, int VERBOSE, int PRINT)
+/*
+ * Fits the polynomial chain for the given knots and returns its chi2. If
+ * coeffs is not NULL, it receives KNOTS*(POLYORDER+1) coefficients: for
+ * each interval, the polynomial in (phase - knot) in ascending powers.
+ */
+
+double polyfit (triplet *data, int nobs, int KNOTS, double *knots, int VERBOSE, int PRINT, double *coeffs)
 {
 	int i, j, k, intervals, kfinal, cum, int1index;
 	double chisq, chi2tot, knot, dknot;
@@ -448,8 +463,20 @@ double polyfit (triplet *data, int nobs, int KNOTS, double *knots, int VERBOSE,
 		}
 	}
 
+	if (coeffs) {
+		for (j = 0; j < KNOTS; j++)
+			for (k = 0; k < POLYORDER+1; k++)
+				coeffs[j*(POLYORDER+1)+k] = ck[j][POLYORDER-k];
+
+		/* Fold the periodicity terms of the last interval into its slope: */
+		j = KNOTS-1;
+		dknot = knots[0]-knots[j]+1.0;
+		for (k = 0; k < POLYORDER-1; k++)
+			coeffs[j*(POLYORDER+1)+1] -= ck[j][k] * pow (dknot, POLYORDER-k-1);
+	}
+
 	/* Done! Wrap it up: */
-	for (i = 0; i < KNOTS-1; i++) {
+	for (i = 0; i < KNOTS; i++) {
 		gsl_vector_free (x[i]);
 		gsl_vector_free (y[i]);
 		gsl_vector_free (w[i]);
@@ -475,18 +502,508 @@ double polyfit (triplet *data, int nobs, int KNOTS, double *knots, int VERBOSE,
 	return chi2tot;
 }
 
+/*
+ * Fast chi2 evaluation for the knot search.
+ *
+ * The workspace splits the phase-sorted data into blocks of MOMENT_BLOCK
+ * points and holds the weighted moments w*dx^k, w*dx^k*y and w*y^2 of each
+ * block, with dx measured from the first phase of the block. The moments of
+ * an interval between two knots are the moments of the whole blocks inside
+ * it, shifted binomially to the knot, plus the few points at either end. The
+ * constrained least-squares fit of the interval then reduces to a
+ * (POLYORDER+1)-sized system of normal equations. Evaluating a set of knots
+ * costs O(nobs/MOMENT_BLOCK * POLYORDER^2 + KNOTS * POLYORDER^3) and
+ * allocates nothing.
+ *
+ * Shifting moments only across the width of an interval keeps them
+ * accurate; prefix sums over all the data would cancel catastrophically in
+ * the high moments of narrow intervals.
+ */
+
+#define MOMENT_BLOCK 32
+
+typedef struct polyfit_workspace {
+	int nobs;
+	int order;
+	int stride;      /* Length of one row of block moments */
+	triplet *data;   /* Phase-sorted data */
+	double *x;       /* Sorted phases, for locating the knots */
+	double *moments; /* One row of moments per block */
+	double ymean;    /* Weighted mean flux, subtracted from y for accuracy */
+	double *binom;   /* Binomial coefficients up to 2*order */
+} polyfit_workspace;
+
+/* Add the moments of data points lo...hi-1 about phase a to M, B and S: */
+
+static void sum_moments (const polyfit_workspace *ws, int lo, int hi, double a, double *M, double *B, double *S)
+{
+	int i, k, P = ws->order;
+	double dx, y, xk;
+
+	for (i = lo; i < hi; i++) {
+		dx = ws->data[i].x - a;
+		y = ws->data[i].y - ws->ymean;
+		xk = ws->data[i].z;
+		for (k = 0; k <= 2*P; k++) {
+			M[k] += xk;
+			if (k <= P)
+				B[k] += xk * y;
+			xk *= dx;
+		}
+		*S += ws->data[i].z * y * y;
+	}
+}
+
+polyfit_workspace *polyfit_workspace_alloc (triplet *data, int nobs, int order)
+{
+	int i, k, n, nblocks, nb = 2*order+1;
+	double sw = 0.0, swy = 0.0;
+	double *row;
+	polyfit_workspace *ws;
+
+	nblocks = nobs / MOMENT_BLOCK;
+
+	ws = malloc (sizeof (*ws));
+	ws->data = data;
+	ws->nobs = nobs;
+	ws->order = order;
+	ws->stride = nb + (order+1) + 1;
+	ws->x = malloc (nobs * sizeof (*ws->x));
+	ws->moments = calloc (nblocks * ws->stride + 1, sizeof (*ws->moments));
+	ws->binom = calloc (nb * nb, sizeof (*ws->binom));
+
+	for (i = 0; i < nobs; i++) {
+		ws->x[i] = data[i].x;
+		sw  += data[i].z;
+		swy += data[i].z * data[i].y;
+	}
+	ws->ymean = swy / sw;
+
+	for (i = 0; i < nblocks; i++) {
+		row = ws->moments + i * ws->stride;
+		sum_moments (ws, i * MOMENT_BLOCK, (i+1) * MOMENT_BLOCK, ws->x[i * MOMENT_BLOCK], row, row + nb, row + ws->stride-1);
+	}
+
+	for (n = 0; n < nb; n++) {
+		ws->binom[n*nb] = 1.0;
+		for (k = 1; k <= n; k++)
+			ws->binom[n*nb+k] = ws->binom[(n-1)*nb+k-1] + ((k < n) ? ws->binom[(n-1)*nb+k] : 0.0);
+	}
+
+	return ws;
+}
+
+void polyfit_workspace_free (polyfit_workspace *ws)
+{
+	free (ws->x);
+	free (ws->moments);
+	free (ws->binom);
+	free (ws);
+}
+
+/* Index of the first data point with phase >= value: */
+
+static int lower_bound (const double *x, int nobs, double value)
+{
+	int lo = 0, hi = nobs, mid;
+
+	while (lo < hi) {
+		mid = (lo + hi) / 2;
+		if (x[mid] < value) lo = mid + 1;
+		else hi = mid;
+	}
+
+	return lo;
+}
+
+/* Add the moments of data points lo...hi-1 about phase a to M, B and S: */
+
+static void add_moments (const polyfit_workspace *ws, int lo, int hi, double a, double *M, double *B, double *S)
+{
+	int b, k, n, P = ws->order, nb = 2*ws->order+1;
+	int first = (lo + MOMENT_BLOCK-1) / MOMENT_BLOCK, last = hi / MOMENT_BLOCK;
+	double apow[2*ws->order+1];
+	const double *row;
+
+	if (first >= last) {
+		sum_moments (ws, lo, hi, a, M, B, S);
+		return;
+	}
+
+	sum_moments (ws, lo, first * MOMENT_BLOCK, a, M, B, S);
+	sum_moments (ws, last * MOMENT_BLOCK, hi, a, M, B, S);
+
+	for (b = first; b < last; b++) {
+		row = ws->moments + b * ws->stride;
+
+		/* Powers of the block origin relative to a: */
+		apow[0] = 1.0;
+		for (k = 1; k < nb; k++)
+			apow[k] = (ws->x[b * MOMENT_BLOCK] - a) * apow[k-1];
+
+		for (n = 0; n < nb; n++)
+			for (k = 0; k <= n; k++) {
+				M[n] += ws->binom[n*nb+k] * apow[n-k] * row[k];
+				if (n <= P)
+					B[n] += ws->binom[n*nb+k] * apow[n-k] * row[nb+k];
+			}
+		*S += row[ws->stride-1];
+	}
+}
+
+/*
+ * Weighted least squares for one interval: fit y - q(x) with the nfree
+ * polynomials in the rows of T (all polynomials in ascending powers, about
+ * the knot). Adds the solution to q and returns chi2 of the interval.
+ */
+
+static double fit_interval (polyfit_workspace *ws, const double *M, const double *B, double S, double *q, double *T, int nfree)
+{
+	int a, b, i, k, np = ws->order+1;
+	double Mq[np], Bq[np], r[nfree+1], N[nfree*nfree+1], scale[nfree+1], c[nfree+1];
+	double chi2, sum;
+
+	/* Moments of the residuals y - q(x), with y measured from ymean: */
+	q[0] -= ws->ymean;
+	chi2 = S;
+	for (a = 0; a < np; a++) {
+		Mq[a] = 0.0;
+		for (b = 0; b < np; b++)
+			Mq[a] += M[a+b] * q[b];
+		Bq[a] = B[a] - Mq[a];
+		chi2 -= q[a] * (2.0 * B[a] - Mq[a]);
+	}
+	q[0] += ws->ymean;
+
+	/* Normal equations, scaled to unit diagonal: */
+	for (i = 0; i < nfree; i++) {
+		r[i] = 0.0;
+		for (a = 0; a < np; a++)
+			r[i] += T[i*np+a] * Bq[a];
+		for (k = 0; k <= i; k++) {
+			sum = 0.0;
+			for (a = 0; a < np; a++)
+				for (b = 0; b < np; b++)
+					sum += T[i*np+a] * M[a+b] * T[k*np+b];
+			N[i*nfree+k] = N[k*nfree+i] = sum;
+		}
+		if (N[i*nfree+i] <= 0.0)
+			return 1e10;
+		scale[i] = 1.0 / sqrt (N[i*nfree+i]);
+	}
+	for (i = 0; i < nfree; i++) {
+		c[i] = r[i] * scale[i];
+		for (k = 0; k < nfree; k++)
+			N[i*nfree+k] *= scale[i] * scale[k];
+	}
+
+	/* Cholesky decomposition and solution: */
+	for (i = 0; i < nfree; i++) {
+		for (k = 0; k <= i; k++) {
+			sum = N[i*nfree+k];
+			for (a = 0; a < k; a++)
+				sum -= N[i*nfree+a] * N[k*nfree+a];
+			if (i == k) {
+				if (sum <= 0.0)
+					return 1e10;
+				N[i*nfree+i] = sqrt (sum);
+			}
+			else
+				N[i*nfree+k] = sum / N[k*nfree+k];
+		}
+	}
+	for (i = 0; i < nfree; i++) {
+		for (a = 0; a < i; a++)
+			c[i] -= N[i*nfree+a] * c[a];
+		c[i] /= N[i*nfree+i];
+	}
+	for (i = nfree-1; i >= 0; i--) {
+		for (a = i+1; a < nfree; a++)
+			c[i] -= N[a*nfree+i] * c[a];
+		c[i] /= N[i*nfree+i];
+	}
+
+	for (i = 0; i < nfree; i++) {
+		c[i] *= scale[i];
+		chi2 -= c[i] * r[i];
+		for (a = 0; a < np; a++)
+			q[a] += c[i] * T[i*np+a];
+	}
+
+	return chi2;
+}
+
+/*
+ * Same fit and chi2 as polyfit(), computed from the workspace. If coeffs is
+ * not NULL, it receives the coefficients in the same layout as polyfit().
+ */
+
+double polyfit_fast (polyfit_workspace *ws, int KNOTS, double *knots, double *coeffs)
+{
+	int i, j, k, nfree, P = ws->order, np = ws->order+1;
+	int start[KNOTS];
+	double M[2*P+1], B[np], S, h, d, hk;
+	double poly[KNOTS*np], T[np*np];
+	double chi2, chi2tot = 0.0;
+
+	/* Knots out of order leave an empty interval: */
+	for (j = 0; j < KNOTS-1; j++)
+		if (!(knots[j] < knots[j+1]))
+			return 1e10;
+
+	/* The intervals between knots need enough points: */
+	for (j = 0; j < KNOTS; j++)
+		start[j] = lower_bound (ws->x, ws->nobs, knots[j]);
+	for (j = 0; j < KNOTS-1; j++)
+		if (start[j+1] - start[j] <= P)
+			return 1e10;
+	if (ws->nobs - start[KNOTS-1] + start[0] <= P)
+		return 1e10;
+
+	for (j = 0; j < KNOTS; j++) {
+		double *q = poly + j*np;
+
+		for (k = 0; k < 2*P+1; k++) M[k] = 0.0;
+		for (k = 0; k < np; k++) B[k] = q[k] = 0.0;
+		for (k = 0; k < np*np; k++) T[k] = 0.0;
+		S = 0.0;
+
+		if (j < KNOTS-1)
+			add_moments (ws, start[j], start[j+1], knots[j], M, B, &S);
+		else {
+			/* The last interval wraps around to the first knot: */
+			add_moments (ws, start[j], ws->nobs, knots[j], M, B, &S);
+			add_moments (ws, 0, start[0], knots[j]-1.0, M, B, &S);
+		}
+
+		if (j == 0) {
+			/* All polynomial coefficients are free: */
+			nfree = np;
+			for (k = 0; k < np; k++)
+				T[k*np+k] = 1.0;
+		}
+		else {
+			/* Connectivity constraint: */
+			h = knots[j]-knots[j-1];
+			hk = 1.0;
+			for (k = 0; k < np; k++) {
+				q[0] += poly[(j-1)*np+k] * hk;
+				hk *= h;
+			}
+
+			if (j < KNOTS-1) {
+				nfree = P;
+				for (k = 0; k < P; k++)
+					T[k*np+k+1] = 1.0;
+			}
+			else {
+				/* Periodicity constraint: */
+				d = knots[0]-knots[j]+1.0;
+				q[1] = (poly[0] - q[0]) / d;
+				nfree = P-1;
+				for (k = 0; k < P-1; k++) {
+					T[k*np+P-k] = 1.0;
+					T[k*np+1] -= pow (d, P-k-1);
+				}
+			}
+		}
+
+		chi2 = fit_interval (ws, M, B, S, q, T, nfree);
+		if (chi2 >= 1e10)
+			return 1e10;
+		chi2tot += chi2;
+	}
+
+	if (coeffs)
+		for (i = 0; i < KNOTS*np; i++)
+			coeffs[i] = poly[i];
+
+	return chi2tot;
+}
+
+/* Step size is the minimum width between two knots / 5: */
+
+double find_step (double *knots, int KNOTS)
+{
+	int i;
+	double diff;
+
+	diff = fabs (knots[1]-knots[0]);
+	for (i = 1; i < KNOTS-1; i++)
+		if (fabs (knots[i+1]-knots[i]) < diff)
+			diff = fabs (knots[i+1]-knots[i]);
+	if (fabs (knots[i+1]-knots[0]) < diff)
+		diff = fabs (knots[i+1]-knots[0]);
+
+	return diff / 5.0;
+}
+
+/*
+ * Randomly displaces all knots ITERS times, keeping each displacement that
+ * lowers chi2. Stops early after PATIENCE iterations in a row without
+ * improvement, unless PATIENCE is 0. The knots are updated in place;
+ * returns the final chi2.
+ */
+
+double search_knots (polyfit_workspace *ws, int KNOTS, double *knots, int ITERS, double STEP_SIZE, int PATIENCE, gsl_rng *r, double chi2)
+{
+	int i, iter, stalled = 0;
+	double chi2test, u;
+	double *test;
+
+	test = malloc (KNOTS * sizeof (*test));
+
+	for (iter = 0; iter < ITERS; iter++) {
+		for (i = 0; i < KNOTS; i++) {
+			u = gsl_rng_uniform (r);
+			test[i] = knots[i] + STEP_SIZE * 2 * u - STEP_SIZE;
+			if (test[i] < -0.5) test[i] += 1.0;
+			if (test[i] >  0.5) test[i] -= 1.0;
+		}
+
+		chi2test = polyfit_fast (ws, KNOTS, test, NULL);
+		if (chi2test < chi2) {
+			chi2 = chi2test;
+			for (i = 0; i < KNOTS; i++)
+				knots[i] = test[i];
+			stalled = 0;
+		}
+		else if (PATIENCE && ++stalled >= PATIENCE)
+			break;
+	}
+
+	free (test);
+
+	return chi2;
+}
+
+/*
+ * Runs CHAINS independent knot searches from the same initial knots, chain c
+ * seeded with seed+c, and keeps the best result. The chains run in parallel
+ * when compiled with OpenMP. With one chain this is identical to a single
+ * search_knots() call seeded with seed.
+ */
+
+double search_knots_chains (polyfit_workspace *ws, int KNOTS, double *knots, int ITERS, double STEP_SIZE, int PATIENCE, int CHAINS, unsigned long seed)
+{
+	int c, i, best = 0;
+	double chi2;
+	double *chain_knots, *chain_chi2;
+
+	if (CHAINS < 1)
+		CHAINS = 1;
+
+	chi2 = polyfit_fast (ws, KNOTS, knots, NULL);
+
+	chain_knots = malloc (CHAINS * KNOTS * sizeof (*chain_knots));
+	chain_chi2 = malloc (CHAINS * sizeof (*chain_chi2));
+
+	#pragma omp parallel for private(i)
+	for (c = 0; c < CHAINS; c++) {
+		gsl_rng *r = gsl_rng_alloc (gsl_rng_mt19937);
+		gsl_rng_set (r, seed + c);
+		for (i = 0; i < KNOTS; i++)
+			chain_knots[c*KNOTS+i] = knots[i];
+		chain_chi2[c] = search_knots (ws, KNOTS, chain_knots + c*KNOTS, ITERS, STEP_SIZE, PATIENCE, r, chi2);
+		gsl_rng_free (r);
+	}
+
+	for (c = 1; c < CHAINS; c++)
+		if (chain_chi2[c] < chain_chi2[best])
+			best = c;
+
+	chi2 = chain_chi2[best];
+	for (i = 0; i < KNOTS; i++)
+		knots[i] = chain_knots[best*KNOTS+i];
+
+	free (chain_knots);
+	free (chain_chi2);
+
+	return chi2;
+}
+
+/*
+ * Library entry point, for running polyfit in-process (e.g. through ctypes)
+ * instead of through files. Build with `make libpolyfit.so`.
+ *
+ *   phase, flux   ..  nobs data points, phase in [-0.5, 0.5)
+ *   sigma         ..  standard deviations, or NULL for equal weights
+ *   knots         ..  in: initial knots (unless find_knots), out: final knots;
+ *                     must have room for at least 4 knots
+ *   nknots        ..  in: number of initial knots, out: number of final knots
+ *   coeffs        ..  out: (*nknots)*(order+1) coefficients, see polyfit()
+ *   chi2          ..  out: chi2 of the final fit
+ *   chains        ..  number of independent knot search chains
+ *   patience      ..  stop a chain after this many iterations without
+ *                     improvement (0 to always run all iters)
+ *
+ * Returns 0 on success, or -1 if no valid fit was found.
+ */
+
+int polyfit_fit (const double *phase, const double *flux, const double *sigma, int nobs, int order, int iters, double step, int find_knots_flag, int find_step_flag, int chain_length, unsigned long seed, double *knots, int *nknots, double *coeffs, double *chi2, int chains, int patience)
+{
+	int i, status;
+	triplet *data;
+	double *found = NULL;
+	polyfit_workspace *ws;
+
+	SILENT = 1;
+	POLYORDER = order;
+	CHAIN_LENGTH = chain_length;
+
+	data = malloc (nobs * sizeof (*data));
+	for (i = 0; i < nobs; i++) {
+		data[i].x = phase[i];
+		data[i].y = flux[i];
+		data[i].z = sigma ? 1.0/sigma[i]/sigma[i] : 1.0;
+	}
+
+	qsort (data, nobs, sizeof (*data), sort_by_phase);
+
+	if (find_knots_flag) {
+		status = find_knots (data, nobs, &found);
+		if (status == 0) {
+			*nknots = KNOTS;
+			for (i = 0; i < KNOTS; i++)
+				knots[i] = found[i];
+			free (found);
+		}
+		else if (*nknots < 4) {
+			/* Revert to the default knots: */
+			*nknots = 4;
+			knots[0] = -0.4; knots[1] = -0.1; knots[2] = 0.1; knots[3] = 0.4;
+		}
+	}
+
+	qsort (knots, *nknots, sizeof (*knots), sort_by_value);
+
+	if (find_step_flag)
+		step = find_step (knots, *nknots);
+
+	ws = polyfit_workspace_alloc (data, nobs, order);
+	search_knots_chains (ws, *nknots, knots, iters, step, patience, chains, seed);
+	polyfit_workspace_free (ws);
+
+	*chi2 = polyfit (data, nobs, *nknots, knots, 0, 0, coeffs);
+
+	free (data);
+
+	return (*chi2 < 1e10) ? 0 : -1;
+}
+
+#ifndef POLYFIT_LIB
+
 int main (int argc, char **argv)
 {
-	int i, nobs, iter, status;
+	int i, nobs, status;
 	triplet *data;
 	FILE *in;
-	double col1, col2, col3, chi2, chi2test, u;
+	double col1, col2, col3, chi2;
 	char line[255];
 
 	double *knots = NULL;
-	double *test;
 
-	gsl_rng *r;
+	polyfit_workspace *ws;
 
 	if (argc < 2) {
 		printf ("Usage: ./polyfit [options] lc.dat\n\n");
@@ -500,6 +1017,8 @@ int main (int argc, char **argv)
 		printf ("  --find-knots      ..  attempt to find knots automatically\n");
 		printf ("  --find-step       ..  attempt to find step automatically\n");
 		printf ("  --chain-length    ..  minimum chain length for automatic knot search\n");
+		printf ("  --chains N        ..  number of independent knot search chains (default: 1)\n");
+		printf ("  --patience N      ..  stop a chain after N iterations without improvement\n");
 		printf ("  --ann-compatible  ..  make output ANN-compatible\n\n");
 		exit (0);
 	}
@@ -529,6 +1048,10 @@ int main (int argc, char **argv)
 			FIND_STEP = 1;
 		if (strcmp (argv[i], "--chain-length") == 0)
 			CHAIN_LENGTH = atoi (argv[++i]);
+		if (strcmp (argv[i], "--chains") == 0)
+			CHAINS = atoi (argv[++i]);
+		if (strcmp (argv[i], "--patience") == 0)
+			PATIENCE = atoi (argv[++i]);
 		if (strcmp (argv[i], "--ann-compatible") == 0)
 			ANN_COMPATIBLE = 1;
 	}
@@ -600,18 +1123,8 @@ int main (int argc, char **argv)
 	/* Sort the knots in ascending order: */
 	qsort (knots, KNOTS, sizeof (*knots), sort_by_value);
 
-	if (FIND_STEP) {
-		double diff;
-		/* Step size would be the minimum width between two knots / 5: */
-		diff = fabs (knots[1]-knots[0]);
-		for (i = 1; i < KNOTS-1; i++)
-			if (fabs (knots[i+1]-knots[i]) < diff)
-				diff = fabs (knots[i+1]-knots[i]);
-		if (fabs (knots[i+1]-knots[0]) < diff)
-			diff = fabs (knots[i+1]-knots[0]);
-
-		STEP_SIZE = diff / 5.0;
-	}
+	if (FIND_STEP)
+		STEP_SIZE = find_step (knots, KNOTS);
 
 	if (!ANN_COMPATIBLE) {
 		printf ("# Fitting polynomial order: %d\n", POLYORDER);
@@ -623,39 +1136,22 @@ int main (int argc, char **argv)
 		printf ("# Step size for knot search: %lf\n# \n", STEP_SIZE);
 	}
 
-	r = gsl_rng_alloc (gsl_rng_mt19937);
-	gsl_rng_set (r, 1);
-
-	chi2 = polyfit (data, nobs, KNOTS, knots, 0, 0);
+	chi2 = polyfit (data, nobs, KNOTS, knots, 0, 0, NULL);
 	if (!ANN_COMPATIBLE)
 		printf ("# Original chi2: %lf\n", chi2);
 
-	test = malloc (KNOTS * sizeof (*test));
-
-	for (iter = 0; iter < ITERS; iter++) {
-		for (i = 0; i < KNOTS; i++) {
-			u = gsl_rng_uniform (r);
-			test[i] = knots[i] + STEP_SIZE * 2 * u - STEP_SIZE;
-			if (test[i] < -0.5) test[i] += 1.0;
-			if (test[i] >  0.5) test[i] -= 1.0;
-		}
-
-		chi2test = polyfit (data, nobs, KNOTS, test, 0, 0);
-		if (chi2test < chi2) {
-			chi2 = chi2test;
-			for (i = 0; i < KNOTS; i++)
-				knots[i] = test[i];
-		}
-	}
+	ws = polyfit_workspace_alloc (data, nobs, POLYORDER);
+	chi2 = search_knots_chains (ws, KNOTS, knots, ITERS, STEP_SIZE, PATIENCE, CHAINS, 1);
+	polyfit_workspace_free (ws);
 
 	if (!ANN_COMPATIBLE)
 		printf ("# Final chi2:    %lf\n# \n", chi2);
-	chi2 = polyfit (data, nobs, KNOTS, knots, 1, 1);
+	chi2 = polyfit (data, nobs, KNOTS, knots, 1, 1, NULL);
 
-	gsl_rng_free (r);
 	free (data);
-	free (test);
 	free (knots);
 
 	return 0;
 }
+
+#endif
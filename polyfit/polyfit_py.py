@@ -1,14 +1,152 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import ctypes
+import multiprocessing
 import os
 
-import pandas as pd
 import numpy as np
-from scipy.interpolate import interp1d
+import pandas as pd
+
+_lib = None
+
+
+def _load_lib():
+    """
+    Load the polyfit shared library, built with `make libpolyfit.so`.
+    """
+    global _lib
+
+    if _lib is None:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'libpolyfit.so')
+        lib = ctypes.CDLL(path)
+
+        array = np.ctypeslib.ndpointer(np.float64, flags='C_CONTIGUOUS')
+        lib.polyfit_fit.argtypes = [array, array, ctypes.c_void_p,
+                                    ctypes.c_int, ctypes.c_int, ctypes.c_int,
+                                    ctypes.c_double, ctypes.c_int,
+                                    ctypes.c_int, ctypes.c_int,
+                                    ctypes.c_ulong, array,
+                                    ctypes.POINTER(ctypes.c_int), array,
+                                    ctypes.POINTER(ctypes.c_double),
+                                    ctypes.c_int, ctypes.c_int]
+        lib.polyfit_fit.restype = ctypes.c_int
+        _lib = lib
+
+    return _lib
+
+
+def fit(phase, flux, sigma=None, order=2, iters=1000, step=0.01, knots=None,
+        find_knots=True, find_step=True, chain_length=8, seed=1, chains=1,
+        patience=0):
+    """
+    Fit a chain of polynomials to a phased lightcurve, in-process.
+
+    Calls the polyfit C code directly on the arrays; see phase_fit for the
+    meaning of the options.
+
+    Parameters
+    ----------
+    phase : array_like
+        The input orbital phase, from -0.5 to 0.5.
+    flux : array_like
+        The input fluxes in relative units.
+    sigma : array_like, optional
+        Flux uncertainties. Default is to weight all points equally.
+    chain_length : int, optional
+        Minimum chain length for the automatic knot search. (Default: 8)
+    seed : int, optional
+        Seed of the random knot displacements. (Default: 1)
+    chains : int, optional
+        Number of independent knot searches; the best one is kept.
+        (Default: 1)
+    patience : int, optional
+        Stop a knot search after this many iterations without improvement,
+        or never if 0. (Default: 0)
+
+    Returns
+    -------
+    knots : ndarray
+        The final knots, in ascending phase.
+    coeffs : ndarray
+        Polynomial coefficients with shape (len(knots), order + 1). Row i
+        is the polynomial in (phase - knots[i]), in ascending powers, which
+        holds from knots[i] to the next knot.
+    chi2 : float
+        Chi-squared of the fit.
+
+    """
+    lib = _load_lib()
+
+    phase = np.ascontiguousarray(phase, dtype=np.float64)
+    flux = np.ascontiguousarray(flux, dtype=np.float64)
+    if sigma is not None:
+        sigma = np.ascontiguousarray(sigma, dtype=np.float64)
+        sigma_ptr = sigma.ctypes.data
+    else:
+        sigma_ptr = None
+
+    if isinstance(knots, str):
+        knots = knots.split()
+    if knots is None:
+        if not find_knots:
+            raise ValueError("Use 'knots' to provide an explict list of "
+                             "knots.")
+        knots = []
+
+    nknots = ctypes.c_int(len(knots))
+    knots_out = np.zeros(max(len(knots), 4), dtype=np.float64)
+    knots_out[:len(knots)] = np.asarray(knots, dtype=np.float64)
+    coeffs = np.zeros(knots_out.size * (order + 1), dtype=np.float64)
+    chi2 = ctypes.c_double()
+
+    status = lib.polyfit_fit(phase, flux, sigma_ptr, phase.size, order, iters,
+                             step, int(find_knots), int(find_step),
+                             chain_length, seed, knots_out,
+                             ctypes.byref(nknots), coeffs, ctypes.byref(chi2),
+                             chains, patience)
+    if status != 0:
+        raise RuntimeError('polyfit could not fit the light curve.')
+
+    nknots = nknots.value
+    coeffs = coeffs[:nknots * (order + 1)].reshape(nknots, order + 1)
+
+    return knots_out[:nknots], coeffs, chi2.value
+
+
+def chain_model(phase, knots, coeffs):
+    """
+    Evaluate a polynomial chain from `fit` at the given phases.
+
+    Parameters
+    ----------
+    phase : array_like
+        Orbital phase, from -0.5 to 0.5.
+    knots, coeffs : ndarray
+        As returned by `fit`.
+
+    Returns
+    -------
+    flux : ndarray
+        Model flux at each phase.
+
+    """
+    phase = np.asarray(phase, dtype=np.float64)
+
+    # Phases before the first knot belong to the wrapped last interval.
+    interval = np.searchsorted(knots, phase, side='right') - 1
+    origin = knots[interval] - (interval < 0)
+
+    xx = phase - origin
+    flux = np.zeros_like(xx)
+    for cc in coeffs[interval].T[::-1]:
+        flux = flux * xx + cc
+
+    return flux
 
 
 def phase_fit(phase, flux, order=2, iters=1000, step=0.01, knots=None,
-              find_knots=True, find_step=True):
+              find_knots=True, find_step=True, seed=1, chains=1, patience=0):
     """
     Run polyfit on a phased lightcurve to find the eclipses.
 
@@ -31,12 +169,21 @@ def phase_fit(phase, flux, order=2, iters=1000, step=0.01, knots=None,
         The number of iterations. (Default: 1000)
     step : float, optional
         Step size for random knot displacement.
-    knots : str, optional
+    knots : array_like or str, optional
         An explicit list of knots.
     find_knots : bool, optional
         Default is to find knots automatically.
     find_step : bool, optional
         Default is to find step size automatically.
+    seed : int, optional
+        Seed of the random knot displacements. (Default: 1)
+    chains : int, optional
+        Number of independent knot searches, run in parallel if polyfit was
+        built with OpenMP; the best one is kept. Chain c uses the seed
+        `seed + c`. (Default: 1)
+    patience : int, optional
+        Stop a knot search after this many iterations without improvement,
+        or never if 0. (Default: 0)
 
     Returns
     -------
@@ -48,6 +195,10 @@ def phase_fit(phase, flux, order=2, iters=1000, step=0.01, knots=None,
         s_depth: depth of secondary eclipse.
         sep: separation between primary and secondary eclipse in phase.
         p_phase: Phase of the primary eclipse.
+    model_phase : ndarray
+        Phases of the fitted light curve, from 0 to 1.
+    model_flux : ndarray
+        Fluxes of the fitted light curve.
 
     References
     ----------
@@ -55,57 +206,25 @@ def phase_fit(phase, flux, order=2, iters=1000, step=0.01, knots=None,
 
     """
     # Polyfit expects phase from -0.5 to 0.5
-    phase = phase - 0.5
-
-    # Parse arguments to construct polyfit command.
-    command = "polyfit -o {} -i {}".format(order, iters)
-
-    if find_step:
-        command += " --find-step"
-    else:
-        command += " -s {}".format(step)
+    phase = np.asarray(phase) - 0.5
 
-    if find_knots:
-        command += " --find-knots"
-    elif knots is not None:
-        command += " -k {}".format(knots)
-    elif knots is None:
-        raise ValueError("Use 'knots' to provide an explict list of knots.")
+    knots, coeffs, chi2 = fit(phase, flux, order=order, iters=iters,
+                              step=step, knots=knots, find_knots=find_knots,
+                              find_step=find_step, seed=seed, chains=chains,
+                              patience=patience)
 
-    command += " lc.dat > lc.out"
+    # The fit light curve, with phase from 0 to 1.
+    model_phase = np.linspace(-0.5, 0.5, 201)
+    model_flux = chain_model(model_phase, knots, coeffs)
+    model_phase += 0.5
 
-    # Write light curve to text file line by line.
-    text_file = open("lc.dat", "w")
+    widths = np.empty(knots.size)
+    midpoints = np.empty(knots.size)
 
-    for ph, fl in zip(phase, flux):
-        text_file.write("{:3.6f} {:3.6f} \n".format(ph, fl))
-
-    text_file.close()
-
-    os.system(command)
-
-    df = pd.read_table('lc.out', delim_whitespace=True, comment='#',
-                       names=('phase', 'flux'))
-
-    # We want phase from 0 to 1
-    df.phase += 0.5
-
-    # Interpolate the fit light curve to find flux at mid-eclipse.
-    interpolated_lc = interp1d(df.phase, df.flux)
-
-    ff = open("lc.out")
-    lines = ff.readlines()
-
-    widths = np.empty(4)
-    midpoints = np.empty(4)
-    midfluxes = np.empty(4)
-
-    # FIXME: This pulls parameters from specific lines and columns in file.
-    # This is stable as long as the output of polyfit.c doesn't change,
-    # but a more robust solution is probably desirable.
-    for ii, row in enumerate([19, 20, 21, 22]):
-        ph1 = float(lines[row][18:24]) + 0.5
-        ph2 = float(lines[row][26:32]) + 0.5
+    # Each pair of neighboring knots bounds one segment of the light curve.
+    for ii in range(knots.size):
+        ph1 = knots[ii] + 0.5
+        ph2 = knots[(ii + 1) % knots.size] + 0.5
 
         # Egress should be at greater phase than ingress.
         if ph2 < ph1:
@@ -118,7 +237,9 @@ def phase_fit(phase, flux, order=2, iters=1000, step=0.01, knots=None,
 
         widths[ii] = ph2 - ph1
         midpoints[ii] = mid
-        midfluxes[ii] = interpolated_lc(mid)
+
+    # Flux at mid-eclipse.
+    midfluxes = chain_model(midpoints - 0.5, knots, coeffs)
 
     # Sort by flux at midpoint to find primary and secondary eclipses.
     sort_indices = np.argsort(midfluxes)
@@ -133,7 +254,67 @@ def phase_fit(phase, flux, order=2, iters=1000, step=0.01, knots=None,
 
     params = (p_width, s_width, p_depth, s_depth, sep, p_phase)
 
-    os.remove('lc.dat')
-    os.remove('lc.out')
+    return params, model_phase, model_flux
+
+
+# Columns of the table returned by phase_fit_many.
+PARAM_NAMES = ('p_width', 's_width', 'p_depth', 's_depth', 'sep', 'p_phase')
+
+
+def _phase_fit_task(args):
+    """
+    Fit one light curve for phase_fit_many. Failed fits give NaNs.
+    """
+    phase, flux, seed, kwargs = args
+    try:
+        params, model_phase, model_flux = phase_fit(phase, flux, seed=seed,
+                                                    **kwargs)
+    except (RuntimeError, ValueError, IndexError):
+        params = (np.nan,) * len(PARAM_NAMES)
+
+    return params
+
+
+def phase_fit_many(curves, index=None, processes=None, seed=1, chunksize=1,
+                   **kwargs):
+    """
+    Run phase_fit on many phased lightcurves across a pool of processes.
+
+    Each fit runs in memory, so fits never share any files, and fit i uses
+    the knot search seed `seed + i`, so the results do not depend on the
+    number of processes or the order in which the fits finish.
+
+    Parameters
+    ----------
+    curves : sequence of (phase, flux) pairs
+        The phased lightcurves, with phase from 0 to 1.
+    index : sequence, optional
+        Labels of the lightcurves, e.g. KIC IDs, used as the index of the
+        returned table. (Default: 0, 1, 2, ...)
+    processes : int, optional
+        Number of worker processes. (Default: number of CPUs)
+    seed : int, optional
+        Seed of the knot search of the first lightcurve. (Default: 1)
+    chunksize : int, optional
+        Number of lightcurves handed to a worker at a time. (Default: 1)
+    **kwargs
+        Other phase_fit options, e.g. order or iters.
+
+    Returns
+    -------
+    params : pandas.DataFrame
+        One row of eclipse parameters per lightcurve, with the columns of
+        PARAM_NAMES. Rows of failed fits are NaN.
+
+    """
+    tasks = [(phase, flux, seed + ii, kwargs)
+             for ii, (phase, flux) in enumerate(curves)]
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(_phase_fit_task, tasks, chunksize)
+    finally:
+        pool.close()
+        pool.join()
 
-    return params, df.phase, df.flux
+    return pd.DataFrame(results, index=index, columns=PARAM_NAMES)
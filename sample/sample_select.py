@@ -1,4 +1,7 @@
-import pandas as pd
+import sys
+
+sys.path.append('..')
+from catalog import Catalog
 
 def save_list(kiclist, filename):
     """
@@ -21,7 +24,7 @@ def save_list(kiclist, filename):
 
     text_file.close()
 
-df = pd.read_csv("../villanova-db.csv", comment="#")
+df = Catalog.load("../villanova-db.csv").df.copy()
 df["pdepth/sdepth"] = df.pdepth / df.sdepth
 
 df_new = df[(df.pdepth > 0.1) & (df.sdepth > 0.1) & (df.period > 3.0)]